@@ -40,17 +40,30 @@ class Writer(object):
 
     def write_record(self, individual, data_samples,
                      data_collection_samples=None):
+        self.write_records([(individual, data_samples)],
+                           data_collection_samples)
+
+    def write_records(self, records, data_collection_samples=None):
+        """
+        Write (individual, data_samples) records, resolving the
+        genotype data of all selected data samples in bulk.
+        """
         allele_patterns = {0: 'AA', 1: 'BB', 2:'AB', 3: 'NN'}
-        if data_collection_samples:
-            dsamples = [d for d in data_samples if d in data_collection_samples]
-        else:
-            dsamples = data_samples
-        if len(dsamples) > 0:
+        dsamples = []
+        for individual, data_samples in records:
+            if data_collection_samples:
+                selected = [d for d in data_samples
+                            if d in data_collection_samples]
+            else:
+                selected = data_samples
             if self.igd:
-                dsamples = dsamples[:1]
+                selected = selected[:1]
+            dsamples.extend(selected)
+        if len(dsamples) > 0:
+            resolved = dsamples[0].proxy.resolve_to_data(dsamples)
             for ds in dsamples:
                 start = time.time()
-                probs, _ = ds.resolve_to_data()
+                probs, _ = resolved.next()
                 end = time.time() - start
                 self.counter['total_fetch_time'] += end
                 if end < self.counter['faster_fetch'] or 'faster_fetch' not in self.counter:
@@ -136,15 +149,9 @@ class App(Core):
             'logger' : self.logger
             }
         writer = Writer(**kw_args)
-        self.logger.info('Writing records')
-        for ind, dsamples in data_samples_map.iteritems():
-            self.logger.debug(
-                'Writing record for individual %s (%d/%d)' % (
-                    ind.id,
-                    data_samples_map.keys().index(ind) + 1, 
-                    len(inds)
-                    ))
-            writer.write_record(ind, dsamples, dc_samples)
+        self.logger.info('Writing records for %d individuals' %
+                         len(data_samples_map))
+        writer.write_records(data_samples_map.iteritems(), dc_samples)
         self.logger.info('Closing writer')
         writer.close()
         self.kb.disconnect()
@@ -107,6 +107,7 @@ def implementation(logger, host, user, passwd, args):
                         lineterminator=os.linesep)
   otsv.writeheader()
   global_stats.dump(args.study, otsv)
+  logger.info('object cache stats: %r' % global_stats.kb.get_cache_stats())
 
 
 def do_register(registration_list):
@@ -7,6 +7,7 @@ Extract marker data from KB
 """
 
 import os, csv
+import itertools as it
 
 from bl.vl.app.importer.core import Core
 
@@ -33,8 +34,8 @@ class Markers(Core):
     fieldnames = ['label', 'mask', 'index', 'allele_flip']
     writer = csv.writer(ofile, **CSV_OPTS)
     writer.writerow(fieldnames)
-    for row in self.mset.markers:
-      writer.writerow([str(row[n]) for n in fieldnames])
+    view = self.mset.get_marker_view()
+    writer.writerows(it.izip(*[getattr(view, n).tolist() for n in fieldnames]))
     self.logger.info('marker definitions dumped to %s' % ofile.name)
 
   def dump_alignments(self, ofile, ref_genome):
@@ -188,23 +188,18 @@ class VCFWriter(object):
     self.mset.load_markers()
     self.mset.load_alignments(self.ref_genome)
 
-  def __initialize_marker_selector(self, d):
-    if self.marker_selector is None:
-      probs, _ = d.resolve_to_data()
-      self.marker_selector = np.arange(probs.shape[1], dtype=np.uint32)
-
   def __load_data(self, data_samples):
-    self.__initialize_marker_selector(data_samples[0])
+    if self.marker_selector is None:
+      self.marker_selector = np.arange(len(self.mset), dtype=np.uint32)
     N = len(data_samples)
     M = len(self.marker_selector)
     data = np.zeros((N, M), dtype=np.uint8)
-    labels = []
-    for i, d in enumerate(data_samples):
-      labels.append(d.label)
-      # FIXME: it would be better if we could directly tell resolve_to_data
-      # to fetch only as selected by marker_selector
-      probs, _ = d.resolve_to_data()
-      data[i, :] = project_to_discrete_genotype(probs[:, self.marker_selector])
+    labels = [d.label for d in data_samples]
+    resolved = self.mset.proxy.resolve_to_data(
+      data_samples, indices=self.marker_selector
+      )
+    for i, (probs, _) in enumerate(resolved):
+      data[i, :] = project_to_discrete_genotype(probs)
     return labels, data
 
   def __write_header(self, fobj, labels):
@@ -218,26 +213,34 @@ class VCFWriter(object):
     fobj.write('\t' + '\t'.join(labels))
     fobj.write('\n')
 
-  def __write_snp(self, fobj, m, dat):
+  def __write_snp(self, fobj, chrom, pos, label, mask, strand, allele, dat):
     allele_patterns = np.array(['0/0', '1/1', '0/1', './.'])
-    _, alleles, _ = split_mask(m.mask)
-    if m.on_reference_strand:
-      ref_allele = alleles[m.allele_on_reference == 'B']
-      alt_allele = alleles[m.allele_on_reference == 'A']
+    _, alleles, _ = split_mask(mask)
+    if strand:
+      ref_allele = alleles[allele == 'B']
+      alt_allele = alleles[allele == 'A']
     else:
-      ref_allele = rev_compl(alleles[m.allele_on_reference == 'B'])
-      alt_allele = rev_compl(alleles[m.allele_on_reference == 'A'])
-    fobj.write('%s\t%s' % m.position)
-    fobj.write('\t%s\t%s\t%s' % (m.label, ref_allele, alt_allele))
+      ref_allele = rev_compl(alleles[allele == 'B'])
+      alt_allele = rev_compl(alleles[allele == 'A'])
+    fobj.write('%s\t%s' % (chrom, pos))
+    fobj.write('\t%s\t%s\t%s' % (label, ref_allele, alt_allele))
     fobj.write('\t.\tPASS\tGT')
     fobj.write('\t' + '\t'.join(allele_patterns[dat]))
     fobj.write('\n')
 
   def write(self, file_object, data_samples):
+    """
+    Write one line per selected marker, skipping markers that are
+    not uniquely aligned on the reference genome.
+    """
     labels, data = self.__load_data(data_samples)
     self.__write_header(file_object, labels)
-    for i, _ in enumerate(labels):
-      self.__write_snp(file_object, self.mset[i], data[i, :])
+    view = self.mset.get_marker_view(self.marker_selector)
+    columns = [c.tolist() for c in (view.chrom, view.pos, view.label,
+                                    view.mask, view.strand, view.allele)]
+    for j in np.nonzero(view.aligned)[0]:
+      args = [c[j] for c in columns] + [data[:, j]]
+      self.__write_snp(file_object, *args)
 
 
 class PedWriter(object):
@@ -300,16 +303,15 @@ class PedWriter(object):
       if x < 23:
         return x
       return { 23 : 'X', 24 : 'Y', 25 : 'XY', 26 : 'MT'}[x]
-    def dump_markers(fo, marker_indx):
-      for i in marker_indx:
-        m = self.mset[i]
-        chrom, pos = m.position
-        fo.write('%s\t%s\t%s\t%s\n' % (chrom, m.label, 0, pos))
+    def dump_markers(fo, view):
+      for chrom, label, pos in it.izip(view.chrom.tolist(),
+                                       view.label.tolist(),
+                                       view.pos.tolist()):
+        fo.write('%s\t%s\t%s\t%s\n' % (chrom, label, 0, pos))
     with open(self.base_path + '.map', 'w') as fo:
       fo.write('# map based on mset %s aligned on %s\n' %
                (self.mset.id, self.ref_genome))
-      s = self.selected_markers or xrange(len(self.mset))
-      dump_markers(fo, s)
+      dump_markers(fo, self.mset.get_marker_view(self.selected_markers))
 
   def write_family(self, family_label, family_members,
                    data_sample_by_id=None, phenotype_by_id=None):
@@ -335,12 +337,18 @@ class PedWriter(object):
     if not phenotype_by_id:
       phenotype_by_id = {None: 0}
     allele_patterns = {0: 'A A', 1: 'B B', 2: 'A B', 3: '0 0'}
-    def dump_genotype(fo, data_sample):
-      if data_sample is None:
-        probs = self.null_probs
-      else:
-        probs, _ = data_sample.resolve_to_data()
-      if self.selected_markers:
+    family_members = list(family_members)
+    probs_by_id = {}
+    if data_sample_by_id:
+      ids = [i.id for i in family_members
+             if data_sample_by_id.get(i.id) is not None]
+      data_samples = [data_sample_by_id[k] for k in ids]
+      if data_samples:
+        resolved = self.mset.proxy.resolve_to_data(data_samples)
+        probs_by_id = dict((k, probs) for k, (probs, _) in zip(ids, resolved))
+    def dump_genotype(fo, individual_id):
+      probs = probs_by_id.get(individual_id, self.null_probs)
+      if self.selected_markers is not None:
         probs = probs[:, self.selected_markers]
       fo.write('\t'.join([allele_patterns[x]
                           for x in project_to_discrete_genotype(probs)]))
@@ -356,7 +364,7 @@ class PedWriter(object):
       self.ped_file.write('%s\t%s\t%s\t%s\t%s\t%s\t' %
                           (family_label, i.id, fat_id, mot_id, gender, pheno))
       if data_sample_by_id:
-        dump_genotype(self.ped_file, data_sample_by_id.get(i.id))
+        dump_genotype(self.ped_file, i.id)
 
   def close(self):
     if self.ped_file:
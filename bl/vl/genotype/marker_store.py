@@ -0,0 +1,218 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+"""
+Marker-major genotype store
+===========================
+
+GDO tables are sample-major: each row holds all the markers of a
+single sample, so per-marker statistics over a cohort must scan every
+sample's full vector. A :class:`MarkerMajorStore` holds the same data
+transposed, in a chunked HDF5 file (one per marker set) with one
+``n_markers x n_samples`` array for each of the AA probabilities, BB
+probabilities and confidence values. A block of markers for all
+samples can then be read with a single contiguous read.
+
+Samples are appended in GDO table row order, so the store can be
+kept in sync incrementally. Appending a few samples at a time is
+expensive, though: each append touches, and recompresses, every chunk
+along the marker axis. Writers should append in multiples of
+:attr:`MarkerMajorStore.chunk_samples` whenever possible, and hold
+:func:`lock` on the store path while it is open for appending. A store
+that missed an update is flagged with :func:`mark_stale` until it is
+synced again. Requires PyTables.
+"""
+
+import os, fcntl
+from contextlib import contextmanager
+
+import numpy as np
+
+try:
+  import tables
+except ImportError:
+  tables = None
+
+
+VID_SIZE = 34
+CHUNK_MARKERS = 1024
+CHUNK_SAMPLES = 64
+DATASETS = ('probs_A', 'probs_B', 'confidence')
+
+
+def _method(obj, new_name, old_name):
+  # PyTables 3 renamed most camelCase methods
+  return getattr(obj, new_name, None) or getattr(obj, old_name)
+
+
+def _check_tables():
+  if tables is None:
+    raise ImportError('the marker-major store requires PyTables')
+
+
+@contextmanager
+def lock(path):
+  """
+  Hold an exclusive lock on the store at path, blocking until other
+  writers (in this or other processes) release it.
+
+  The lock is taken on a ``path + '.lock'`` sidecar file, which is
+  left in place on release: removing it would let a writer that is
+  waiting on the old file and one that creates a new file both hold
+  the lock. Leftover lock files are expected and harmless.
+  """
+  d = os.path.dirname(path)
+  if d and not os.path.isdir(d):
+    os.makedirs(d)
+  with open(path + '.lock', 'a') as f:
+    fcntl.flock(f, fcntl.LOCK_EX)
+    try:
+      yield
+    finally:
+      fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def mark_stale(path):
+  """
+  Flag the store at path as out of date wrt its GDO table.
+  """
+  open(path + '.stale', 'w').close()
+
+
+def clear_stale(path):
+  if os.path.exists(path + '.stale'):
+    os.remove(path + '.stale')
+
+
+def is_stale(path):
+  return os.path.exists(path + '.stale')
+
+
+class MarkerMajorStore(object):
+  """
+  A marker-major genotype store, opened in the given mode ('r' or
+  'a'). Use :meth:`create` to make a new one.
+  """
+  def __init__(self, path, mode='r'):
+    _check_tables()
+    self.path = path
+    self.h5 = _method(tables, 'open_file', 'openFile')(path, mode)
+    root = self.h5.root
+    self.datasets = [getattr(root, name) for name in DATASETS]
+    self.vid = root.vid
+    self.row_index = root.row_index
+
+  @classmethod
+  def create(cls, path, n_markers, chunk_markers=CHUNK_MARKERS,
+             chunk_samples=CHUNK_SAMPLES):
+    """
+    Create an empty store for ``n_markers`` markers and open it for
+    appending.
+    """
+    _check_tables()
+    h5 = _method(tables, 'open_file', 'openFile')(path, 'w')
+    try:
+      create_earray = _method(h5, 'create_earray', 'createEArray')
+      filters = tables.Filters(complevel=1, complib='zlib', shuffle=True)
+      for name in DATASETS:
+        create_earray(h5.root, name, tables.Float32Atom(), (n_markers, 0),
+                      filters=filters,
+                      chunkshape=(min(chunk_markers, max(1, n_markers)),
+                                  chunk_samples))
+      create_earray(h5.root, 'vid', tables.StringAtom(VID_SIZE), (0,))
+      create_earray(h5.root, 'row_index', tables.Int64Atom(), (0,))
+    finally:
+      h5.close()
+    return cls(path, 'a')
+
+  @property
+  def n_markers(self):
+    return self.datasets[0].shape[0]
+
+  @property
+  def n_samples(self):
+    return self.datasets[0].shape[1]
+
+  @property
+  def chunk_samples(self):
+    return self.datasets[0].chunkshape[1]
+
+  def append(self, vids, row_indices, probs, confidence):
+    """
+    Append samples, given as n_samples x 2 x n_markers ``probs`` and
+    n_samples x n_markers ``confidence`` arrays (i.e., as returned by
+    ``get_gdos``).
+    """
+    probs = np.asarray(probs, dtype=np.float32)
+    confidence = np.asarray(confidence, dtype=np.float32)
+    n = len(vids)
+    if probs.shape != (n, 2, self.n_markers) or \
+       confidence.shape != (n, self.n_markers):
+      raise ValueError('bad array shapes for %d samples x %d markers' %
+                       (n, self.n_markers))
+    self.datasets[0].append(probs[:, 0, :].T)
+    self.datasets[1].append(probs[:, 1, :].T)
+    self.datasets[2].append(confidence.T)
+    self.vid.append(np.asarray(vids, dtype='|S%d' % VID_SIZE))
+    self.row_index.append(np.asarray(row_indices, dtype=np.int64))
+    self.h5.flush()
+
+  def truncate(self, n_samples):
+    """
+    Drop all samples after the first ``n_samples``, e.g., to recover
+    from an interrupted append.
+    """
+    if n_samples >= self.n_samples:
+      return
+    for a in self.datasets:
+      a.truncate(n_samples)
+    self.vid.truncate(n_samples)
+    self.row_index.truncate(n_samples)
+    self.h5.flush()
+
+  def read(self, start=0, stop=None):
+    """
+    Read markers ``start`` to ``stop`` for all samples. Return the
+    2 x n_markers x n_samples 'probs' and the n_markers x n_samples
+    'confidence' arrays.
+    """
+    stop = self.n_markers if stop is None else stop
+    pa, pb, c = [a[start:stop] for a in self.datasets]
+    return {'probs': np.array([pa, pb]), 'confidence': c}
+
+  def read_sample(self, j):
+    """
+    Read all markers of the j-th sample: return its 2 x n_markers
+    probs and n_markers confidence arrays. This reads across all
+    chunks, so it is only meant for spot checks.
+    """
+    pa, pb, c = [a[:, j] for a in self.datasets]
+    return np.array([pa, pb]), c
+
+  def iter_blocks(self, block_size=CHUNK_MARKERS):
+    """
+    Iterate over (start, stop, data) tuples, where data is the result
+    of ``read(start, stop)``, in blocks of ``block_size`` markers.
+    """
+    for start in xrange(0, self.n_markers, block_size):
+      stop = min(self.n_markers, start + block_size)
+      yield start, stop, self.read(start, stop)
+
+  def counts(self, start=0, stop=None):
+    """
+    Return the (n_samples, counts) tuple expected by the ``counts``
+    argument of :func:`bl.vl.genotype.algo.maf` and
+    :func:`~bl.vl.genotype.algo.hwe`, for markers ``start`` to
+    ``stop``.
+    """
+    probs = self.read(start, stop)['probs']
+    return self.n_samples, np.cast[np.int32](probs.sum(axis=2))
+
+  def close(self):
+    self.h5.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
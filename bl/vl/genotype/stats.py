@@ -0,0 +1,199 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+"""
+Chunked marker statistics
+=========================
+
+The functions in :mod:`~bl.vl.genotype.algo` work on a whole
+genotype data set at once and compute HWE p-values one marker at a
+time. This module computes the same statistics (MAF and HWE exact
+test) block by block: marker blocks are described by their
+homozygote counts, in the ``(n_samples, counts)`` format returned by
+:func:`~bl.vl.genotype.algo.count_homozygotes`, and are processed by
+a pool of worker processes. Only counts travel between processes,
+and only a bounded number of blocks is in flight at any time.
+
+HWE p-values are computed with :func:`hwe_exact`, which evaluates
+each exact distribution once per distinct minor allele count rather
+than once per marker.
+
+.. code-block:: python
+
+  from bl.vl.genotype import stats
+
+  with kb.get_marker_store(mset, sync=True) as store:
+    maf, hwe = stats.compute_stats(stats.store_count_blocks(store))
+"""
+
+import multiprocessing as mp
+from collections import deque
+
+import numpy as np
+
+import bl.vl.genotype.algo as algo
+
+
+BLOCK_SIZE = 16384
+MEMO_MAX_VALUES = 2**22
+
+_memo = {}
+_memo_size = [0]
+
+
+def _hwe_distribution(n_a, N):
+  # same distribution as algo.hwe_probabilites, returned together
+  # with its sorted values and their cumulative sums
+  key = (n_a, N)
+  if key in _memo:
+    return _memo[key]
+  n_b = 2*N - n_a
+  N_ab = np.arange(n_a & 0x01, n_a, 2, dtype=np.float64)
+  log_fact = np.log((n_a - N_ab) * (n_b - N_ab) / ((N_ab + 2.0) * (N_ab + 1.0)))
+  weight = np.cumsum(log_fact)
+  prob = np.exp(weight - weight.max())
+  prob /= prob.sum()
+  sorted_prob = np.sort(prob)
+  d = (prob, sorted_prob, np.cumsum(sorted_prob))
+  if _memo_size[0] + len(prob) <= MEMO_MAX_VALUES:
+    _memo[key] = d
+    _memo_size[0] += len(prob)
+  return d
+
+
+def hwe_exact(n_a, n_ab, N):
+  """
+  Vectorized version of :func:`~bl.vl.genotype.algo.hwe_scalar`:
+  return the HWE exact test p-values for markers with minor allele
+  counts n_a and heterozygote counts n_ab, out of N samples.
+  """
+  n_a = np.asarray(n_a, dtype=np.int64)
+  n_ab = np.asarray(n_ab, dtype=np.int64)
+  n_a = np.where(n_a <= N, n_a, 2*N - n_a)
+  p_values = np.empty(len(n_a), dtype=np.float32)
+  monomorphic = n_a == 0
+  p_values[monomorphic] = 1.0
+  all_het = ~monomorphic & (n_ab == n_a)
+  p_values[all_het] = 0.0
+  regular = ~monomorphic & (0 <= n_ab) & (n_ab < n_a) & \
+            ((n_a - n_ab) % 2 == 0)
+  for i in np.nonzero(~(monomorphic | all_het | regular))[0]:
+    p_values[i] = algo.hwe_scalar(n_a[i], n_ab[i], N)
+  idx = np.nonzero(regular)[0]
+  idx = idx[np.argsort(n_a[idx], kind='mergesort')]
+  values, starts = np.unique(n_a[idx], return_index=True)
+  bounds = np.append(starts, len(idx))
+  for v, i, j in zip(values, bounds[:-1], bounds[1:]):
+    sel = idx[i:j]
+    prob, sorted_prob, cum_prob = _hwe_distribution(int(v), N)
+    p = prob[(n_ab[sel] - (v & 0x01)) // 2]
+    p_values[sel] = cum_prob[np.searchsorted(sorted_prob, p, side='right') - 1]
+  return p_values
+
+
+def block_stats(N, counts):
+  """
+  Return the MAF and HWE p-values, as computed by
+  :func:`~bl.vl.genotype.algo.maf` and
+  :func:`~bl.vl.genotype.algo.hwe`, of a marker block with the given
+  (N, counts) homozygote counts.
+  """
+  N_AB = N - counts.sum(axis=0)
+  maf = (2*counts + N_AB)/(2.0*N)
+  N_x = N_AB + 2*counts
+  return maf, hwe_exact(N_x.min(axis=0), N_AB, N)
+
+
+def _block_stats(args):
+  return block_stats(*args)
+
+
+def _bounded_imap(pool, func, iterable, max_pending):
+  pending = deque()
+  for x in iterable:
+    pending.append(pool.apply_async(func, (x,)))
+    if len(pending) >= max_pending:
+      yield pending.popleft().get()
+  while pending:
+    yield pending.popleft().get()
+
+
+def iter_stats(count_blocks, processes=None, max_pending=None):
+  """
+  Iterate over the (maf, hwe) results of the given stream of (N,
+  counts) marker blocks, in stream order.
+
+  Blocks are processed by a pool of ``processes`` workers (by
+  default, one per CPU); if processes is 1, they are processed in
+  the calling process. At most ``max_pending`` blocks (by default,
+  twice the number of workers) are queued at any time, so the stream
+  is consumed only as fast as results are produced.
+  """
+  processes = processes or mp.cpu_count()
+  if processes == 1:
+    for b in count_blocks:
+      yield _block_stats(b)
+    return
+  pool = mp.Pool(processes)
+  try:
+    for r in _bounded_imap(pool, _block_stats, count_blocks,
+                           max_pending or 2 * processes):
+      yield r
+  except:
+    pool.terminate()
+    raise
+  else:
+    pool.close()
+  finally:
+    pool.join()
+
+
+def compute_stats(count_blocks, processes=None, max_pending=None):
+  """
+  Compute the MAF and HWE p-values of a stream of consecutive marker
+  blocks (see :func:`iter_stats`) and merge them. Return the same
+  arrays as :func:`~bl.vl.genotype.algo.maf` and
+  :func:`~bl.vl.genotype.algo.hwe` over the whole marker set.
+  """
+  results = list(iter_stats(count_blocks, processes, max_pending))
+  if not results:
+    raise ValueError('no marker blocks')
+  return (np.hstack([r[0] for r in results]),
+          np.concatenate([r[1] for r in results]))
+
+
+def split_counts(counts, block_size=BLOCK_SIZE):
+  """
+  Split (N, counts), as returned by
+  :func:`~bl.vl.genotype.algo.count_homozygotes`, into marker blocks.
+  """
+  N, counts = counts
+  for start in xrange(0, counts.shape[1], block_size):
+    yield N, counts[:, start:start+block_size]
+
+
+def store_count_blocks(store, block_size=BLOCK_SIZE):
+  """
+  Stream the marker block counts of a
+  :class:`~bl.vl.genotype.marker_store.MarkerMajorStore`.
+  """
+  for start in xrange(0, store.n_markers, block_size):
+    yield store.counts(start, min(store.n_markers, start + block_size))
+
+
+def kb_count_blocks(kb, data_samples, n_markers, block_size=BLOCK_SIZE,
+                    batch_size=None):
+  """
+  Stream the marker block counts of data_samples, which must all
+  refer to the same marker set of n_markers markers, reading one
+  marker block at a time from the KB (see ``resolve_to_data``). This
+  is only efficient if genotype data is stored in blocks (see
+  :mod:`bl.vl.kb.drivers.omero.gdo_layout`); otherwise, prefer
+  :func:`store_count_blocks`.
+  """
+  data_samples = list(data_samples)
+  for start in xrange(0, n_markers, block_size):
+    indices = np.arange(start, min(n_markers, start + block_size))
+    data = kb.resolve_to_data(data_samples, indices=indices,
+                              batch_size=batch_size)
+    yield algo.count_homozygotes(dict(probs=p) for p, _ in data)
@@ -14,11 +14,13 @@ class Admin(object):
        kb.admin.set_group_owner('group_name', 'foouser')
     """
     c = self.kb.connect()
-    a = c.getAdminService()
-    ouser = a.lookupExperimenter(user)
-    ogroup = a.lookupGroup(group)
-    a.setGroupOwner(ogroup, ouser)
-    # self.kb.disconnect()
+    try:
+      a = c.getAdminService()
+      ouser = a.lookupExperimenter(user)
+      ogroup = a.lookupGroup(group)
+      a.setGroupOwner(ogroup, ouser)
+    finally:
+      self.kb.disconnect()
 
   def move_to_common_space(self, objs):
     """
@@ -29,5 +31,8 @@ class Admin(object):
        kb.admin.move_to_common_space(studies)
     """
     c = self.kb.connect()
-    a = c.getAdminService()
-    a.moveToCommonSpace([o.ome_obj for o in objs])
+    try:
+      a = c.getAdminService()
+      a.moveToCommonSpace([o.ome_obj for o in objs])
+    finally:
+      self.kb.disconnect()
@@ -0,0 +1,205 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+"""
+Process-wide alignment cache
+============================
+
+Analysis tools often open the same marker set, and load its
+alignments wrt the same reference genome, many times in a single
+process, possibly through different SNPMarkersSet objects or
+proxies. :class:`AlignmentCache` keeps the loaded alignment arrays in
+memory, up to a size bound, keyed by marker set VID, reference genome
+and number of rows of the ``align-*`` table. Appending alignments
+changes the row count and thus never returns stale data; writers
+should still call :meth:`AlignmentCache.invalidate` to release the
+obsolete entries right away.
+
+An optional on-disk tier (a
+:class:`~bl.vl.kb.drivers.omero.table_mirror.TableMirror`) makes
+cached alignments survive the process. Cached arrays are read-only,
+since they are shared by all their users.
+
+There is a single cache per process, whatever the number of proxies:
+:func:`configure_alignment_cache` only ever grows it, so that
+configuring a proxy never drops entries cached by another one.
+"""
+
+import os, threading
+
+from object_cache import ObjectCache
+from table_mirror import TableMirror
+from table_mirror import DEFAULT_QUOTA as DEFAULT_DISK_QUOTA
+
+
+DEFAULT_MAX_BYTES = 2**30
+
+
+def array_size(a):
+  return a.nbytes
+
+
+def _max_limit(a, b):
+  # None means no limit
+  return None if a is None or b is None else max(a, b)
+
+
+class AlignmentCache(object):
+  """
+  A two-tier alignment cache.
+
+  :param max_bytes: memory cap for the in-memory tier (None means no
+    limit)
+  :type max_bytes: int
+
+  :param disk_dir: root directory of the on-disk tier (None disables
+    it)
+  :type disk_dir: str
+
+  :param disk_quota: disk cap for the on-disk tier (None means no
+    limit)
+  :type disk_quota: int
+  """
+  def __init__(self, max_bytes=DEFAULT_MAX_BYTES, disk_dir=None,
+               disk_quota=DEFAULT_DISK_QUOTA, logger=None):
+    self.logger = logger
+    self.memory = ObjectCache(max_size=None, max_bytes=max_bytes,
+                              sizer=array_size)
+    if disk_dir:
+      self.disk = TableMirror(disk_dir, quota=disk_quota, logger=logger)
+    else:
+      self.disk = None
+    self.__keys = {}
+    self.__lock = threading.RLock()
+
+  @property
+  def max_bytes(self):
+    return self.memory.max_bytes
+
+  @property
+  def disk_dir(self):
+    return self.disk.root if self.disk else None
+
+  @property
+  def disk_quota(self):
+    return self.disk.quota if self.disk else None
+
+  def extend(self, max_bytes=DEFAULT_MAX_BYTES, disk_dir=None,
+             disk_quota=DEFAULT_DISK_QUOTA):
+    """
+    Merge the given settings into the current ones, keeping all
+    cached entries: memory and disk caps are raised to the larger
+    value, and the on-disk tier is enabled if disk_dir is set and the
+    tier is disabled. A different disk_dir for an enabled tier is
+    ignored, with a warning.
+    """
+    with self.__lock:
+      self.memory.max_bytes = _max_limit(self.memory.max_bytes, max_bytes)
+      if not disk_dir:
+        return
+      if self.disk is None:
+        self.disk = TableMirror(disk_dir, quota=disk_quota,
+                                logger=self.logger)
+        return
+      if os.path.abspath(disk_dir) != os.path.abspath(self.disk.root):
+        if self.logger:
+          self.logger.warning('alignment cache already on %s, ignoring %s' %
+                              (self.disk.root, disk_dir))
+        return
+      self.disk.quota = _max_limit(self.disk.quota, disk_quota)
+
+  # the table mirror is keyed by (table name, file id, n_rows): the
+  # row count alone versions alignment tables, so the file id is 0
+
+  def get(self, set_vid, ref_genome, n_rows):
+    """
+    Return the cached alignments of the given marker set wrt
+    ref_genome, or None if they are not available.
+    """
+    key = (set_vid, ref_genome, n_rows)
+    aligns = self.memory.get(key)
+    if aligns is None and self.disk:
+      aligns = self.disk.get(set_vid, 0, n_rows, selector=ref_genome)
+      if aligns is not None:
+        self.__put_memory(key, aligns)
+    return aligns
+
+  def put(self, set_vid, ref_genome, n_rows, aligns):
+    """
+    Cache alignments read from a table with n_rows rows and return
+    the (read-only) cached copy.
+    """
+    if not len(aligns):
+      return aligns
+    if self.disk:
+      aligns = self.disk.put(set_vid, 0, n_rows, data=aligns,
+                             selector=ref_genome)
+    else:
+      aligns.setflags(write=False)
+    self.__put_memory((set_vid, ref_genome, n_rows), aligns)
+    return aligns
+
+  def invalidate(self, set_vid):
+    """
+    Drop all cached alignments of the given marker set.
+    """
+    with self.__lock:
+      keys = self.__keys.pop(set_vid, set())
+    for key in keys:
+      self.memory.discard(key)
+    if self.disk:
+      self.disk.purge(set_vid)
+
+  def clear(self):
+    with self.__lock:
+      self.__keys.clear()
+    self.memory.clear()
+    if self.disk:
+      self.disk.clear()
+
+  def stats(self):
+    """
+    Return a dictionary with the usage counters of the 'memory' and
+    'disk' (None if disabled) tiers.
+    """
+    return {
+      'memory': self.memory.stats(),
+      'disk': self.disk.stats() if self.disk else None,
+      }
+
+  def __put_memory(self, key, aligns):
+    with self.__lock:
+      self.__keys.setdefault(key[0], set()).add(key)
+    self.memory.put(key, aligns)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_alignment_cache():
+  """
+  Return the process-wide alignment cache.
+  """
+  global _cache
+  with _cache_lock:
+    if _cache is None:
+      _cache = AlignmentCache()
+    return _cache
+
+
+def configure_alignment_cache(max_bytes=DEFAULT_MAX_BYTES, disk_dir=None,
+                              disk_quota=DEFAULT_DISK_QUOTA, logger=None):
+  """
+  Set up the process-wide alignment cache and return it. If the
+  cache already exists, the given settings are merged into its
+  current ones (see :meth:`AlignmentCache.extend`) and its contents
+  are kept.
+  """
+  global _cache
+  with _cache_lock:
+    if _cache is None:
+      _cache = AlignmentCache(max_bytes, disk_dir, disk_quota, logger)
+    else:
+      _cache.extend(max_bytes, disk_dir, disk_quota)
+    return _cache
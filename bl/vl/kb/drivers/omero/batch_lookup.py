@@ -0,0 +1,155 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+"""
+Batch lookup of KB objects by field value
+=========================================
+
+Resolves large lists of values (e.g., VIDs or labels) to KB objects
+with ``... where o.<field> in (:values)`` queries. Value lists are
+bound as query parameters, split in chunks sized against the server
+parameter and message limits and dispatched concurrently, one thread
+per free pooled session.
+"""
+
+import time, threading, Queue
+
+import Ice
+
+
+# PostgreSQL rejects statements with more than 32767 bind parameters
+MAX_QUERY_PARAMETERS = 30000
+# only use this fraction of the message size for a single reply
+MESSAGE_SIZE_USAGE = 0.25
+# rough size of a serialized KB object in a query reply
+RESULT_SIZE_ESTIMATE = 2048
+MIN_CHUNK_SIZE = 16
+
+
+class BatchLookup(object):
+  """
+  Map values of ``klass.field_name`` to the KB objects that hold them.
+
+  :param n_workers: number of concurrent queries; defaults to the
+    number of sessions of the kb session pool that are not bound to
+    the calling thread
+  :type n_workers: int
+  """
+  def __init__(self, kb, klass, field_name, n_workers=None):
+    self.kb = kb
+    self.klass = klass
+    self.field_name = field_name
+    self.n_workers = n_workers
+    self.query = 'from %s o where o.%s in (:values)' % (
+      klass.get_ome_table(), field_name
+      )
+    self.logger = kb.logger
+
+  def get_n_workers(self):
+    if self.n_workers:
+      return self.n_workers
+    # a session the caller still holds is not available to workers
+    pool = self.kb.session_pool
+    return max(1, pool.size - (pool.current() is not None))
+
+  def chunk_size(self):
+    """
+    Return the number of values that go in a single query. Replies
+    are much larger than the values, so this only depends on the
+    estimated size of a result and on the Ice message size limit;
+    chunks whose reply is too large anyway are split on the fly.
+    """
+    budget = MESSAGE_SIZE_USAGE * 1024 * self.kb.get_message_size_max()
+    size = int(budget / RESULT_SIZE_ESTIMATE)
+    return max(MIN_CHUNK_SIZE, min(MAX_QUERY_PARAMETERS, size))
+
+  def __run_query(self, chunk):
+    return self.kb.find_all_by_query(self.query, {'values': list(chunk)})
+
+  def __resolve_chunk(self, chunk):
+    """
+    Run the query for a chunk, splitting it in halves if the reply
+    does not fit in an Ice message.
+    """
+    try:
+      return self.__run_query(chunk)
+    except Ice.MemoryLimitException:
+      if len(chunk) < 2:
+        raise
+      self.logger.debug('%d values exceed the message size, splitting' %
+                        len(chunk))
+      h = len(chunk) / 2
+      return self.__resolve_chunk(chunk[:h]) + self.__resolve_chunk(chunk[h:])
+
+  def __resolve_chunks(self, chunks):
+    n_workers = self.get_n_workers()
+    if n_workers < 2 or len(chunks) < 2:
+      res = []
+      for c in chunks:
+        res.extend(self.__resolve_chunk(c))
+      return res
+    tasks = Queue.Queue()
+    for c in chunks:
+      tasks.put(c)
+    results, errors = [], []
+    def worker():
+      try:
+        while not errors:
+          try:
+            c = tasks.get_nowait()
+          except Queue.Empty:
+            break
+          r = self.__resolve_chunk(c)
+          results.append(r)
+      except Exception, e:
+        errors.append(e)
+      finally:
+        self.kb.session_pool.checkin()
+    threads = [threading.Thread(target=worker)
+               for _ in xrange(min(n_workers, len(chunks)))]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    if errors:
+      raise errors[0]
+    return [o for r in results for o in r]
+
+  def resolve(self, values, batch_size=None, multi_valued=False):
+    """
+    Return a dictionary that maps each element of ``values`` held by
+    at least one object to that object or, if ``multi_valued`` is
+    True, to the list of all such objects.
+
+    If ``batch_size`` is None, chunk size is computed automatically;
+    if it is 0, all values are resolved with a single query.
+    """
+    values = list(set(values))
+    if not values:
+      return {}
+    if batch_size is None:
+      batch_size = self.chunk_size()
+    elif batch_size == 0:
+      batch_size = len(values)
+    chunks = [values[i:i+batch_size]
+              for i in xrange(0, len(values), batch_size)]
+    start = time.time()
+    objs = self.__resolve_chunks(chunks)
+    self.logger.debug('resolved %d %s values in %d chunks (%.3f s)' %
+                      (len(values), self.field_name, len(chunks),
+                       time.time() - start))
+    mapping = {}
+    if multi_valued:
+      for o in objs:
+        mapping.setdefault(getattr(o, self.field_name), []).append(o)
+    else:
+      n_ambiguous = 0
+      for o in objs:
+        k = getattr(o, self.field_name)
+        if k in mapping and mapping[k] != o:
+          n_ambiguous += 1
+        mapping[k] = o
+      if n_ambiguous:
+        self.logger.warning('%d %s values map to more than one object' %
+                            (n_ambiguous, self.field_name))
+    return mapping
@@ -1,7 +1,6 @@
 # BEGIN_COPYRIGHT
 # END_COPYRIGHT
 
-from bl.vl.kb import mimetypes
 import wrapper as wp
 from action import Action, OriginalFile
 from genotyping import SNPMarkersSet
@@ -49,17 +48,9 @@ class GenotypeDataSample(DataSample):
   __fields__ = [('snpMarkersSet', SNPMarkersSet, wp.REQUIRED)]
 
   def resolve_to_data(self):
-    dos = self.proxy.get_data_objects(self)
-    if not dos:
-      raise ValueError('no connected DataObject(s)')
-    for do in dos:
-      do.reload()
-      if do.mimetype == mimetypes.GDO_TABLE:
-        set_vid, vid, index = self.proxy.parse_gdo_path(do.path)
-        mset = self.snpMarkersSet
-        assert mset.id == set_vid
-        mset.reload()
-        res = self.proxy.get_gdo(mset, vid, index)
-        return res['probs'], res['confidence']
-    else:
-      raise ValueError('DataObject is not a %s' % mimetypes.GDO_TABLE)
+    """
+    Return the (probs, confidence) arrays of this sample. To resolve
+    many samples, use the proxy's resolve_to_data, which works in
+    bulk.
+    """
+    return self.proxy.resolve_to_data([self]).next()
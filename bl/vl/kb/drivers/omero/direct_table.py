@@ -0,0 +1,232 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+"""
+Direct HDF5 table reads
+=======================
+
+OMERO tables are HDF5 files stored under ``${omero.data.dir}/Files``
+and named after their OriginalFile id. On nodes that mount the OMERO
+data directory, reading them with PyTables is much faster than going
+through ``Table.read`` (see ``utils/table_performance.py``).
+
+:class:`DirectTableReader` opens such files read-only, if PyTables is
+installed and the file is locally readable and consistent with what
+the server reports; otherwise it returns None and the caller falls
+back to the Ice path. Selectors are PyTables conditions, so they are
+evaluated locally with the same semantics as ``getWhereList``.
+
+Files are kept open, up to ``MAX_OPEN_FILES`` of them, so that
+repeated reads of the same table do not reopen it. As with
+:class:`~.table_cache.TableCache`, handles evicted while in use are
+closed when the last user releases them. A read-only handle does not
+see rows written after it was opened: a cached handle whose row count
+differs from the one reported by the server is replaced.
+"""
+
+import os, threading
+from collections import OrderedDict
+
+import numpy as np
+
+try:
+  import tables
+except ImportError:
+  tables = None
+
+from table_query import group_selectors, merge_selectors
+
+
+MAX_OPEN_FILES = 32
+
+def _method(obj, new_name, old_name):
+  # PyTables 3 renamed most camelCase methods
+  return getattr(obj, new_name, None) or getattr(obj, old_name)
+
+
+class DirectTable(object):
+  """
+  A read-only, locally opened OMERO table.
+  """
+  def __init__(self, path):
+    self.path = path
+    self.h5 = _method(tables, 'open_file', 'openFile')(path, 'r')
+    try:
+      self.table = self.h5.root.OME.Measurements
+    except tables.NoSuchNodeError:
+      self.h5.close()
+      raise
+    # PyTables file handles are not thread-safe
+    self.__read_lock = threading.Lock()
+    self.__lock = threading.Lock()
+    self.__users = 0
+    self.__retired = False
+
+  def getNumberOfRows(self):
+    return self.table.nrows
+
+  def row_ids(self, selector):
+    """
+    Return the sorted array of ids of the rows matching the selector.
+    """
+    get_where_list = _method(self.table, 'get_where_list', 'getWhereList')
+    ids = [get_where_list(merge_selectors(terms))
+           for terms in group_selectors(selector)]
+    return np.unique(np.concatenate(ids).astype(np.int64))
+
+  def read(self, record_type, start=0, stop=None, row_numbers=None,
+           selector=None, ranges=None, columnar=False):
+    """
+    Read the columns described by ``record_type`` either for rows
+    ``start`` to ``stop``, for the given ``row_numbers``, for the
+    rows in a list of (start, stop) ``ranges`` or for the rows
+    matching ``selector``. Results have the same layout as those of
+    the corresponding :class:`~.proxy_core.ProxyCore` methods.
+    """
+    with self.__read_lock:
+      if selector:
+        row_numbers = self.row_ids(selector)
+      elif ranges is not None:
+        row_numbers = np.concatenate(
+          [np.arange(i, j, dtype=np.int64) for i, j in ranges] or
+          [np.zeros(0, dtype=np.int64)]
+          )
+      if row_numbers is not None:
+        if len(row_numbers):
+          raw = _method(self.table, 'read_coordinates', 'readCoordinates')(
+            np.asarray(row_numbers, dtype=np.int64)
+            )
+        else:
+          raw = np.zeros(0, dtype=self.table.dtype)
+      else:
+        raw = self.table.read(start, stop)
+    if columnar:
+      return dict((name, raw[name].astype(t)) for name, t in record_type)
+    if len(raw) == 0:
+      return []
+    data = np.zeros(len(raw), dtype=record_type)
+    for name, _ in record_type:
+      data[name] = raw[name]
+    return data
+
+  def acquire(self):
+    """
+    Mark the table as in use, so that it is not closed on eviction.
+    """
+    with self.__lock:
+      self.__users += 1
+
+  def release(self):
+    with self.__lock:
+      self.__users -= 1
+      close = self.__retired and self.__users == 0
+    if close:
+      self.close()
+
+  def retire(self):
+    """
+    Close the table now if it is not in use, else on last release.
+    """
+    with self.__lock:
+      self.__retired = True
+      close = self.__users == 0
+    if close:
+      self.close()
+
+  def close(self):
+    with self.__read_lock:
+      if self.h5.isopen:
+        self.h5.close()
+
+
+class DirectTableReader(object):
+  """
+  Opens OMERO tables stored in ``data_dir`` (the OMERO data directory
+  as seen by this node), keeping up to ``max_open`` of them open.
+  """
+  def __init__(self, data_dir, logger=None, max_open=MAX_OPEN_FILES):
+    self.data_dir = data_dir
+    self.logger = logger
+    self.max_open = max_open
+    self.__lock = threading.Lock()
+    self.__tables = OrderedDict()
+    self.n_opened = 0
+    self.n_reused = 0
+    self.n_fallbacks = 0
+
+  @staticmethod
+  def available():
+    return tables is not None
+
+  def path(self, ofile_id):
+    return os.path.join(self.data_dir, 'Files', '%d' % ofile_id)
+
+  def open(self, ofile_id, n_rows=None):
+    """
+    Return a :class:`DirectTable` for the given OriginalFile id, or
+    None if it cannot be read locally or, when ``n_rows`` is given,
+    if its number of rows differs from the expected one (i.e., the
+    server has not flushed its last writes yet). The table is
+    returned acquired: call its ``release`` method when done.
+    """
+    if tables is None:
+      return None
+    with self.__lock:
+      dt = self.__tables.pop(ofile_id, None)
+      if dt is not None and (n_rows is None or
+                             dt.getNumberOfRows() == n_rows):
+        self.__tables[ofile_id] = dt
+        dt.acquire()
+        self.n_reused += 1
+        return dt
+    if dt is not None:
+      dt.retire()
+    path = self.path(ofile_id)
+    if not os.access(path, os.R_OK):
+      self.n_fallbacks += 1
+      return None
+    try:
+      dt = DirectTable(path)
+    except Exception, e:
+      if self.logger:
+        self.logger.debug('cannot open %s directly: %s' % (path, e))
+      self.n_fallbacks += 1
+      return None
+    if n_rows is not None and dt.getNumberOfRows() != n_rows:
+      dt.close()
+      self.n_fallbacks += 1
+      return None
+    dt.acquire()
+    evicted = []
+    with self.__lock:
+      old = self.__tables.pop(ofile_id, None)
+      if old is not None:
+        evicted.append(old)
+      self.__tables[ofile_id] = dt
+      while len(self.__tables) > self.max_open:
+        evicted.append(self.__tables.popitem(last=False)[1])
+      self.n_opened += 1
+    for e in evicted:
+      e.retire()
+    return dt
+
+  def invalidate(self, ofile_id):
+    """
+    Close the cached handle, if any, for the given OriginalFile id
+    (e.g., because the table has been deleted).
+    """
+    with self.__lock:
+      dt = self.__tables.pop(ofile_id, None)
+    if dt is not None:
+      dt.retire()
+
+  def clear(self):
+    with self.__lock:
+      cached = self.__tables.values()
+      self.__tables.clear()
+    for dt in cached:
+      dt.retire()
+
+  def stats(self):
+    return {'opened': self.n_opened, 'reused': self.n_reused,
+            'fallbacks': self.n_fallbacks, 'open': len(self.__tables)}
@@ -0,0 +1,220 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+"""
+GDO table layouts
+=================
+
+A GDO table holds one row per genotyped sample. In the original
+(monolithic) layout, all the 2 x N probabilities of a sample are
+stored in a single ``probs`` column and the N confidence values in a
+single ``confidence`` column, so any read moves all of them.
+
+In the blocked layout, markers are split into blocks of
+``block_size`` consecutive markers, each stored in its own
+``probs_<k>`` (AA probabilities followed by BB probabilities) and
+``confidence_<k>`` columns. Since OMERO tables can read any subset of
+columns, a read restricted to a few markers only fetches the blocks
+that contain them.
+
+Values can be stored either as float32 (the default) or, with the
+compact ``q8`` encoding, quantized to 8 bits (``round(255 * x)``, after
+clipping to [0, 1]) and packed eight to a ``long_array`` element,
+which cuts the size of each genotype from 12 to 3 bytes. Since the
+packed arrays are padded to a multiple of eight values, the encoding
+and the actual number of values are recorded in the description of
+each column.
+
+The layout is recorded in the column names and descriptions, so
+:meth:`GDOLayout.from_headers` can recover it from any existing table.
+"""
+
+import numpy as np
+
+
+PROBS_COL = 'probs'
+CONFIDENCE_COL = 'confidence'
+DEFAULT_BLOCK_SIZE = 16384
+
+FLOAT32 = 'float32'
+Q8 = 'q8'
+ENCODINGS = (FLOAT32, Q8)
+Q8_SCALE = 255.0
+Q8_DESC_PREFIX = 'gdo:q8:'
+
+
+def q8_encode(a):
+  """
+  Quantize the values of the n x m array a and pack them into an n x
+  ceil(m / 8) int64 array.
+  """
+  a = np.atleast_2d(a)
+  n, m = a.shape
+  packed = np.zeros((n, 8 * ((m + 7) // 8)), dtype=np.uint8)
+  packed[:, :m] = np.rint(np.clip(a, 0.0, 1.0) * Q8_SCALE)
+  return packed.view('<i8')
+
+
+def q8_decode(a, m):
+  """
+  Inverse of :func:`q8_encode`: return the first m decoded values of
+  each row of a as a float32 array.
+  """
+  a = np.ascontiguousarray(np.atleast_2d(a), dtype='<i8')
+  q = a.view(np.uint8)[:, :m]
+  return q.astype(np.float32) / np.float32(Q8_SCALE)
+
+
+class GDOLayout(object):
+  """
+  Describes how the genotype arrays of a sample with ``n_markers``
+  markers map to GDO table columns. If ``block_size`` is None, the
+  layout is monolithic. ``encoding`` is one of ``ENCODINGS`` (None
+  means float32).
+  """
+  def __init__(self, n_markers, block_size=None, encoding=None):
+    encoding = encoding or FLOAT32
+    if encoding not in ENCODINGS:
+      raise ValueError('unknown gdo encoding: %r' % (encoding,))
+    self.n_markers = n_markers
+    self.block_size = block_size
+    self.encoding = encoding
+    if block_size:
+      self.blocks = [(i, min(n_markers, i + block_size))
+                     for i in xrange(0, n_markers, block_size)]
+    else:
+      self.blocks = [(0, n_markers)]
+
+  @property
+  def blocked(self):
+    return bool(self.block_size)
+
+  @property
+  def quantized(self):
+    return self.encoding == Q8
+
+  @classmethod
+  def from_headers(cls, record_type, descriptions=None):
+    """
+    Recover the layout from a GDO table record type, as returned by
+    ``get_table_headers``. For quantized tables, the column
+    descriptions (as returned by ``get_table_descriptions``) are
+    also needed.
+    """
+    dtypes = dict((name, np.dtype(t)) for name, t in record_type)
+    def size(name):
+      if dtypes[name].base != np.int64:
+        return dtypes[name].shape[0], FLOAT32
+      desc = (descriptions or {}).get(name, '')
+      if not desc.startswith(Q8_DESC_PREFIX):
+        raise ValueError('no q8 encoding description for column %s' % name)
+      return int(desc[len(Q8_DESC_PREFIX):]), Q8
+    if CONFIDENCE_COL in dtypes:
+      n_markers, encoding = size(CONFIDENCE_COL)
+      return cls(n_markers, encoding=encoding)
+    n_markers, k = 0, 0
+    while '%s_%d' % (CONFIDENCE_COL, k) in dtypes:
+      n, encoding = size('%s_%d' % (CONFIDENCE_COL, k))
+      n_markers += n
+      k += 1
+    if k == 0:
+      raise ValueError('not a GDO table record type: %r' % (record_type,))
+    return cls(n_markers, size('%s_0' % CONFIDENCE_COL)[0], encoding)
+
+  def probs_col(self, k):
+    return '%s_%d' % (PROBS_COL, k) if self.blocked else PROBS_COL
+
+  def confidence_col(self, k):
+    return '%s_%d' % (CONFIDENCE_COL, k) if self.blocked else CONFIDENCE_COL
+
+  def columns(self):
+    """
+    Return the column definitions for the genotype data, in the
+    format expected by ``create_table``.
+    """
+    cols = []
+    for k, (start, stop) in enumerate(self.blocks):
+      n = stop - start
+      if self.quantized:
+        cols.append(('long_array', self.probs_col(k),
+                     '%s%d' % (Q8_DESC_PREFIX, 2*n), (2*n + 7) // 8, None))
+        cols.append(('long_array', self.confidence_col(k),
+                     '%s%d' % (Q8_DESC_PREFIX, n), (n + 7) // 8, None))
+      else:
+        cols.append(('float_array', self.probs_col(k),
+                     'np.zeros((2,N), dtype=np.float32)', 2*n, None))
+        cols.append(('float_array', self.confidence_col(k),
+                     'np.zeros((N,), dtype=np.float32)', n, None))
+    return cols
+
+  def pack(self, probs, confidence):
+    """
+    Return a dictionary that maps column names to the values of a
+    single sample's probs (2 x n_markers) and confidence arrays.
+    """
+    probs = np.asarray(probs).reshape(2, self.n_markers)
+    confidence = np.asarray(confidence).reshape(self.n_markers)
+    row = {}
+    for k, (start, stop) in enumerate(self.blocks):
+      p, c = probs[:, start:stop].ravel(), confidence[start:stop]
+      if self.quantized:
+        p, c = q8_encode(p)[0], q8_encode(c)[0]
+      row[self.probs_col(k)] = p
+      row[self.confidence_col(k)] = c
+    return row
+
+  def select(self, indices=None):
+    """
+    Return the block numbers needed to read the markers selected by
+    indices (anything that can index a numpy array), together with
+    the positions of those markers within the concatenation of the
+    selected blocks (None if the blocks must be returned whole).
+    """
+    if indices is None:
+      return range(len(self.blocks)), None
+    if not self.blocked:
+      return [0], indices
+    idx = np.arange(self.n_markers)[indices]
+    block_of = idx // self.block_size
+    blocks = np.unique(block_of)
+    offsets = np.zeros(len(self.blocks), dtype=np.int64)
+    lengths = np.array([self.blocks[b][1] - self.blocks[b][0]
+                        for b in blocks], dtype=np.int64)
+    offsets[blocks] = np.cumsum(lengths) - lengths
+    return blocks.tolist(), offsets[block_of] + idx % self.block_size
+
+  def col_names(self, blocks):
+    names = []
+    for k in blocks:
+      names.extend([self.probs_col(k), self.confidence_col(k)])
+    return names
+
+  def unpack(self, data, blocks, positions=None):
+    """
+    Extract the n x 2 x m probs and n x m confidence arrays from
+    data, a record array or a dictionary of column arrays holding
+    the given blocks for n samples.
+    """
+    n = len(data['vid'])
+    if not blocks:
+      return (np.zeros((n, 2, 0), dtype=np.float32),
+              np.zeros((n, 0), dtype=np.float32))
+    probs, confidence = [], []
+    for k in blocks:
+      start, stop = self.blocks[k]
+      p, c = data[self.probs_col(k)], data[self.confidence_col(k)]
+      if self.quantized:
+        m = stop - start
+        p = q8_decode(p.reshape(n, (2*m + 7) // 8), 2*m)
+        c = q8_decode(c.reshape(n, (m + 7) // 8), m)
+      probs.append(p.reshape(n, 2, stop - start))
+      confidence.append(c.reshape(n, stop - start))
+    if len(blocks) == 1:
+      probs, confidence = probs[0], confidence[0]
+    else:
+      probs = np.concatenate(probs, axis=2)
+      confidence = np.concatenate(confidence, axis=1)
+    if positions is not None:
+      probs = probs[:, :, positions]
+      confidence = confidence[:, positions]
+    return probs, confidence
@@ -0,0 +1,113 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+"""
+Bulk GDO ingestion
+==================
+
+:meth:`Proxy.add_gdo_data_object` writes one GDO row and saves one
+DataObject per call. :class:`GDOWriter` buffers rows, per marker set,
+into table appends of about ``TARGET_BATCH_BYTES`` (or of a single
+row, for chips whose rows are larger than that), and saves the
+corresponding DataObjects ``batch_size`` at a time with a single
+``save_array`` call. Appends are further split by
+:meth:`GenotypingAdapter.add_gdos` to fit the Ice message size limit.
+"""
+
+import time
+
+import numpy as np
+
+from bl.vl.kb import mimetypes
+
+from table_iterator import TARGET_BATCH_BYTES
+from utils import resolve_action_id, gdo_checksum
+
+
+OBJECT_BATCH_SIZE = 1000
+
+
+class GDOWriter(object):
+  """
+  Accumulates (action, sample, probs, confs) records and writes them
+  in bulk. Call :meth:`close` to flush pending records: it returns
+  the list of all created DataObjects (in input order only if all
+  samples share the same marker set).
+  """
+  def __init__(self, kb, batch_size=OBJECT_BATCH_SIZE,
+               target_bytes=TARGET_BATCH_BYTES):
+    self.kb = kb
+    self.batch_size = batch_size
+    self.target_bytes = target_bytes
+    self.logger = kb.logger
+    self.__rows = {}
+    self.__ready = []
+    self.__objects = []
+    self.__msets = {}
+    self.__avids = {}
+    self.n_gdos = 0
+    self.n_appends = 0
+    self.n_saves = 0
+    self.start = time.time()
+
+  def __resolve_action_id(self, action):
+    if not isinstance(action, self.kb.Action):
+      return action
+    k = id(action)
+    if k not in self.__avids:
+      self.__avids[k] = (action, resolve_action_id(self.kb, action))
+    return self.__avids[k][1]
+
+  def add(self, action, sample, probs, confs):
+    if not isinstance(sample, self.kb.GenotypeDataSample):
+      raise ValueError('sample should be an instance of GenotypeDataSample')
+    mset = sample.snpMarkersSet
+    avid = self.__resolve_action_id(action)
+    # buffered rows must not alias the caller's arrays: np.array
+    # always makes one (float32) copy
+    probs = np.array(probs, dtype=np.float32)
+    confs = np.array(confs, dtype=np.float32)
+    sha1, size = gdo_checksum(probs, confs)
+    info = {'sample': sample, 'sha1': sha1, 'size': size}
+    self.__msets[mset.id] = mset
+    rows = self.__rows.setdefault(mset.id, [])
+    rows.append((probs, confs, avid, info))
+    if len(rows) * size >= self.target_bytes:
+      self.__flush_rows(mset.id)
+
+  def __flush_rows(self, set_vid):
+    rows = self.__rows.pop(set_vid, [])
+    if not rows:
+      return
+    mset = self.__msets[set_vid]
+    ids = self.kb.gadpt.add_gdos(set_vid, [r[:3] for r in rows])
+    self.n_appends += 1
+    for (vid, row_index), r in zip(ids, rows):
+      conf = r[3]
+      conf['path'] = self.kb.make_gdo_path(mset, vid, row_index)
+      conf['mimetype'] = mimetypes.GDO_TABLE
+      self.__ready.append(conf)
+    if len(self.__ready) >= self.batch_size:
+      self.__flush_objects()
+
+  def __flush_objects(self):
+    while self.__ready:
+      confs = self.__ready[:self.batch_size]
+      del self.__ready[:self.batch_size]
+      objs = [self.kb.factory.create(self.kb.DataObject, c) for c in confs]
+      self.__objects.extend(self.kb.save_array(objs))
+      self.n_saves += 1
+      self.n_gdos += len(objs)
+      elapsed = time.time() - self.start
+      self.logger.info('%d gdos written in %.1f s (%.1f gdos/s)' %
+                       (self.n_gdos, elapsed, self.n_gdos / max(elapsed, 1e-6)))
+
+  def close(self):
+    for set_vid in self.__rows.keys():
+      self.__flush_rows(set_vid)
+    for set_vid in self.__msets:
+      self.kb.gadpt.flush_marker_store(set_vid)
+    self.__flush_objects()
+    self.logger.debug('%d gdos: %d table appends, %d saves' %
+                      (self.n_gdos, self.n_appends, self.n_saves))
+    return self.__objects
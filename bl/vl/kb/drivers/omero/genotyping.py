@@ -24,21 +24,31 @@ if the Illumina strand detection algorithm yields a result (see
 :func:`~bl.vl.utils.snp.convert_to_top`).
 """
 
+import os, tempfile, shutil, threading
 import itertools as it
 from operator import itemgetter
-from collections import Counter
+from contextlib import contextmanager
 
 import numpy as np
 
 import bl.vl.utils as vlu
 import bl.vl.utils.snp as vlu_snp
 import bl.vl.utils.np_ext as np_ext
+from bl.vl.utils.extsort import external_sort, DEFAULT_MEMORY_BUDGET
+import bl.vl.genotype.marker_store as mstore
+from bl.vl.genotype.marker_store import MarkerMajorStore
 
 from utils import assign_vid, make_unique_key
+from table_iterator import auto_batch_size
+from gdo_layout import GDOLayout
+from marker_view import Marker, MarkerView
+from interval_index import IntervalIndex
+from alignment_cache import get_alignment_cache
 import wrapper as wp
 
 
 BATCH_SIZE = 5000
+ALIGN_CHUNK_SIZE = 100000
 VID_SIZE = vlu.DEFAULT_VID_LEN
 
 # mset tables
@@ -48,24 +58,6 @@ MSET_TABLE = 'mset'
 MS_TABLES = frozenset([ALIGN_TABLE, GDO_TABLE, MSET_TABLE])
 
 
-class Marker(object):
-  """
-  Wraps the contents of a marker definition and associate information.
-  """
-  def __init__(self, vid, index=None, position=(0,0), flip=None, **kwargs):
-    self.id = vid
-    self.index = index
-    self.position = position
-    self.flip = flip
-    for k, v in kwargs.iteritems():
-      setattr(self, k, v)
-
-  # this is here to make app.importer.map_vid happy
-  @classmethod
-  def get_ome_table(klass):
-    return klass.__name__
-
-
 class SNPMarkersSet(wp.OmeroWrapper):
 
   OME_TABLE = 'SNPMarkersSet'
@@ -114,15 +106,8 @@ class SNPMarkersSet(wp.OmeroWrapper):
       for i in indices:
         assert (beg_chr, beg_pos) <= ms.markers[i].position < (end_chr, end_pos)
     """
-    if not mset.has_aligns():
-      raise ValueError('aligns vector has not been loaded')
     beg, end = gc_range
-    global_pos = mset.aligns['global_pos']
-    idx = mset.markers['index']
-    low_gpos = SNPMarkersSet.compute_global_position(beg)
-    high_gpos = SNPMarkersSet.compute_global_position(end)
-    sel = (low_gpos <= global_pos) &  (global_pos <= high_gpos)
-    return idx[sel]
+    return mset.get_interval_index().select([beg], [end], closed_interval)
 
   @staticmethod
   def intersect(mset1, mset2):
@@ -141,13 +126,41 @@ class SNPMarkersSet(wp.OmeroWrapper):
         assert ms1[i].position == ms2[i].position
 
     """
-    if not (mset1.has_aligns() and mset2.has_aligns()):
-      raise ValueError('both mset should be aligned')
-    if mset1.ref_genome != mset2.ref_genome:
+    return tuple(SNPMarkersSet.intersect_all([mset1, mset2]))
+
+  @staticmethod
+  def __position_keys(msets):
+    if not all(mset.has_aligns() for mset in msets):
+      raise ValueError('all msets should be aligned')
+    if len(set(mset.ref_genome for mset in msets)) > 1:
       raise ValueError('msets should be aligned to the same ref_genome')
-    gpos1 = mset1.aligns['global_pos']
-    gpos2 = mset2.aligns['global_pos']
-    return np_ext.index_intersect(gpos1, gpos2)
+    return [mset.get_position_keys() for mset in msets]
+
+  @staticmethod
+  def intersect_all(msets):
+    """
+    Multi-way version of :meth:`intersect`: return a list with, for
+    each mset, the indices of the markers that align to a position
+    shared by all msets, ordered by position. Sorted positions are
+    cached by each mset, so repeated intersections only cost a
+    binary search per marker.
+
+    .. code-block:: python
+
+      for ms in msets:
+        ms.load_alignments('hg19')
+      indices = kb.SNPMarkersSet.intersect_all(msets)
+    """
+    return np_ext.multi_index_intersect(SNPMarkersSet.__position_keys(msets))
+
+  @staticmethod
+  def union_all(msets):
+    """
+    Return the sorted array of the global positions of the markers of
+    any of the msets, and a list with, for each mset, the indices of
+    the markers at these positions (-1 where the mset has no marker).
+    """
+    return np_ext.multi_index_union(SNPMarkersSet.__position_keys(msets))
 
   def __preprocess_conf__(self, conf):
     if not 'snpMarkersSetUK' in conf:
@@ -189,24 +202,18 @@ class SNPMarkersSet(wp.OmeroWrapper):
     return True
 
   def __getitem__(self, i):
+    return self.get_marker_view().marker(i)
+
+  def get_marker_view(self, indices=None):
+    """
+    Return a columnar :class:`~.marker_view.MarkerView` of the
+    markers selected by indices (all markers if None), including
+    alignment info if it has been loaded.
+    """
     if not self.has_markers():
       raise ValueError('markers vector has not been reloaded')
-    mdef = self.markers[i]
-    kwargs = {
-      'vid': mdef['vid'],
-      'label': mdef['label'],
-      'mask': mdef['mask'],
-      'index': mdef['index'],
-      'flip': mdef['allele_flip'],
-      'position': (0, 0),
-      }
-    if self.has_aligns():
-      mali = self.aligns[i]
-      if mali['copies'] == 1:
-        kwargs.update({'position' : (mali['chromosome'], mali['pos']),
-                       'on_reference_strand' : mali['strand'],
-                       'allele_on_reference' : mali['allele']})
-    return Marker(**kwargs)
+    aligns = self.aligns if self.has_aligns() else None
+    return MarkerView(self.markers, aligns, indices)
 
   def load_markers(self, batch_size=1000):
     """
@@ -222,21 +229,61 @@ class SNPMarkersSet(wp.OmeroWrapper):
     """
     if not self.has_markers():
       raise ValueError('markers vector has not been reloaded')
-    selector = "(ref_genome == '%s')" % ref_genome
-    aligns = self.proxy.gadpt.read_snp_markers_set_alignments(
-      self.id, selector=selector, batch_size=batch_size
+    aligns = self.proxy.gadpt.get_snp_markers_set_alignments(
+      self.id, ref_genome, batch_size=batch_size
       )
     assert len(aligns) >= len(self)
     if len(aligns) > len(self):
       aligns = aligns[:len(self)]
     self.bare_setattr('aligns', aligns)
     self.bare_setattr('ref_genome', ref_genome)
+    for name in 'interval_indices', 'position_keys':
+      if hasattr(self, name):
+        self.bare_getattr(name).pop(ref_genome, None)
+
+  def get_interval_index(self):
+    """
+    Return the :class:`~.interval_index.IntervalIndex` of the markers
+    wrt the currently loaded reference genome. Indices are built on
+    first use and cached per reference genome.
+
+    .. code-block:: python
+
+      ms.load_alignments('hg19')
+      index = ms.get_interval_index()
+      starts, stops = index.query([(10, 190000), (11, 5000)],
+                                  [(10, 300000), (11, 9000)])
+      for start, stop in zip(starts, stops):
+        marker_indices = index.markers(start, stop)
+    """
+    if not self.has_aligns():
+      raise ValueError('aligns vector has not been loaded')
+    if not hasattr(self, 'interval_indices'):
+      self.bare_setattr('interval_indices', {})
+    indices = self.bare_getattr('interval_indices')
+    if self.ref_genome not in indices:
+      indices[self.ref_genome] = IntervalIndex(
+        self.aligns['global_pos'], self.markers['index'], self.MAX_GENOME_LEN
+        )
+    return indices[self.ref_genome]
+
+  def get_position_keys(self):
+    """
+    Return the global positions of the markers wrt the currently
+    loaded reference genome as a :class:`bl.vl.utils.np_ext.SortedKeys`
+    object, cached per reference genome. See :meth:`intersect_all`.
+    """
+    if not self.has_aligns():
+      raise ValueError('aligns vector has not been loaded')
+    if not hasattr(self, 'position_keys'):
+      self.bare_setattr('position_keys', {})
+    keys = self.bare_getattr('position_keys')
+    if self.ref_genome not in keys:
+      keys[self.ref_genome] = np_ext.SortedKeys(self.aligns['global_pos'])
+    return keys[self.ref_genome]
 
   def get_markers_iterator(self, indices = None):
-    if not self.has_markers():
-      raise ValueError('markers vector has not been reloaded')
-    for i in xrange(len(self)):
-      yield self[i]
+    return self.get_marker_view(indices).iter_markers()
 
   def __update_constraints__(self):
     uk = make_unique_key(self.maker, self.model, self.release)
@@ -271,20 +318,19 @@ class GenotypingAdapter(object):
      VID_SIZE, None),
     ]
   @staticmethod
-  def SNP_GDO_REPO_COLS(N):
+  def SNP_GDO_REPO_COLS(N, block_size=None, encoding=None):
     cols = [
       ('string', 'vid', 'gdo VID', VID_SIZE, None),
       ('string', 'op_vid', 'Last operation that modified this row',
        VID_SIZE, None),
-      ('float_array', 'probs', 'np.zeros((2,N), dtype=np.float32)',
-       2*N, None),
-      ('float_array', 'confidence', 'np.zeros((N,), dtype=np.float32)',
-       N, None),
       ]
-    return cols
+    return cols + GDOLayout(N, block_size, encoding).columns()
 
-  def __init__(self, kb):
+  def __init__(self, kb, marker_store_dir=None):
     self.kb = kb
+    self.marker_store_dir = marker_store_dir
+    self.__pending = {}
+    self.__held = threading.local()
 
   @classmethod
   def snp_markers_set_table_name(klass, table_name_root, set_vid):
@@ -313,15 +359,22 @@ class GenotypingAdapter(object):
     return self.kb.add_table_rows_from_stream(table_name, i_s, batch_size)
 
   def _read_snp_markers_set_table(self, table_name_root, set_vid, selector,
-                                  batch_size):
+                                  batch_size, mirror=True):
     table_name = self.snp_markers_set_table_name(table_name_root, set_vid)
-    return self.kb.get_table_rows(table_name, selector, batch_size=batch_size)
+    # marker set and alignment tables are never updated in place
+    return self.kb.get_table_rows(table_name, selector, batch_size=batch_size,
+                                  mirror=mirror)
 
-  def create_snp_markers_set_tables(self, set_vid, N):
+  def create_snp_markers_set_tables(self, set_vid, N, gdo_block_size=None,
+                                    gdo_encoding=None):
     """
-    Create all tables needed by a SNPMarkersSet.
+    Create all tables needed by a SNPMarkersSet. If gdo_block_size is
+    set, genotype data is stored in blocks of gdo_block_size markers;
+    gdo_encoding selects how genotype values are stored (see
+    :mod:`.gdo_layout`).
     """
-    snp_gdo_repo_cols = self.SNP_GDO_REPO_COLS(N)
+    snp_gdo_repo_cols = self.SNP_GDO_REPO_COLS(N, gdo_block_size,
+                                               gdo_encoding)
     for table, cols in ((MSET_TABLE, self.SNP_SET_COLS),
                         (ALIGN_TABLE, self.SNP_ALIGNMENT_COLS),
                         (GDO_TABLE, snp_gdo_repo_cols)):
@@ -333,11 +386,27 @@ class GenotypingAdapter(object):
     """
     for table in MS_TABLES:
       self._delete_snp_markers_set_table(table, set_vid)
+    get_alignment_cache().invalidate(set_vid)
+    if self.marker_store_dir:
+      self.__pending.pop(set_vid, None)
+      path = self.marker_store_path(set_vid)
+      with self.__writer_lock(set_vid):
+        if os.path.exists(path):
+          os.remove(path)
+        mstore.clear_stale(path)
 
   def define_snp_markers_set(self, set_vid, stream, op_vid,
-                             batch_size=BATCH_SIZE):
+                             batch_size=BATCH_SIZE,
+                             memory_budget=DEFAULT_MEMORY_BUDGET,
+                             tmp_dir=None, progress=None):
     """
     Fill in a SNPMarkersSet definition table.
+
+    Records are sorted by index with an external merge sort that
+    keeps about memory_budget bytes of records in memory, spilling
+    sorted runs to tmp_dir, and are streamed to the table batch_size
+    at a time. progress, if set, is called as progress(phase, count)
+    (see :func:`bl.vl.utils.extsort.external_sort`).
     """
     N = [0]
     def mod_stream():
@@ -347,7 +416,9 @@ class GenotypingAdapter(object):
         N[0] += 1
         yield x
     i_s = mod_stream()
-    by_idx_s = iter(sorted(i_s, key=itemgetter('index')))  # uses memory
+    by_idx_s = external_sort(i_s, itemgetter('index'),
+                             memory_budget=memory_budget, tmp_dir=tmp_dir,
+                             progress=progress)
     self._fill_snp_markers_set_table(MSET_TABLE, set_vid, by_idx_s,
                                      batch_size=batch_size)
     return N[0]
@@ -359,100 +430,591 @@ class GenotypingAdapter(object):
   def add_snp_markers_set_alignments(self, mset, stream, action,
                                      batch_size=BATCH_SIZE):
     """
-    Add alignment info to a SNPMarkersSet table.
+    Add alignment info to a SNPMarkersSet table, from a stream of
+    dictionaries with 'marker_vid', 'ref_genome', 'chromosome',
+    'pos', 'strand', 'allele' and 'copies' keys. See
+    :meth:`load_snp_markers_set_alignments`.
+    """
+    stream = iter(stream)
+    try:
+      first = stream.next()
+    except StopIteration:
+      raise ValueError('no alignment records')
+    fields = ('marker_vid', 'chromosome', 'pos', 'strand', 'allele', 'copies')
+    tuples = (tuple(x[k] for k in fields) for x in it.chain([first], stream))
+    return self.load_snp_markers_set_alignments(
+      mset, first['ref_genome'], tuples, action, batch_size=batch_size
+      )
 
-    In the case of multiple hits, only the first copy encountered is
-    added in the same order as it is found in the input stream;
-    additional copies are temporarily stored and appended at the end.
-    In addition, the global position field for all copies will be set
-    to a unique negative value. Duplicate global positions (different
-    SNPs align to the same position) will also be replaced by unique
-    negative values. This is done to avoid ambiguities in marker set
+  def load_snp_markers_set_alignments(self, mset, ref_genome, stream, action,
+                                      batch_size=BATCH_SIZE,
+                                      chunk_size=ALIGN_CHUNK_SIZE):
+    """
+    Add alignment info wrt ref_genome to a SNPMarkersSet table, from
+    a stream of (marker_vid, chromosome, pos, strand, allele, copies)
+    tuples.
+
+    The stream is consumed chunk_size records at a time: marker vids
+    are mapped to marker indices with a binary search over the sorted
+    vids of the set, and records for vids not in the set are
+    ignored. The first record found for each marker is written in
+    marker order; any further copies of multiply aligned markers are
+    appended at the end. The global position of markers with more
+    (or less) than one copy is set to a unique negative value, and so
+    is that of markers that share their global position with other
+    markers. This is done to avoid ambiguities in marker set
     intersection.
+
+    Return a dictionary that summarizes the number of markers that
+    are uniquely aligned, unaligned (zero copies), multiply aligned
+    and with a duplicate position, together with the number of extra
+    copies and of ignored records.
     """
+    stream = iter(stream)
     tname = self.snp_markers_set_table_name(MSET_TABLE, mset.id)
-    vids = [t[0] for t in
-            self.kb.get_table_rows(tname, None, col_names=['vid'])]
-    vids_set = frozenset(vids)
-    global_pos = SNPMarkersSet.compute_global_position
-    dummy_pos_generator = it.count(-1 - mset.omero_id * mset.MAX_LEN, -1)
-    def add_vids(stream):
-      multiple_hits = {}
-      for x in stream:
-        k = x['marker_vid']
-        if k not in vids_set:
-          continue
-        x['op_vid'] = action.id
-        if x['copies'] == 1:
-          x['global_pos'] = global_pos((x['chromosome'], x['pos']))
-        else:
-          x['global_pos'] = dummy_pos_generator.next()
-        if x['copies'] > 1:
-          if k in multiple_hits:
-            multiple_hits[k].append(x)
-            continue
-          else:
-            multiple_hits[k] = []
-        yield x
-      for v in multiple_hits.itervalues():
-        for x in v:
-          yield x
-    i_s = add_vids(stream)
-    by_vid = {}
-    gpos_count = Counter()
-    for i in xrange(len(vids)):
-      r = i_s.next()
-      by_vid[r['marker_vid']] = r
-      gpos_count[r['global_pos']] += 1
-    records = []
-    for v in vids:
-      try:
-        r = by_vid[v]
-      except KeyError as e:
-        raise ValueError("no alignment info for %s" % e.args[0])
-      if gpos_count[r['global_pos']] > 1:
-        r['global_pos'] = dummy_pos_generator.next()
-      records.append(r)
-    i_s = it.chain(iter(records), i_s)
-    return self._fill_snp_markers_set_table(ALIGN_TABLE, mset.id, i_s,
-                                            batch_size=batch_size)
+    vids = self.kb.get_table_rows(tname, None, col_names=['vid'],
+                                  columnar=True)['vid']
+    n = len(vids)
+    order = np.argsort(vids, kind='mergesort')
+    sorted_vids = vids[order]
+    chromosome = np.zeros(n, dtype=np.int64)
+    pos = np.zeros(n, dtype=np.int64)
+    strand = np.zeros(n, dtype=np.bool)
+    allele = np.zeros(n, dtype='|S1')
+    copies = np.zeros(n, dtype=np.int64)
+    seen = np.zeros(n, dtype=np.bool)
+    extras = []
+    n_ignored = 0
+    while True:
+      chunk = list(it.islice(stream, chunk_size))
+      if not chunk:
+        break
+      cols = zip(*chunk)
+      # keep the natural width: casting to vids.dtype would truncate
+      # over-long vids, which could then match a stored vid by prefix
+      c_vids = np.array(cols[0], dtype=str)
+      idx = np.minimum(np.searchsorted(sorted_vids, c_vids), max(n - 1, 0))
+      found = sorted_vids[idx] == c_vids if n else np.zeros(len(chunk), bool)
+      n_ignored += len(chunk) - found.sum()
+      m = order[idx[found]]
+      c = (np.array(cols[1], dtype=np.int64)[found],
+           np.array(cols[2], dtype=np.int64)[found],
+           np.array(cols[3], dtype=np.bool)[found],
+           np.array(cols[4], dtype='|S1')[found],
+           np.array(cols[5], dtype=np.int64)[found])
+      # the first record of a marker is the first one in the first
+      # chunk where the marker appears
+      primary = np.zeros(len(m), dtype=np.bool)
+      primary[np.unique(m, return_index=True)[1]] = True
+      primary &= ~seen[m]
+      pm = m[primary]
+      for a, v in zip((chromosome, pos, strand, allele, copies), c):
+        a[pm] = v[primary]
+      seen[pm] = True
+      if not primary.all():
+        extras.append((c_vids[found][~primary],) +
+                      tuple(v[~primary] for v in c))
+    if not seen.all():
+      missing = vids[~seen]
+      raise ValueError('no alignment info for %d markers: %s%s' % (
+        len(missing), ', '.join(missing[:5]), ', ...' if len(missing) > 5
+        else ''))
+    global_pos = chromosome * SNPMarkersSet.MAX_GENOME_LEN + pos
+    unique = copies == 1
+    u_pos = np.sort(global_pos[unique])
+    dup_values = u_pos[1:][u_pos[1:] == u_pos[:-1]]
+    dup = np.zeros(n, dtype=np.bool)
+    dup[unique] = np.in1d(global_pos[unique], dup_values)
+    needs_dummy = ~unique | dup
+    dummy_start = -1 - mset.omero_id * mset.MAX_LEN
+    n_dummies = needs_dummy.sum()
+    global_pos[needs_dummy] = dummy_start - np.arange(n_dummies)
+    dummy_start -= n_dummies
+    table_name = self.snp_markers_set_table_name(ALIGN_TABLE, mset.id)
+    def write(columns):
+      k = len(columns[0])
+      rows = dict(zip(('marker_vid', 'chromosome', 'pos', 'strand', 'allele',
+                       'copies', 'global_pos'), columns))
+      for start in xrange(0, k, batch_size):
+        batch = dict((name, v[start:start+batch_size])
+                     for name, v in rows.iteritems())
+        size = len(batch['marker_vid'])
+        batch['ref_genome'] = [ref_genome] * size
+        batch['op_vid'] = [action.id] * size
+        self.kb.add_table_rows(table_name, batch, batch_size=size)
+    write((vids, chromosome, pos, strand, allele, copies, global_pos))
+    n_extra = 0
+    for e in extras:
+      k = len(e[0])
+      write(e + (dummy_start - np.arange(k),))
+      dummy_start -= k
+      n_extra += k
+    get_alignment_cache().invalidate(mset.id)
+    report = {
+      'markers': n,
+      'aligned': int((unique & ~dup).sum()),
+      'unaligned': int((copies == 0).sum()),
+      'multi_aligned': int((copies > 1).sum()),
+      'duplicate_position': int(dup.sum()),
+      'extra_copies': n_extra,
+      'ignored_records': int(n_ignored),
+      }
+    self.kb.logger.info('alignments of %s wrt %s: %s' % (
+      mset.id, ref_genome, ', '.join('%d %s' % (report[k], k.replace('_', ' '))
+                                     for k in sorted(report))
+      ))
+    return report
 
   def read_snp_markers_set_alignments(self, set_vid, selector=None,
                                       batch_size=BATCH_SIZE):
     return self._read_snp_markers_set_table(ALIGN_TABLE, set_vid, selector,
                                             batch_size=batch_size)
 
+  def get_snp_markers_set_alignments(self, set_vid, ref_genome,
+                                     batch_size=BATCH_SIZE):
+    """
+    Return the alignments of a marker set wrt ref_genome through the
+    process-wide alignment cache (see :mod:`.alignment_cache`). Only
+    the row count of the alignment table is read on a cache hit.
+    """
+    table_name = self.snp_markers_set_table_name(ALIGN_TABLE, set_vid)
+    n_rows = self.kb.get_table_n_rows(table_name)
+    cache = get_alignment_cache()
+    aligns = cache.get(set_vid, ref_genome, n_rows)
+    if aligns is None:
+      # the cache has its own disk tier: do not mirror the table too
+      selector = "(ref_genome == '%s')" % ref_genome
+      aligns = self._read_snp_markers_set_table(
+        ALIGN_TABLE, set_vid, selector, batch_size, mirror=False
+        )
+      aligns = cache.put(set_vid, ref_genome, n_rows, aligns)
+    return aligns
+
   def add_gdo(self, set_vid, probs, confidence, op_vid):
-    probs.shape = probs.size
+    return self.add_gdos(set_vid, [(probs, confidence, op_vid)])[0]
+
+  def add_gdos(self, set_vid, records):
+    """
+    Append a list of (probs, confidence, op_vid) records to the GDO
+    table of the given marker set, with as few table writes as the
+    Ice message size limit allows. Return the list of the
+    corresponding (vid, row_index) pairs.
+
+    If a marker store is configured, rows are copied to it in whole
+    chunk columns: up to ``chunk_samples`` of them may be held back
+    until a later call or :meth:`flush_marker_store`.
+    """
+    if not records:
+      return []
     table_name = self.snp_markers_set_table_name(GDO_TABLE, set_vid)
-    row = {'op_vid': op_vid, 'probs': probs, 'confidence': confidence}
-    assign_vid(row)
-    row_indices = self.kb.add_table_row(table_name, row)
-    assert len(row_indices) == 1
-    probs.shape = (2, probs.size/2)
-    return row['vid'], row_indices[0]
-
-  def _unwrap_gdo(self, row, indices):
-    r = {'vid': row['vid'], 'op_vid': row['op_vid']}
-    p = row['probs']
-    p.shape = (2, p.size/2)
-    r['probs'] = p[:, indices] if indices is not None else p
-    c = row['confidence']
-    r['confidence'] = c[indices] if indices is not None else c
-    return r
+    vids = [assign_vid({})['vid'] for _ in records]
+    with self.__writer_lock(set_vid):
+      layout = self.gdo_layout(set_vid)
+      columns = self.__pack_gdo_columns(layout, vids,
+                                        [r[2] for r in records],
+                                        [r[0] for r in records],
+                                        [r[1] for r in records])
+      row_bytes = sum(np.asarray(v).nbytes for v in columns.itervalues())
+      row_indices = self.kb.add_table_rows(
+        table_name, columns,
+        batch_size=self.kb.get_write_batch_size(row_bytes / len(records))
+        )
+      assert len(row_indices) == len(records)
+      if self.marker_store_dir:
+        self.__buffer_for_marker_store(set_vid, layout, row_indices,
+                                       columns)
+    return zip(vids, row_indices)
+
+  def __pack_gdo_columns(self, layout, vids, op_vids, probs, confidence):
+    packed = [layout.pack(p, c) for p, c in zip(probs, confidence)]
+    columns = {'vid': vids, 'op_vid': op_vids}
+    for name in packed[0]:
+      columns[name] = np.vstack([p[name] for p in packed])
+    return columns
+
+  def marker_store_path(self, set_vid):
+    if not self.marker_store_dir:
+      raise ValueError('marker store directory not configured')
+    return os.path.join(self.marker_store_dir, 'mstore-%s.h5' % set_vid)
+
+  @contextmanager
+  def __writer_lock(self, set_vid):
+    # serializes writers to the GDO table and marker store of a marker
+    # set. Without a marker store directory, the lock lives in the
+    # temporary directory and only covers writers on this host. It is
+    # reentrant within a thread: flock blocks even on a second open of
+    # the same file by the same process
+    if self.marker_store_dir:
+      path = self.marker_store_path(set_vid)
+    else:
+      path = os.path.join(tempfile.gettempdir(), 'bl-vl-gdo-%s' % set_vid)
+    held = self.__held.__dict__.setdefault('paths', set())
+    if path in held:
+      yield
+      return
+    with mstore.lock(path):
+      held.add(path)
+      try:
+        yield
+      finally:
+        held.discard(path)
+
+  def __buffer_for_marker_store(self, set_vid, layout, row_indices,
+                                columns):
+    # each append to the marker store recompresses all chunks along
+    # the marker axis: keep rows (as packed columns, i.e., as a read
+    # would return them) until whole chunk columns can be written
+    pending = self.__pending.setdefault(set_vid, [])
+    pending.append((layout, np.asarray(row_indices, dtype=np.int64),
+                    columns))
+    if sum(len(p[1]) for p in pending) >= mstore.CHUNK_SAMPLES:
+      self.__append_to_marker_store(set_vid)
+
+  def flush_marker_store(self, set_vid):
+    """
+    Write to the marker-major store of the given marker set the GDOs
+    that :meth:`add_gdos` is holding back to fill whole store chunks.
+    GDOs that are never flushed (e.g., because the process exits
+    first) are picked up by the next :meth:`sync_marker_store`.
+    """
+    if self.marker_store_dir:
+      self.__append_to_marker_store(set_vid, flush=True)
+
+  def __append_to_marker_store(self, set_vid, flush=False):
+    pending = self.__pending.pop(set_vid, None)
+    if not pending:
+      return
+    layout = pending[0][0]
+    row_indices = np.concatenate([p[1] for p in pending])
+    columns = dict((k, np.concatenate([np.asarray(p[2][k]) for p in pending]))
+                   for k in pending[0][2])
+    # the marker store is secondary: never fail a GDO write because of
+    # it, but flag it as stale so that it is not read until synced
+    path = self.marker_store_path(set_vid)
+    try:
+      with self.__writer_lock(set_vid):
+        if mstore.is_stale(path):
+          return
+        try:
+          store = self.__open_marker_store_for_update(set_vid)
+          try:
+            start = store.n_samples
+            if (row_indices != np.arange(start,
+                                         start + len(row_indices))).any():
+              # someone else wrote to the table: catch up from there
+              self.__sync_marker_store(set_vid, store, aligned=not flush)
+              return
+            n = len(row_indices)
+            if not flush:
+              n -= (start + n) % store.chunk_samples
+            if n > 0:
+              head = dict((k, v[:n]) for k, v in columns.iteritems())
+              probs, confidence = layout.unpack(head,
+                                                range(len(layout.blocks)))
+              store.append(head['vid'], row_indices[:n], probs, confidence)
+            if n < len(row_indices):
+              self.__pending[set_vid] = [
+                (layout, row_indices[n:],
+                 dict((k, v[n:]) for k, v in columns.iteritems()))
+                ]
+          finally:
+            store.close()
+        except Exception:
+          mstore.mark_stale(path)
+          raise
+    except Exception, e:
+      self.kb.logger.warning('could not update marker store for %s, '
+                             'marked as stale: %s' % (set_vid, e))
+
+  def __open_marker_store_for_update(self, set_vid):
+    path = self.marker_store_path(set_vid)
+    if os.path.exists(path):
+      return MarkerMajorStore(path, 'a')
+    if not os.path.isdir(self.marker_store_dir):
+      os.makedirs(self.marker_store_dir)
+    return MarkerMajorStore.create(path, self.gdo_layout(set_vid).n_markers)
+
+  def __sync_marker_store(self, set_vid, store, batch_size=None,
+                          aligned=False):
+    # appends end on multiples of batch_size, itself a multiple of the
+    # store's chunk width; if aligned is True, a trailing partial chunk
+    # is left for a later sync
+    table_name = self.snp_markers_set_table_name(GDO_TABLE, set_vid)
+    n_rows = self.kb.get_table_n_rows(table_name)
+    if store.n_samples > n_rows:
+      raise ValueError('marker store for %s has more samples than its gdo '
+                       'table: rebuild it' % set_vid)
+    w = store.chunk_samples
+    if not batch_size:
+      batch_size = w * max(1, (1 << 24) // (12 * max(1, store.n_markers) * w))
+    if aligned:
+      n_rows -= n_rows % w
+    n_added = 0
+    start = store.n_samples
+    while start < n_rows:
+      stop = min(n_rows, (start // batch_size + 1) * batch_size)
+      gdos = self.get_gdos(set_vid, row_indices=range(start, stop))
+      store.append(gdos['vid'], gdos['row_index'], gdos['probs'],
+                   gdos['confidence'])
+      n_added += len(gdos['vid'])
+      start = stop
+    return n_added
+
+  def sync_marker_store(self, set_vid, batch_size=None):
+    """
+    Append to the marker-major store of the given marker set (see
+    :mod:`bl.vl.genotype.marker_store`) all GDOs it does not hold
+    yet, creating the store if needed. Return the number of appended
+    samples.
+    """
+    # rows held back by add_gdos are in the table: sync reads them
+    self.__pending.pop(set_vid, None)
+    path = self.marker_store_path(set_vid)
+    with self.__writer_lock(set_vid):
+      store = self.__open_marker_store_for_update(set_vid)
+      try:
+        n_added = self.__sync_marker_store(set_vid, store, batch_size)
+      finally:
+        store.close()
+      mstore.clear_stale(path)
+    return n_added
 
-  def get_gdo(self, set_vid, vid, row_index, indices=None):
+  def rebuild_marker_store(self, set_vid, batch_size=None):
+    """
+    Rebuild from scratch the marker-major store of the given marker
+    set.
+    """
+    path = self.marker_store_path(set_vid)
+    with self.__writer_lock(set_vid):
+      if os.path.exists(path):
+        os.remove(path)
+    return self.sync_marker_store(set_vid, batch_size)
+
+  def verify_marker_store(self, set_vid, n_checks=10):
+    """
+    Check the marker-major store of the given marker set against its
+    GDO table: sample count and order must match, and the genotype
+    data of n_checks randomly chosen samples must be identical.
+    Return a list of problem descriptions (empty if the store is
+    consistent).
+    """
+    path = self.marker_store_path(set_vid)
+    if not os.path.exists(path):
+      return ['no marker store for %s' % set_vid]
+    if mstore.is_stale(path):
+      return ['marker store for %s is stale: sync it' % set_vid]
     table_name = self.snp_markers_set_table_name(GDO_TABLE, set_vid)
-    rows = self.kb.get_table_rows_by_indices(table_name, [row_index])
-    assert len(rows) == 1
-    assert rows[0]['vid'] == vid
-    return self._unwrap_gdo(rows[0], indices)
+    vids = self.kb.get_table_rows(table_name, None, col_names=['vid'],
+                                  columnar=True)['vid']
+    problems = []
+    with MarkerMajorStore(path) as store:
+      if store.n_samples != len(vids):
+        problems.append('store has %d samples, gdo table has %d rows' %
+                        (store.n_samples, len(vids)))
+      n = min(store.n_samples, len(vids))
+      if (store.vid[:n] != vids[:n]).any():
+        problems.append('sample vids do not match gdo table rows')
+      if (store.row_index[:n] != np.arange(n)).any():
+        problems.append('sample row indices are not in table order')
+      if problems or n == 0:
+        return problems
+      rows = np.sort(np.random.permutation(n)[:n_checks])
+      gdos = self.get_gdos(set_vid, row_indices=rows)
+      if store.n_markers != gdos['confidence'].shape[1]:
+        return ['store has %d markers, gdo table has %d' %
+                (store.n_markers, gdos['confidence'].shape[1])]
+      for i, j in enumerate(rows):
+        probs, confidence = store.read_sample(j)
+        if (probs != gdos['probs'][i]).any() or \
+           (confidence != gdos['confidence'][i]).any():
+          problems.append('genotype data mismatch for sample %d' % j)
+    return problems
+
+  def open_marker_store(self, set_vid, sync=False):
+    """
+    Open, read-only, the marker-major store of the given marker set.
+    If sync is True, bring it up to date first. Raise a ValueError if
+    the store missed an update and has not been synced since.
+    """
+    if sync:
+      self.sync_marker_store(set_vid)
+    else:
+      self.flush_marker_store(set_vid)
+    path = self.marker_store_path(set_vid)
+    if mstore.is_stale(path):
+      raise ValueError('marker store for %s is stale: sync it' % set_vid)
+    return MarkerMajorStore(path)
+
+  def gdo_layout(self, set_vid):
+    """
+    Return the :class:`~.gdo_layout.GDOLayout` of the GDO table of
+    the given marker set.
+    """
+    table_name = self.snp_markers_set_table_name(GDO_TABLE, set_vid)
+    return GDOLayout.from_headers(self.kb.get_table_headers(table_name),
+                                  self.kb.get_table_descriptions(table_name))
 
-  def get_gdo_iterator(self, set_vid, indices=None, batch_size=100):
-    def iterator(stream):
-      for d in stream:
-        yield self._unwrap_gdo(d, indices)
+  def get_gdo(self, set_vid, vid, row_index, indices=None):
+    gdos = self.get_gdos(set_vid, row_indices=[row_index], indices=indices)
+    assert gdos['vid'][0] == vid
+    return {'vid': gdos['vid'][0], 'op_vid': gdos['op_vid'][0],
+            'probs': gdos['probs'][0], 'confidence': gdos['confidence'][0]}
+
+  def get_gdos(self, set_vid, row_indices=None, vids=None, indices=None,
+               batch_size=None):
+    """
+    Bulk version of :meth:`get_gdo`: fetch the GDOs stored at the
+    given row indices or, if row_indices is None, with the given
+    VIDs. Requested rows are coalesced into sorted contiguous ranges,
+    each read with as few calls as possible. With a blocked GDO
+    layout, only the blocks that hold the markers selected by indices
+    are read; otherwise, whole rows are read and then subset (see
+    :meth:`reencode_gdo_table` and ``tools/reencode_gdos``).
+
+    Return a dictionary with the 'vid', 'op_vid' and 'row_index'
+    arrays and the n_samples x 2 x n_markers 'probs' and n_samples x
+    n_markers 'confidence' arrays, in the requested order. If
+    indices is not None, only the selected markers are returned.
+    """
     table_name = self.snp_markers_set_table_name(GDO_TABLE, set_vid)
-    return iterator(
-      self.kb.get_table_rows_iterator(table_name, batch_size=batch_size)
+    if row_indices is None:
+      if vids is None:
+        raise ValueError('either row_indices or vids must be specified')
+      all_vids = self.kb.get_table_rows(table_name, None, col_names=['vid'],
+                                        columnar=True)['vid']
+      by_vid = dict((v, i) for i, v in enumerate(all_vids))
+      try:
+        row_indices = [by_vid[v] for v in vids]
+      except KeyError, e:
+        raise ValueError('no gdo with vid %s in %s' % (e.args[0], table_name))
+    requested = np.asarray(row_indices, dtype=np.int64)
+    rows = np.unique(requested)
+    headers = self.kb.get_table_headers(table_name)
+    layout = self.gdo_layout(set_vid)
+    blocks, positions = layout.select(indices)
+    col_names = ['vid', 'op_vid'] + layout.col_names(blocks)
+    if not batch_size:
+      batch_size = auto_batch_size([h for h in headers if h[0] in col_names])
+    data = self.kb.get_table_row_ranges(
+      table_name, np_ext.index_ranges(rows), col_names=col_names,
+      batch_size=batch_size, columnar=True
       )
+    if len(data['vid']) != rows.size:
+      raise ValueError('row indices out of range for %s' % table_name)
+    if rows.size != requested.size or (rows != requested).any():
+      pos = np.searchsorted(rows, requested)
+      data = dict((k, v[pos]) for k, v in data.iteritems())
+    probs, confidence = layout.unpack(data, blocks, positions)
+    return {'vid': data['vid'], 'op_vid': data['op_vid'],
+            'row_index': requested, 'probs': probs,
+            'confidence': confidence}
+
+  def get_gdo_iterator(self, set_vid, indices=None, batch_size=None):
+    layout = self.gdo_layout(set_vid)
+    blocks, positions = layout.select(indices)
+    def iterator(stream):
+      for batch in stream:
+        probs, confidence = layout.unpack(batch, blocks, positions)
+        for i in xrange(len(batch)):
+          yield {'vid': batch['vid'][i], 'op_vid': batch['op_vid'][i],
+                 'probs': probs[i], 'confidence': confidence[i]}
+    table_name = self.snp_markers_set_table_name(GDO_TABLE, set_vid)
+    return iterator(self.kb.get_table_rows_iterator(
+      table_name, batch_size=batch_size, yield_batches=True,
+      col_names=['vid', 'op_vid'] + layout.col_names(blocks)
+      ))
+
+  def reencode_gdo_table(self, set_vid, encoding=None, block_size=None,
+                         work_dir=None, batch_size=None, resume=False):
+    """
+    Rewrite the GDO table of the given marker set with a new
+    encoding and block size (see :mod:`.gdo_layout`). Rows keep
+    their vids, op_vids and indices, so existing GDO paths remain
+    valid.
+
+    The table is first dumped, in batches, to work_dir (a new
+    temporary directory if None, otherwise an empty one); a
+    completion marker recording the number of markers and rows is
+    written after the last batch, and the table is deleted only if
+    the dump holds all of its rows. The table is then recreated and
+    refilled from the dump. The dump is removed on success and left
+    in place otherwise: call again with resume=True and the same
+    work_dir to refill the table from it, which requires a complete
+    dump. Return the number of rows.
+
+    Writers to the table are locked out for the whole operation; on
+    resume, the table is left untouched if it has more rows than the
+    dump.
+
+    The sha1 and size fields of GDO DataObjects describe genotype
+    data as originally submitted and are not updated: after a switch
+    to a lossy encoding (e.g., q8) they no longer match the values
+    read back from the table.
+    """
+    table_name = self.snp_markers_set_table_name(GDO_TABLE, set_vid)
+    if work_dir is None:
+      if resume:
+        raise ValueError('resume requires a work_dir')
+      work_dir = tempfile.mkdtemp(prefix='gdo-%s-' % set_vid)
+    elif not os.path.isdir(work_dir):
+      os.makedirs(work_dir)
+    elif not resume and os.listdir(work_dir):
+      raise ValueError('work_dir %s is not empty' % work_dir)
+    done_fn = os.path.join(work_dir, 'dump-done.npy')
+    def batch_fns():
+      return sorted(os.path.join(work_dir, f) for f in os.listdir(work_dir)
+                    if f.endswith('.npz'))
+    # dump, delete and refill must not interleave with other writers
+    with self.__writer_lock(set_vid):
+      if not resume:
+        old_layout = self.gdo_layout(set_vid)
+        n_dumped = 0
+        for i, batch in enumerate(self.kb.get_table_rows_iterator(
+            table_name, batch_size=batch_size, yield_batches=True)):
+          probs, confidence = old_layout.unpack(
+            batch, range(len(old_layout.blocks))
+            )
+          np.savez(os.path.join(work_dir, 'batch-%06d.npz' % i),
+                   vid=batch['vid'], op_vid=batch['op_vid'], probs=probs,
+                   confidence=confidence)
+          n_dumped += len(batch['vid'])
+        n_table_rows = self.kb.get_table_n_rows(table_name)
+        if n_dumped != n_table_rows:
+          raise ValueError('dumped %d rows of %s, expected %d: table '
+                           'left untouched' % (n_dumped, table_name,
+                                               n_table_rows))
+        np.save(done_fn, np.array([old_layout.n_markers, n_dumped]))
+        self.kb.logger.info('%s dumped to %s' % (table_name, work_dir))
+      elif not os.path.exists(done_fn):
+        raise ValueError('no complete dump in %s: cannot resume' % work_dir)
+      n_markers, n_dumped = [int(x) for x in np.load(done_fn)]
+      n_found = sum(len(np.load(fn)['vid']) for fn in batch_fns())
+      if n_found != n_dumped:
+        raise ValueError('dump in %s has %d rows, expected %d' %
+                         (work_dir, n_found, n_dumped))
+      if self.kb.table_exists(table_name):
+        n_table_rows = self.kb.get_table_n_rows(table_name)
+        if n_table_rows > n_dumped:
+          raise ValueError('%s has %d rows, more than the %d dumped: table '
+                           'left untouched' % (table_name, n_table_rows,
+                                               n_dumped))
+        self.kb.delete_table(table_name)
+      self._create_snp_markers_set_table(
+        GDO_TABLE, self.SNP_GDO_REPO_COLS(n_markers, block_size, encoding),
+        set_vid
+        )
+      layout = GDOLayout(n_markers, block_size, encoding)
+      n_rows = 0
+      for fn in batch_fns():
+        batch = np.load(fn)
+        columns = self.__pack_gdo_columns(layout, batch['vid'],
+                                          batch['op_vid'], batch['probs'],
+                                          batch['confidence'])
+        row_indices = self.kb.add_table_rows(table_name, columns,
+                                             batch_size=len(batch['vid']))
+        assert row_indices[0] == n_rows
+        n_rows += len(row_indices)
+      shutil.rmtree(work_dir)
+      if self.marker_store_dir:
+        self.rebuild_marker_store(set_vid)
+    return n_rows
@@ -0,0 +1,230 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+"""
+KB operation instrumentation
+============================
+
+:class:`OperationStats` collects, for each ``service.action`` pair
+(e.g., ``getQueryService.findAllByQuery`` or ``Table.read``), the
+number of calls and failed calls, a latency histogram and the number
+of rows (or objects) and bytes transferred. Table proxies returned by
+:func:`instrument_table` record their calls automatically.
+
+The collected data is available as a dictionary through
+:meth:`OperationStats.stats` and as a text report that can be logged
+periodically or once at interpreter exit. A burst of calls with a
+very low average latency is usually the sign of an N+1 access
+pattern.
+"""
+
+import time, threading, atexit
+
+import omero
+import omero_Tables_ice
+
+
+# upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.01, 0.1, 1.0, 10.0)
+
+_COLUMN_ITEM_SIZE = (
+  (omero.grid.LongColumn, 8),
+  (omero.grid.DoubleColumn, 8),
+  (omero.grid.BoolColumn, 1),
+  (omero.grid.FloatArrayColumn, 4),
+  (omero.grid.DoubleArrayColumn, 8),
+  (omero.grid.LongArrayColumn, 8),
+  )
+
+
+def column_size(c):
+  """
+  Return the approximate size, in bytes, of a single value of table
+  column ``c``.
+  """
+  if isinstance(c, omero.grid.StringColumn):
+    return c.size
+  for klass, item_size in _COLUMN_ITEM_SIZE:
+    if isinstance(c, klass):
+      return item_size * max(1, getattr(c, 'size', 1) or 1)
+  return 0
+
+
+def data_size(d):
+  """
+  Return the number of rows and the approximate size, in bytes, of an
+  ``omero.grid.Data`` object or of a list of columns (as passed to
+  ``Table.addData``).
+  """
+  columns = getattr(d, 'columns', d)
+  if not columns or getattr(columns[0], 'values', None) is None:
+    return 0, 0
+  n_rows = len(columns[0].values)
+  return n_rows, n_rows * sum(column_size(c) for c in columns)
+
+
+def _is_data(x):
+  if isinstance(x, omero.grid.Data):
+    return True
+  return (isinstance(x, (list, tuple)) and len(x) > 0 and
+          isinstance(x[0], omero.grid.Column))
+
+
+class OperationStats(object):
+  """
+  Thread-safe per-operation counters.
+  """
+  def __init__(self):
+    self.__lock = threading.Lock()
+    self.__ops = {}
+    self.__sources = []
+    self.__reporter = None
+    self.started = time.time()
+
+  def add_source(self, name, callback):
+    """
+    Include the dictionary returned by ``callback()`` in the stats
+    under ``name`` (e.g., session pool or cache counters).
+    """
+    self.__sources.append((name, callback))
+
+  def record(self, key, elapsed, n_rows=0, n_bytes=0, error=False):
+    with self.__lock:
+      op = self.__ops.get(key)
+      if op is None:
+        op = self.__ops[key] = {
+          'calls': 0, 'errors': 0, 'time': 0.0, 'max_time': 0.0, 'rows': 0,
+          'bytes': 0, 'histogram': [0] * (len(LATENCY_BUCKETS) + 1),
+          }
+      op['calls'] += 1
+      if error:
+        op['errors'] += 1
+      op['time'] += elapsed
+      op['max_time'] = max(op['max_time'], elapsed)
+      op['rows'] += n_rows
+      op['bytes'] += n_bytes
+      i = 0
+      while i < len(LATENCY_BUCKETS) and elapsed > LATENCY_BUCKETS[i]:
+        i += 1
+      op['histogram'][i] += 1
+
+  def timed(self, key, func, *args):
+    """
+    Call ``func(*args)``, recording its latency under ``key``.
+    """
+    start, error = time.time(), True
+    try:
+      res = func(*args)
+      error = False
+      return res
+    finally:
+      self.record(key, time.time() - start, error=error)
+
+  def reset(self):
+    with self.__lock:
+      self.__ops = {}
+      self.started = time.time()
+
+  def stats(self):
+    """
+    Return a dictionary that maps operation keys to their counters.
+    Counters of registered sources are stored under their names.
+    """
+    with self.__lock:
+      stats = dict((k, dict(v, histogram=list(v['histogram'])))
+                   for k, v in self.__ops.iteritems())
+    for name, callback in self.__sources:
+      try:
+        stats[name] = callback()
+      except Exception:
+        pass
+    return stats
+
+  def report(self):
+    """
+    Return the collected stats as a list of text lines, most time
+    consuming operations first.
+    """
+    stats = self.stats()
+    ops = sorted(((k, v) for k, v in stats.iteritems() if 'calls' in v),
+                 key=lambda (k, v): v['time'], reverse=True)
+    lines = ['KB operations in the last %.1f s:' %
+             (time.time() - self.started)]
+    for k, v in ops:
+      lines.append(
+        '  %-40s %7d calls %d errors %9.3f s (avg %.1f ms, max %.1f ms) '
+        '%d rows %d bytes hist=%s' %
+        (k, v['calls'], v['errors'], v['time'], 1000 * v['time'] / v['calls'],
+         1000 * v['max_time'], v['rows'], v['bytes'],
+         '/'.join(map(str, v['histogram'])))
+        )
+    for name, _ in self.__sources:
+      if name in stats:
+        lines.append('  %s: %s' % (name, ', '.join(
+          '%s=%s' % kv for kv in sorted(stats[name].iteritems())
+          )))
+    return lines
+
+  def log_report(self, logger):
+    for l in self.report():
+      logger.info(l)
+
+  def dump_on_exit(self, logger):
+    """
+    Log the report when the interpreter exits.
+    """
+    atexit.register(self.log_report, logger)
+
+  def start_periodic_log(self, logger, interval):
+    """
+    Log the report every ``interval`` seconds from a daemon thread.
+    """
+    self.stop_periodic_log()
+    stop = threading.Event()
+    def run():
+      while not stop.wait(interval):
+        self.log_report(logger)
+    t = threading.Thread(target=run)
+    t.daemon = True
+    t.start()
+    self.__reporter = stop
+
+  def stop_periodic_log(self):
+    if self.__reporter:
+      self.__reporter.set()
+      self.__reporter = None
+
+
+class InstrumentedTable(object):
+  """
+  Wraps an OMERO table proxy, recording each call as ``Table.<name>``
+  together with the rows and bytes read or written.
+  """
+  def __init__(self, table, op_stats):
+    self.__table = table
+    self.__op_stats = op_stats
+
+  def __getattr__(self, name):
+    attr = getattr(self.__table, name)
+    if not callable(attr):
+      return attr
+    op_stats = self.__op_stats
+    key = 'Table.%s' % name
+    def call(*args, **kw):
+      start, res, error = time.time(), None, True
+      try:
+        res = attr(*args, **kw)
+        error = False
+        return res
+      finally:
+        n_rows, n_bytes = 0, 0
+        if isinstance(res, omero.grid.Data):
+          n_rows, n_bytes = data_size(res)
+        elif not error and args and _is_data(args[0]):
+          n_rows, n_bytes = data_size(args[0])
+        op_stats.record(key, time.time() - start, n_rows, n_bytes, error)
+    return call
+
+
+def instrument_table(table, op_stats):
+  return InstrumentedTable(table, op_stats)
@@ -0,0 +1,87 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+"""
+Genomic interval index
+======================
+
+An :class:`IntervalIndex` holds the global positions of the uniquely
+aligned markers of a marker set in sorted order, together with the
+offset of each chromosome in the sorted array. A batch of genomic
+regions can then be resolved with two binary searches per region,
+and each region maps to a contiguous range of the index rather than
+to a mask over all markers.
+"""
+
+import numpy as np
+
+
+MAX_CHROMOSOME = 26
+
+
+class IntervalIndex(object):
+  """
+  Index the markers with the given marker indices by their global
+  position. Negative global positions (i.e., markers that are not
+  uniquely aligned) are not indexed. max_genome_len is the
+  chromosome stride used to compute global positions.
+  """
+  def __init__(self, global_pos, marker_indices, max_genome_len):
+    global_pos = np.asarray(global_pos)
+    marker_indices = np.asarray(marker_indices)
+    valid = np.nonzero(global_pos >= 0)[0]
+    order = valid[np.argsort(global_pos[valid], kind='mergesort')]
+    self.global_pos = global_pos[order]
+    self.marker_indices = marker_indices[order]
+    self.max_genome_len = max_genome_len
+    bounds = np.arange(MAX_CHROMOSOME + 2) * max_genome_len
+    self.chrom_offsets = np.searchsorted(self.global_pos, bounds)
+
+  def __len__(self):
+    return len(self.global_pos)
+
+  def chromosome_range(self, chrom):
+    """
+    Return the (start, stop) index range of the markers on chrom.
+    """
+    return self.chrom_offsets[chrom], self.chrom_offsets[chrom + 1]
+
+  def __to_global(self, positions):
+    positions = np.asarray(positions, dtype=np.int64)
+    if positions.ndim == 1:
+      return positions
+    return positions[..., 0] * self.max_genome_len + positions[..., 1]
+
+  def query(self, begins, ends, closed_interval=True):
+    """
+    Return the (starts, stops) arrays of the index ranges that
+    correspond to the given regions. begins and ends are either
+    arrays of global positions or arrays of (chromosome, position)
+    pairs. If closed_interval is False, ends are excluded.
+    """
+    begins, ends = self.__to_global(begins), self.__to_global(ends)
+    starts = np.searchsorted(self.global_pos, begins, side='left')
+    side = 'right' if closed_interval else 'left'
+    stops = np.maximum(starts, np.searchsorted(self.global_pos, ends,
+                                               side=side))
+    return starts, stops
+
+  def markers(self, start, stop):
+    """
+    Return the indices of the markers in index range [start, stop).
+    """
+    return self.marker_indices[start:stop]
+
+  def select(self, begins, ends, closed_interval=True):
+    """
+    Return the sorted indices of all markers in any of the given
+    regions (see :meth:`query`).
+    """
+    starts, stops = self.query(begins, ends, closed_interval)
+    if len(starts) == 1:
+      return np.sort(self.markers(starts[0], stops[0]))
+    n = len(self) + 1
+    depth = (np.bincount(starts, minlength=n) -
+             np.bincount(stops, minlength=n)).cumsum()
+    mask = depth[:-1] > 0
+    return np.sort(self.marker_indices[mask])
@@ -0,0 +1,209 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+"""
+Columnar marker views
+=====================
+
+A :class:`MarkerView` exposes the markers of a loaded SNPMarkersSet,
+or a subset of them, as NumPy columns (label, index, mask,
+allele_flip, chrom, pos, ...), so that filtering, slicing and joins
+are vectorized. :class:`Marker` objects are only built on explicit
+request, via :meth:`MarkerView.marker` or
+:meth:`MarkerView.iter_markers`.
+"""
+
+import numpy as np
+
+
+class Marker(object):
+  """
+  Wraps the contents of a marker definition and associate information.
+  """
+  def __init__(self, vid, index=None, position=(0,0), flip=None, **kwargs):
+    self.id = vid
+    self.index = index
+    self.position = position
+    self.flip = flip
+    for k, v in kwargs.iteritems():
+      setattr(self, k, v)
+
+  # this is here to make app.importer.map_vid happy
+  @classmethod
+  def get_ome_table(klass):
+    return klass.__name__
+
+
+class MarkerView(object):
+  """
+  A view over the rows of the ``markers`` (and, optionally,
+  ``aligns``) record arrays of a marker set. ``indices`` is anything
+  that can index a numpy array (None selects all markers).
+
+  Indexing a view with an integer returns a :class:`Marker`; any other
+  key (slice, index array, boolean mask) returns a new view.
+  """
+  def __init__(self, markers, aligns=None, indices=None):
+    self.markers = markers
+    self.aligns = aligns
+    if indices is not None:
+      indices = np.arange(len(markers))[indices]
+    self.indices = indices
+
+  def __len__(self):
+    return len(self.markers) if self.indices is None else len(self.indices)
+
+  def __column(self, table, name):
+    a = table[name]
+    return a if self.indices is None else a[self.indices]
+
+  def __align_column(self, name):
+    if self.aligns is None:
+      raise ValueError('aligns vector has not been loaded')
+    return self.__column(self.aligns, name)
+
+  def has_aligns(self):
+    return self.aligns is not None
+
+  @property
+  def vid(self):
+    return self.__column(self.markers, 'vid')
+
+  @property
+  def label(self):
+    return self.__column(self.markers, 'label')
+
+  @property
+  def mask(self):
+    return self.__column(self.markers, 'mask')
+
+  @property
+  def index(self):
+    return self.__column(self.markers, 'index')
+
+  @property
+  def allele_flip(self):
+    return self.__column(self.markers, 'allele_flip')
+
+  @property
+  def copies(self):
+    return self.__align_column('copies')
+
+  @property
+  def aligned(self):
+    """
+    True for markers with a unique alignment.
+    """
+    if self.aligns is None:
+      return np.zeros(len(self), dtype=np.bool)
+    return self.copies == 1
+
+  def __position_column(self, name):
+    if self.aligns is None:
+      return np.zeros(len(self), dtype=np.int64)
+    return np.where(self.aligned, self.__align_column(name), 0)
+
+  @property
+  def chrom(self):
+    """
+    Chromosome of uniquely aligned markers, 0 for the others (or if
+    alignments have not been loaded).
+    """
+    return self.__position_column('chromosome')
+
+  @property
+  def pos(self):
+    """
+    Position of uniquely aligned markers, 0 for the others (or if
+    alignments have not been loaded).
+    """
+    return self.__position_column('pos')
+
+  @property
+  def global_pos(self):
+    return self.__align_column('global_pos')
+
+  @property
+  def strand(self):
+    return self.__align_column('strand')
+
+  @property
+  def allele(self):
+    return self.__align_column('allele')
+
+  def __getitem__(self, key):
+    if isinstance(key, (int, long, np.integer)):
+      return self.marker(key)
+    if self.indices is None:
+      return MarkerView(self.markers, self.aligns, key)
+    return MarkerView(self.markers, self.aligns, self.indices[key])
+
+  def filter(self, mask):
+    """
+    Return a view of the markers for which mask is True.
+    """
+    mask = np.asarray(mask, dtype=np.bool)
+    if mask.shape != (len(self),):
+      raise ValueError('mask length does not match view length')
+    return self[mask]
+
+  def __join_keys(self, on):
+    if on == 'position':
+      keys, valid = self.global_pos, self.aligned
+    else:
+      keys = self.__column(self.markers, on)
+      valid = np.ones(len(keys), dtype=np.bool)
+    return keys, valid
+
+  def join(self, other, on='label'):
+    """
+    Return a pair of equal length arrays with the positions, in this
+    view and in other, of markers with the same value of the given
+    column. If on is 'position', match uniquely aligned markers by
+    global position. If a value occurs more than once in other, only
+    one of its occurrences is matched.
+    """
+    keys, valid = self.__join_keys(on)
+    other_keys, other_valid = other.__join_keys(on)
+    other_pos = np.nonzero(other_valid)[0]
+    order = other_pos[np.argsort(other_keys[other_pos], kind='mergesort')]
+    sorted_keys = other_keys[order]
+    idx = np.searchsorted(sorted_keys, keys)
+    if len(sorted_keys):
+      idx = np.minimum(idx, len(sorted_keys) - 1)
+      match = valid & (sorted_keys[idx] == keys)
+    else:
+      match = np.zeros(len(keys), dtype=np.bool)
+    return np.nonzero(match)[0], order[idx[match]]
+
+  def marker(self, i):
+    """
+    Build the :class:`Marker` at position i of this view.
+    """
+    n = len(self)
+    if i < 0:
+      i += n
+    if not 0 <= i < n:
+      raise IndexError('marker index out of range')
+    if self.indices is not None:
+      i = self.indices[i]
+    mdef = self.markers[i]
+    kwargs = {
+      'vid': mdef['vid'],
+      'label': mdef['label'],
+      'mask': mdef['mask'],
+      'index': mdef['index'],
+      'flip': mdef['allele_flip'],
+      'position': (0, 0),
+      }
+    if self.aligns is not None:
+      mali = self.aligns[i]
+      if mali['copies'] == 1:
+        kwargs.update({'position' : (mali['chromosome'], mali['pos']),
+                       'on_reference_strand' : mali['strand'],
+                       'allele_on_reference' : mali['allele']})
+    return Marker(**kwargs)
+
+  def iter_markers(self):
+    for i in xrange(len(self)):
+      yield self.marker(i)
@@ -0,0 +1,136 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+"""
+KB object cache
+===============
+
+A bounded, LRU cache of wrapped KB objects keyed by
+:func:`~bl.vl.utils.ome_utils.ome_hash`. Each
+:class:`~bl.vl.kb.drivers.omero.proxy_core.ProxyCore` owns one.
+"""
+
+import sys, threading, weakref
+from collections import OrderedDict, Counter
+
+
+DEFAULT_MAX_SIZE = 50000
+
+
+def estimate_size(obj):
+  """
+  Rough estimate, in bytes, of the memory held by a wrapped object.
+  """
+  ome_obj = getattr(obj, 'ome_obj', obj)
+  size = sys.getsizeof(ome_obj)
+  for v in getattr(ome_obj, '__dict__', {}).itervalues():
+    size += sys.getsizeof(v)
+  return size
+
+
+class ObjectCache(object):
+  """
+  An LRU object cache.
+
+  :param max_size: maximum number of cached objects (None means no
+    limit)
+  :type max_size: int
+
+  :param max_bytes: approximate memory cap, as measured by ``sizer``
+    (None means no limit)
+  :type max_bytes: int
+
+  :param weak: if True, only keep weak references to cached objects,
+    so that the cache never keeps an object alive by itself
+  :type weak: bool
+  """
+  def __init__(self, max_size=DEFAULT_MAX_SIZE, max_bytes=None, weak=False,
+               sizer=estimate_size):
+    self.max_size = max_size
+    self.max_bytes = max_bytes
+    self.weak = weak
+    self.sizer = sizer
+    self.counters = Counter()
+    self.__data = OrderedDict()
+    self.__sizes = {}
+    self.__n_bytes = 0
+    self.__lock = threading.RLock()
+
+  def __len__(self):
+    return len(self.__data)
+
+  def __contains__(self, key):
+    return self.get(key, count=False) is not None
+
+  def __getitem__(self, key):
+    obj = self.get(key)
+    if obj is None:
+      raise KeyError(key)
+    return obj
+
+  def get(self, key, count=True):
+    with self.__lock:
+      try:
+        v = self.__data.pop(key)
+      except KeyError:
+        if count:
+          self.counters['misses'] += 1
+        return None
+      obj = v() if self.weak else v
+      if obj is None:
+        self.__forget(key)
+        if count:
+          self.counters['misses'] += 1
+        return None
+      self.__data[key] = v
+      if count:
+        self.counters['hits'] += 1
+      return obj
+
+  def put(self, key, obj):
+    with self.__lock:
+      if key in self.__data:
+        self.__data.pop(key)
+        self.__forget(key)
+      self.__data[key] = weakref.ref(obj) if self.weak else obj
+      if self.max_bytes is not None:
+        size = self.sizer(obj)
+        self.__sizes[key] = size
+        self.__n_bytes += size
+      self.__evict()
+
+  def discard(self, key):
+    with self.__lock:
+      if self.__data.pop(key, None) is not None:
+        self.__forget(key)
+        self.counters['invalidations'] += 1
+
+  def clear(self):
+    with self.__lock:
+      self.__data.clear()
+      self.__sizes.clear()
+      self.__n_bytes = 0
+
+  def stats(self):
+    """
+    Return a dictionary with cache usage counters.
+    """
+    with self.__lock:
+      stats = {'size': len(self.__data), 'bytes': self.__n_bytes}
+    for k in 'hits', 'misses', 'evictions', 'invalidations':
+      stats[k] = self.counters[k]
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_ratio'] = float(stats['hits']) / lookups if lookups else 0.0
+    return stats
+
+  def __forget(self, key):
+    self.__n_bytes -= self.__sizes.pop(key, 0)
+
+  def __evict(self):
+    while self.__data and (
+      (self.max_size is not None and len(self.__data) > self.max_size) or
+      (self.max_bytes is not None and self.__n_bytes > self.max_bytes)
+      ):
+      key, _ = self.__data.popitem(last=False)
+      self.__forget(key)
+      self.counters['evictions'] += 1
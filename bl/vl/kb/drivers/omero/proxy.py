@@ -1,7 +1,7 @@
 # BEGIN_COPYRIGHT
 # END_COPYRIGHT
 
-import hashlib, time, pwd, json, os
+import time, pwd, json, os
 from importlib import import_module
 
 # This is actually used in the metaclass magic
@@ -13,7 +13,8 @@ from bl.vl.kb.messages import get_events_sender
 from bl.vl.kb.dependency import DependencyTree
 from bl.vl.kb import mimetypes
 
-from proxy_core import ProxyCore
+from proxy_core import ProxyCore, DEFAULT_CACHE_SIZE, DEFAULT_MIRROR_QUOTA
+from proxy_core import DEFAULT_POOL_SIZE, DEFAULT_CHECKOUT_TIMEOUT
 from wrapper import ObjectFactory, MetaWrapper
 import action
 import vessels
@@ -32,10 +33,25 @@ from ehr import EHR
 from genotyping import Marker
 
 from admin import Admin
+from batch_lookup import BatchLookup
+from gdo_writer import GDOWriter, OBJECT_BATCH_SIZE
+from utils import resolve_action_id, gdo_checksum
+from alignment_cache import configure_alignment_cache, get_alignment_cache
+from alignment_cache import DEFAULT_MAX_BYTES as DEFAULT_ALIGN_CACHE_BYTES
+from alignment_cache import DEFAULT_DISK_QUOTA as DEFAULT_ALIGN_CACHE_QUOTA
+from table_iterator import auto_batch_size
 
 
 EXTRA_MODULES_ENV = 'OMERO_BIOBANK_EXTRA_MODULES'
 NO_VCHECK_ENV = 'OMERO_BIOBANK_NO_VCHECK'
+TABLE_MIRROR_ENV = 'OMERO_BIOBANK_TABLE_MIRROR'
+STATS_LOG_ENV = 'OMERO_BIOBANK_STATS_LOG_INTERVAL'
+STATS_DUMP_ENV = 'OMERO_BIOBANK_STATS_DUMP'
+TABLE_DATA_DIR_ENV = 'OMERO_BIOBANK_TABLE_DATA_DIR'
+MARKER_STORE_ENV = 'OMERO_BIOBANK_MARKER_STORE'
+ALIGN_CACHE_ENV = 'OMERO_BIOBANK_ALIGN_CACHE'
+# default number of samples read together by resolve_to_data
+RESOLVE_BATCH_SIZE = 64
 
 KOK = MetaWrapper.__KNOWN_OME_KLASSES__
 BATCH_SIZE = 5000
@@ -46,11 +62,42 @@ class Proxy(ProxyCore):
   An OMERO driver for the knowledge base.
   """
   def __init__(self, host, user, passwd, group=None, session_keep_tokens=1,
-               check_ome_version=True, extra_modules=None):
+               check_ome_version=True, extra_modules=None,
+               pool_size=DEFAULT_POOL_SIZE,
+               session_max_operations=None, session_max_age=None,
+               session_checkout_timeout=DEFAULT_CHECKOUT_TIMEOUT,
+               keepalive_secs=None, cache_size=DEFAULT_CACHE_SIZE,
+               cache_max_bytes=None, cache_weak_refs=False,
+               table_mirror_dir=None, table_mirror_quota=DEFAULT_MIRROR_QUOTA,
+               stats_log_interval=None, stats_dump_on_exit=False,
+               table_data_dir=None, marker_store_dir=None,
+               align_cache_max_bytes=DEFAULT_ALIGN_CACHE_BYTES,
+               align_cache_dir=None,
+               align_cache_quota=DEFAULT_ALIGN_CACHE_QUOTA):
     if os.getenv(NO_VCHECK_ENV):
       check_ome_version = False
+    table_mirror_dir = table_mirror_dir or os.getenv(TABLE_MIRROR_ENV)
+    if stats_log_interval is None and os.getenv(STATS_LOG_ENV):
+      stats_log_interval = float(os.getenv(STATS_LOG_ENV))
+    stats_dump_on_exit = stats_dump_on_exit or bool(os.getenv(STATS_DUMP_ENV))
+    table_data_dir = table_data_dir or os.getenv(TABLE_DATA_DIR_ENV)
+    marker_store_dir = marker_store_dir or os.getenv(MARKER_STORE_ENV)
+    align_cache_dir = align_cache_dir or os.getenv(ALIGN_CACHE_ENV)
     super(Proxy, self).__init__(host, user, passwd, group, session_keep_tokens,
-                                check_ome_version)
+                                check_ome_version, pool_size=pool_size,
+                                session_max_operations=session_max_operations,
+                                session_max_age=session_max_age,
+                                session_checkout_timeout=
+                                session_checkout_timeout,
+                                keepalive_secs=keepalive_secs,
+                                cache_size=cache_size,
+                                cache_max_bytes=cache_max_bytes,
+                                cache_weak_refs=cache_weak_refs,
+                                table_mirror_dir=table_mirror_dir,
+                                table_mirror_quota=table_mirror_quota,
+                                stats_log_interval=stats_log_interval,
+                                stats_dump_on_exit=stats_dump_on_exit,
+                                table_data_dir=table_data_dir)
     extra_modules = extra_modules or os.getenv(EXTRA_MODULES_ENV)
     if extra_modules:
       if isinstance(extra_modules, basestring):
@@ -62,6 +109,9 @@ class Proxy(ProxyCore):
           import_module(name)
         except ImportError:
           raise ImportError('Optional module "%s" not available' % name)
+    # the alignment cache is shared by all proxies in the process
+    configure_alignment_cache(align_cache_max_bytes, align_cache_dir,
+                              align_cache_quota, logger=self.logger)
     self.factory = ObjectFactory(proxy=self)
     #-- learn
     for k in KOK:
@@ -70,7 +120,7 @@ class Proxy(ProxyCore):
     # special case
     self.Marker = Marker
     #-- setup adapters
-    self.gadpt = GenotypingAdapter(self)
+    self.gadpt = GenotypingAdapter(self, marker_store_dir=marker_store_dir)
     self.madpt = ModelingAdapter(self)
     self.eadpt = EAVAdapter(self)
     self.admin = Admin(self)
@@ -82,15 +132,6 @@ class Proxy(ProxyCore):
       msg = 'bad type for %s(%s)' % (fname, val)
       raise ValueError(msg)
 
-  def __resolve_action_id(self, action):
-    if isinstance(action, self.Action):
-      if not action.is_loaded():
-        action.reload()
-      avid = action.id
-    else:
-      avid = action
-    return avid
-
   # High level ops
   # ==============
   def find_all_by_query(self, query, params):
@@ -104,48 +145,40 @@ class Proxy(ProxyCore):
       raise ValueError("%d kb objects map to %s" % (len(res), vid))
     return res[0]
 
-  def get_by_field(self, klass, field_name, values, batch_size=240):
-    """
-    FIXME returns a dictionary that map all v in values
-    for which exists an object o of class klass such that o.field_name == v
-    to o.
-    """
-    def get_by_field_helper(values):
-      template = "from %s o where o.{} in (%s)".format(field_name)
-      query = template % (klass.get_ome_table(),
-                          ','.join(map(lambda x: "'%s'" % x, values)))
-      params = {}
-      res = self.find_all_by_query(query, params)
-      return dict(map(lambda o: (getattr(o, field_name), o), res))
-    def values_by_chunk():
-      offset = 0
-      while len(values[offset:]) > 0:
-        yield values[offset:offset+batch_size]
-        offset += batch_size
-
-    if len(values) == 0:
-      return {}
-    if batch_size == 0:
-      return get_by_field_helper(values)
-    else:
-      return reduce(lambda x, y: x.update(y) or x,
-                    map(get_by_field_helper, values_by_chunk()))
+  def get_by_field(self, klass, field_name, values, batch_size=None,
+                   multi_valued=False):
+    """
+    Return a dictionary that maps all v in values for which there
+    exists an object o of class klass such that o.field_name == v to
+    o or, if multi_valued is True, to the list of all such objects.
+
+    Values are resolved in chunks of batch_size elements, dispatched
+    concurrently over the session pool. If batch_size is None, the
+    chunk size is computed from the server limits; if it is 0, a
+    single query is issued.
+    """
+    lookup = BatchLookup(self, klass, field_name)
+    return lookup.resolve(values, batch_size=batch_size,
+                          multi_valued=multi_valued)
 
-  def get_by_vids(self, klass, vids, batch_size=240):
+  def get_by_vids(self, klass, vids, batch_size=None):
     """
-    FIXME Given a list of vids, returns a dictionary that map all vid
-    in vids for which exists an object o of class klass such that o.vid == vid
-    to o.
+    Given a list of vids, returns a dictionary that map all vid in
+    vids for which exists an object o of class klass such that o.vid
+    == vid to o.
     """
     return self.get_by_field(klass, 'vid', vids, batch_size)
 
-  def get_by_labels(self, klass, labels, batch_size=240):
+  def get_by_labels(self, klass, labels, batch_size=None,
+                    multi_valued=False):
     """
-    FIXME Given a list of labels, returns a dictionary that map all
-    label in labels for which exists an object o of class klass such
-    that o.label == label, to o.
+    Given a list of labels, returns a dictionary that map all label
+    in labels for which exists an object o of class klass such that
+    o.label == label, to o (or to the list of all such objects, if
+    multi_valued is True).
     """
-    return self.get_by_field(klass, 'label', labels, batch_size)
+    return self.get_by_field(klass, 'label', labels, batch_size,
+                             multi_valued=multi_valued)
 
   def create_global_tables(self, destructive=False):
     self.eadpt.create_ehr_table(destructive=destructive)
@@ -205,10 +238,22 @@ class Proxy(ProxyCore):
   # ====================================
 
   def create_snp_markers_set(self, label, maker, model, release,
-                             N, stream, action):
+                             N, stream, action, gdo_block_size=None,
+                             gdo_encoding=None, sort_memory_budget=None,
+                             progress=None):
     """
     Given a stream of (label, mask, index, allele_flip) tuples,
     build and save a new marker set.
+
+    If gdo_block_size is set, genotype data objects for this marker
+    set are stored in blocks of gdo_block_size markers, so that reads
+    restricted to a subset of the markers only fetch the blocks that
+    contain them. If gdo_encoding is 'q8', genotype values are stored
+    quantized to 8 bits (see :mod:`.gdo_layout`).
+
+    The stream is sorted out of core, using about sort_memory_budget
+    bytes of memory; progress is an optional progress(phase, count)
+    callback (see :meth:`GenotypingAdapter.define_snp_markers_set`).
     """
     assert type(N) == int and N > 0
     if not action.is_loaded():
@@ -218,7 +263,7 @@ class Proxy(ProxyCore):
       for tuple_ in stream:
         yield dict(zip(stream_header, tuple_))
     set_vid = vlu.make_vid()
-    op_vid = self.__resolve_action_id(action)
+    op_vid = resolve_action_id(self, action)
     conf = {
       'label': label,
       'maker': maker,
@@ -231,8 +276,13 @@ class Proxy(ProxyCore):
     mset.save()
     # TODO: add better exception handling to the following code
     try:
-      self.gadpt.create_snp_markers_set_tables(mset.id, N)
-      count = self.gadpt.define_snp_markers_set(set_vid, mod_stream(), op_vid)
+      self.gadpt.create_snp_markers_set_tables(mset.id, N, gdo_block_size,
+                                               gdo_encoding)
+      define_kw = {'progress': progress}
+      if sort_memory_budget:
+        define_kw['memory_budget'] = sort_memory_budget
+      count = self.gadpt.define_snp_markers_set(set_vid, mod_stream(), op_vid,
+                                                **define_kw)
       if count != N:
         raise ValueError('there are %d records in stream (expected %d)' %
                          (count, N))
@@ -260,24 +310,16 @@ class Proxy(ProxyCore):
       #. the number of times this marker has been seen on the
          reference genome. If the latter is larger than 1, there
          should be N records for this marker.
+
+    Return a summary report (see
+    :meth:`GenotypingAdapter.load_snp_markers_set_alignments`).
     """
     # FIXME no checking
-    def gen(s):
-      for x in s:
-        y = {
-          'marker_vid': x[0],
-          'ref_genome': ref_genome,
-          'chromosome': x[1],
-          'pos': x[2],
-          'strand': x[3],
-          'allele': x[4],
-          'copies': x[5],
-          }
-        yield y
     max_len = self.gadpt.SNP_ALIGNMENT_COLS[1][3]
     if len(ref_genome) > max_len:
       raise ValueError('len("%s") > %d' % (ref_genome, max_len))
-    self.gadpt.add_snp_markers_set_alignments(mset, gen(stream), action)
+    return self.gadpt.load_snp_markers_set_alignments(mset, ref_genome,
+                                                      stream, action)
 
   def make_gdo_path(self, mset, vid, index):
     table_name = self.gadpt.snp_markers_set_table_name('gdo', mset.id)
@@ -304,57 +346,180 @@ class Proxy(ProxyCore):
     :type probs: numpy.darray
 
     """
-    avid = self.__resolve_action_id(action)
+    avid = resolve_action_id(self, action)
     if not isinstance(sample, self.GenotypeDataSample):
       raise ValueError('sample should be an instance of GenotypeDataSample')
     mset = sample.snpMarkersSet
     # FIXME doesn't check that probs and confs have the right dtype and size
     gdo_vid, row_index = self.gadpt.add_gdo(mset.id, probs, confs, avid)
-    size = 0
-    sha1 = hashlib.sha1()
-    s = probs.tostring();  size += len(s) ; sha1.update(s)
-    s = confs.tostring();  size += len(s) ; sha1.update(s)
+    sha1, size = gdo_checksum(probs, confs)
     conf = {
       'sample': sample,
       'path': self.make_gdo_path(mset, gdo_vid, row_index),
       'mimetype': mimetypes.GDO_TABLE,
-      'sha1': sha1.hexdigest(),
+      'sha1': sha1,
       'size': size,
       }
     gds = self.factory.create(self.DataObject, conf).save()
     return gds
 
+  def add_gdo_data_objects(self, stream, batch_size=OBJECT_BATCH_SIZE):
+    """
+    Bulk version of :meth:`add_gdo_data_object`: stream must yield
+    (action, sample, probs, confs) tuples. Genotype rows are appended
+    to the GDO tables in large chunks and the DataObjects are saved
+    batch_size at a time. Return the list of created DataObjects.
+    """
+    writer = GDOWriter(self, batch_size=batch_size)
+    for action, sample, probs, confs in stream:
+      writer.add(action, sample, probs, confs)
+    return writer.close()
+
   def get_gdo(self, mset, vid, row_index, indices=None):
     return self.gadpt.get_gdo(mset.id, vid, row_index, indices)
 
 
-  #FIXME this is the basic object, we should have some support for selections
-  def get_gdo_iterator(self, mset, data_samples=None, indices = None,
-                       batch_size=100):
-    def get_gdo_iterator_on_list(dos):
-      seen_data_samples = set([])
-      for do in dos:
+  def __get_gdo_refs_by_sample(self, data_samples,
+                               chunk_size=OBJECT_BATCH_SIZE):
+    """
+    Return a dictionary that maps the omero_id of each element of
+    data_samples that has a GDO to its (mset_vid, vid, row_index)
+    reference, with one DataObject query per chunk_size samples.
+    """
+    ids = list(set(ds.omero_id for ds in data_samples))
+    query = 'from DataObject do where do.sample.id in (:ids)'
+    refs = {}
+    for i in xrange(0, len(ids), chunk_size):
+      for do in self.find_all_by_query(query, {'ids': ids[i:i+chunk_size]}):
         # FIXME we could, in principle, handle other mimetypes too
-        if do.mimetype == mimetypes.GDO_TABLE:
-          self.logger.debug(do.path)
-          mset_vid, vid, row_index = self.parse_gdo_path(do.path)
-          self.logger.debug('%r' % [vid, row_index])
-          if mset_vid != mset.id:
-            raise ValueError(
-              'DataObject %s map to data with a wrong SNPMarkersSet' % do.path
-              )
-          yield self.get_gdo(mset, vid, row_index, indices)
-        else:
-          pass
-    if data_samples is None:
-      return self.gadpt.get_gdo_iterator(mset.id, indices, batch_size)
+        if do.mimetype != mimetypes.GDO_TABLE:
+          continue
+        refs.setdefault(do.sample.omero_id, self.parse_gdo_path(do.path))
+    return refs
+
+  def __get_gdo_refs(self, mset, data_samples):
+    """
+    Return the (vid, row_index) GDO references of data_samples, in
+    order.
+    """
     for d in data_samples:
       if d.snpMarkersSet != mset:
         raise ValueError('data_sample %s snpMarkersSet != mset' % d.id)
-    ids = ','.join('%s' % ds.omero_id for ds in data_samples)
-    query = 'from DataObject do where do.sample.id in (%s)' % ids
-    dos = self.find_all_by_query(query, None)
-    return get_gdo_iterator_on_list(dos)
+    if not data_samples:
+      return []
+    refs = self.__get_gdo_refs_by_sample(data_samples)
+    for mset_vid, _, _ in refs.itervalues():
+      if mset_vid != mset.id:
+        raise ValueError('DataObject maps to data with a wrong SNPMarkersSet')
+    return [refs[ds.omero_id][1:] for ds in data_samples
+            if ds.omero_id in refs]
+
+  def resolve_to_data(self, data_samples, indices=None, batch_size=None):
+    """
+    Bulk version of :meth:`GenotypeDataSample.resolve_to_data`:
+    iterate over the (probs, confidence) pairs of data_samples, in
+    input order.
+
+    The DataObjects of all samples are fetched with as few queries as
+    possible; genotype data is then read, batch_size samples (by
+    default, ``RESOLVE_BATCH_SIZE``) at a time, with one bulk
+    :meth:`GenotypingAdapter.get_gdos` call per marker set in the
+    batch, which reads the requested rows as sorted ranges. If
+    indices is not None, only the selected markers are returned.
+    Samples need not share the same marker set: to get a single
+    matrix for samples of the same set, use :meth:`get_gdos`.
+
+    Selecting markers with indices only cuts the data read from the
+    server for GDO tables created with ``gdo_block_size`` (see
+    :mod:`.gdo_layout`); rows of older tables are still read whole.
+    Convert those with ``tools/reencode_gdos``.
+    """
+    data_samples = list(data_samples)
+    refs = self.__get_gdo_refs_by_sample(data_samples)
+    for ds in data_samples:
+      if ds.omero_id not in refs:
+        raise ValueError('no %s DataObject for %s' %
+                         (mimetypes.GDO_TABLE, ds.id))
+      if refs[ds.omero_id][0] != ds.snpMarkersSet.id:
+        raise ValueError('GDO of %s does not belong to its marker set %s' %
+                         (ds.id, ds.snpMarkersSet.id))
+    batch_size = max(1, min(len(data_samples),
+                            batch_size or RESOLVE_BATCH_SIZE))
+    def iterator():
+      for i in xrange(0, len(data_samples), batch_size):
+        chunk = [refs[ds.omero_id] for ds in data_samples[i:i+batch_size]]
+        by_mset = {}
+        for j, (mset_vid, _, row_index) in enumerate(chunk):
+          by_mset.setdefault(mset_vid, []).append((j, row_index))
+        results = [None] * len(chunk)
+        for mset_vid, positions in by_mset.iteritems():
+          gdos = self.gadpt.get_gdos(mset_vid,
+                                     row_indices=[p[1] for p in positions],
+                                     indices=indices)
+          for k, (j, _) in enumerate(positions):
+            assert gdos['vid'][k] == chunk[j][1]
+            results[j] = (gdos['probs'][k], gdos['confidence'][k])
+        for r in results:
+          yield r
+    return iterator()
+
+  def get_gdos(self, mset, data_samples=None, vids=None, row_indices=None,
+               indices=None):
+    """
+    Fetch, in bulk, the GDOs of data_samples or those identified by
+    vids or row_indices (see :meth:`GenotypingAdapter.get_gdos`).
+    Return a dictionary of arrays with one row per sample.
+
+    As with :meth:`resolve_to_data`, selecting markers with indices
+    only reduces the amount of data read for GDO tables created with
+    ``gdo_block_size``: use ``tools/reencode_gdos`` to convert
+    existing ones.
+    """
+    if data_samples is not None:
+      refs = self.__get_gdo_refs(mset, data_samples)
+      if len(refs) != len(data_samples):
+        raise ValueError('%d data samples have no gdo' %
+                         (len(data_samples) - len(refs)))
+      row_indices = [r[1] for r in refs]
+    return self.gadpt.get_gdos(mset.id, row_indices=row_indices, vids=vids,
+                               indices=indices)
+
+  #FIXME this is the basic object, we should have some support for selections
+  def get_gdo_iterator(self, mset, data_samples=None, indices = None,
+                       batch_size=None):
+    def get_gdo_iterator_on_refs(refs, chunk_size):
+      for i in xrange(0, len(refs), chunk_size):
+        chunk = refs[i:i+chunk_size]
+        gdos = self.gadpt.get_gdos(mset.id, row_indices=[r[1] for r in chunk],
+                                   indices=indices)
+        for j, (vid, _) in enumerate(chunk):
+          assert gdos['vid'][j] == vid
+          yield {'vid': vid, 'op_vid': gdos['op_vid'][j],
+                 'probs': gdos['probs'][j],
+                 'confidence': gdos['confidence'][j]}
+    if data_samples is None:
+      return self.gadpt.get_gdo_iterator(mset.id, indices, batch_size)
+    refs = self.__get_gdo_refs(mset, data_samples)
+    if not batch_size:
+      table_name = self.gadpt.snp_markers_set_table_name('gdo', mset.id)
+      batch_size = auto_batch_size(self.get_table_headers(table_name))
+    return get_gdo_iterator_on_refs(refs, batch_size)
+
+  def get_marker_store(self, mset, sync=False):
+    """
+    Open the marker-major genotype store of mset (see
+    :mod:`bl.vl.genotype.marker_store`), bringing it up to date
+    first if sync is True. The store is only available if the
+    proxy has been configured with a marker_store_dir.
+    """
+    return self.gadpt.open_marker_store(mset.id, sync=sync)
+
+  def get_alignment_cache_stats(self):
+    """
+    Return the usage counters of the process-wide alignment cache
+    (see :mod:`.alignment_cache`).
+    """
+    return get_alignment_cache().stats()
 
   def get_snp_markers_set(self, label=None,
                           maker=None, model=None, release=None):
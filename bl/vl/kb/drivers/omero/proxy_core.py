@@ -3,6 +3,7 @@
 
 from bl.vl.utils import get_logger
 
+import time
 import itertools as it
 import numpy as np
 
@@ -18,9 +19,26 @@ import bl.vl.kb as kb
 from bl.vl.utils.ome_utils import ome_hash
 
 from wrapper import ome_wrap
+from session_pool import SessionPool
+from session_pool import DEFAULT_SIZE as DEFAULT_POOL_SIZE
+from session_pool import DEFAULT_CHECKOUT_TIMEOUT
+from table_query import SelectionPlan
+from table_iterator import PrefetchingReader, auto_batch_size, \
+     PREFETCH_BATCHES
+from object_cache import ObjectCache
+from object_cache import DEFAULT_MAX_SIZE as DEFAULT_CACHE_SIZE
+from table_mirror import TableMirror
+from table_mirror import DEFAULT_QUOTA as DEFAULT_MIRROR_QUOTA
+from instrumentation import OperationStats, instrument_table
+from direct_table import DirectTableReader
+from table_cache import TableCache, CachedTable
 
 
 BATCH_SIZE = 5000
+# default Ice.MessageSizeMax for OMERO clients, in KB
+DEFAULT_MESSAGE_SIZE_MAX = 65536
+# only use this fraction of the message size for a single table write
+WRITE_MESSAGE_USAGE = 0.5
 
 
 def convert_type(o):
@@ -52,6 +70,49 @@ def convert_to_numpy_record_type(d):
   return [(c.name, convert_type(c)) for c in d]
 
 
+class TableBuffer(object):
+  """
+  Preallocated destination for table reads.
+
+  Batches of rows (``omero.grid.Data`` objects) are copied in place,
+  column by column, either into a numpy record array or, if
+  ``columnar`` is True, into one numpy array per column.
+  """
+  def __init__(self, col_objs, n_rows, columnar=False):
+    record_type = convert_to_numpy_record_type(col_objs)
+    self.columnar = columnar
+    if columnar:
+      self.data = dict((name, np.zeros(n_rows, dtype=t))
+                       for name, t in record_type)
+      self.columns = self.data
+    else:
+      self.data = np.zeros(n_rows, dtype=record_type)
+      self.columns = dict((name, self.data[name]) for name, _ in record_type)
+    self.size = n_rows
+    self.n_rows = 0
+
+  def add(self, d):
+    if not d.columns:
+      return
+    n = len(d.columns[0].values)
+    if self.n_rows + n > self.size:
+      raise ValueError('table buffer overflow')
+    for c in d.columns:
+      self.columns[c.name][self.n_rows:self.n_rows+n] = c.values
+    self.n_rows += n
+
+  def result(self):
+    if self.n_rows < self.size:
+      if self.columnar:
+        self.data = dict((k, v[:self.n_rows])
+                         for k, v in self.data.iteritems())
+      else:
+        self.data = self.data[:self.n_rows]
+    if not self.columnar and self.n_rows == 0:
+      return []
+    return self.data
+
+
 def convert_from_numpy(x):
   if isinstance(x, np.int64):
     return int(x)
@@ -66,9 +127,13 @@ class ProxyCore(object):
   NOTE: keeping an open session leads to bad performance, because the
   Java garbage collector is called automatically and
   unpredictably. You cannot force garbage collection on an open
-  session unless you are using Java. For this reason, we open a new
-  session for each new operation on the database and close it when we
-  are done, forcing the server to release the allocated memory.
+  session unless you are using Java. For this reason, sessions are
+  drawn from a :class:`~.session_pool.SessionPool` that recycles them
+  after ``session_max_operations`` operations or ``session_max_age``
+  seconds, forcing the server to release the allocated memory without
+  paying for a new session at each operation. Each thread gets its own
+  session, so up to ``pool_size`` threads can query the server
+  concurrently.
   """
 
   OME_TABLE_COLUMN = {
@@ -80,22 +145,24 @@ class ProxyCore(object):
     'double_array': omero.grid.DoubleArrayColumn,
     'long_array': omero.grid.LongArrayColumn,
     }
-  _CACHE = {}
 
   def store_to_cache(self, obj):
-    self.__class__._CACHE[ome_hash(obj.ome_obj)] = obj
+    self.object_cache.put(ome_hash(obj.ome_obj), obj)
 
   def del_from_cache(self, ome_obj):
-    try:
-      del self.__class__._CACHE[ome_hash(ome_obj)]
-    except KeyError:
-      pass
+    self.object_cache.discard(ome_hash(ome_obj))
 
   def get_from_cache(self, ome_obj):
-    return self._CACHE.get(ome_hash(ome_obj))
+    return self.object_cache.get(ome_hash(ome_obj))
 
   def clear_cache(self):
-    self.__class__._CACHE.clear()
+    self.object_cache.clear()
+
+  def get_cache_stats(self):
+    return self.object_cache.stats()
+
+  def get_table_mirror_stats(self):
+    return self.table_mirror.stats() if self.table_mirror else None
 
   def __check_omero_version(self):
     s = self.connect()
@@ -108,48 +175,153 @@ class ProxyCore(object):
                        (client_version, server_version))
 
   def __init__(self, host, user, passwd, group=None, session_keep_tokens=1,
-               check_ome_version=True):
+               check_ome_version=True, pool_size=DEFAULT_POOL_SIZE,
+               session_max_operations=None, session_max_age=None,
+               session_checkout_timeout=DEFAULT_CHECKOUT_TIMEOUT,
+               keepalive_secs=None, cache_size=DEFAULT_CACHE_SIZE,
+               cache_max_bytes=None, cache_weak_refs=False,
+               table_mirror_dir=None, table_mirror_quota=DEFAULT_MIRROR_QUOTA,
+               stats_log_interval=None, stats_dump_on_exit=False,
+               table_data_dir=None):
     self.logger = get_logger('bl.vl.kb.drivers.omero.proxy_core')
+    self.object_cache = ObjectCache(max_size=cache_size,
+                                    max_bytes=cache_max_bytes,
+                                    weak=cache_weak_refs)
     self.user = user
     self.passwd = passwd
     self.group_name = group
-    self.client = omero.client(host)
     for h in self.logger.root.handlers:
       self.logger.root.removeHandler(h)
     self.session_keep_tokens = session_keep_tokens
-    self.transaction_tokens = 0
-    self.current_session = None
+    self.last_selection_stats = None
+    self.__message_size_max = None
+    if table_mirror_dir:
+      self.table_mirror = TableMirror(table_mirror_dir,
+                                      quota=table_mirror_quota,
+                                      logger=self.logger)
+    else:
+      self.table_mirror = None
+    self.session_pool = SessionPool(host, user, passwd, group,
+                                    size=pool_size,
+                                    max_operations=session_max_operations,
+                                    max_age=session_max_age,
+                                    keepalive_secs=keepalive_secs,
+                                    checkout_timeout=session_checkout_timeout,
+                                    logger=self.logger)
+    self.session_pool.add_recycle_listener(self.__release_tables)
+    self.op_stats = OperationStats()
+    self.op_stats.add_source('sessions', self.session_pool.stats)
+    self.op_stats.add_source('cache', self.object_cache.stats)
+    self.op_stats.add_source('tables', self.get_table_cache_stats)
+    if stats_log_interval:
+      self.op_stats.start_periodic_log(self.logger, stats_log_interval)
+    if stats_dump_on_exit:
+      self.op_stats.dump_on_exit(self.logger)
     if check_ome_version:
         self.__check_omero_version()
+    self.direct_reader = None
+    if table_data_dir:
+      if not DirectTableReader.available():
+        self.logger.warning('PyTables not available, direct reads disabled')
+      else:
+        if table_data_dir is True:
+          table_data_dir = self.ome_operation('getConfigService',
+                                              'getConfigValue',
+                                              'omero.data.dir')
+        self.direct_reader = DirectTableReader(table_data_dir, self.logger)
+        self.op_stats.add_source('direct', self.direct_reader.stats)
 
   def __del__(self):
-    if self.current_session:
-      self.client.closeSession()
+    if hasattr(self, 'session_pool'):
+      self.session_pool.close()
 
   def change_group(self, group_name):
     self.group_name = group_name
-    self.transaction_tokens = 0
-    # self.disconnect()
+    self.session_pool.set_group(group_name)
 
   def connect(self):
-    if not self.current_session:
-      self.current_session = self.client.createSession(self.user, self.passwd)
-      self.transaction_tokens = self.session_keep_tokens
-      if self.group_name:
-        a = self.current_session.getAdminService()
-        try:
-          g = a.lookupGroup(self.group_name)
-          self.current_session.setSecurityContext(g)
-        except omero.ApiUsageException, aue:
-          raise ValueError(aue.message)
-    self.transaction_tokens -= 1
-    return self.current_session
+    """
+    Return the OMERO session bound to the calling thread. Each call
+    must be matched by a call to :meth:`disconnect`.
+    """
+    bound = self.session_pool.current() is not None
+    ps = self.session_pool.checkout()
+    if not bound:
+      ps.tokens = self.session_keep_tokens
+      ps.depth = 0
+    ps.tokens -= 1
+    ps.depth += 1
+    return ps.session
 
   def disconnect(self):
-    if self.transaction_tokens <= 0:
-      self.client.closeSession()
-      self.current_session = None
-      self.transaction_tokens = 0
+    """
+    End the operation started by the matching :meth:`connect`. When
+    the outermost operation ends, the calling thread's session is
+    given back to the pool once its ``session_keep_tokens`` have been
+    used up, so that other threads can check it out.
+    """
+    ps = self.session_pool.current()
+    if ps is None:
+      return
+    ps.depth = max(0, ps.depth - 1)
+    if ps.depth == 0 and ps.tokens <= 0:
+      self.session_pool.checkin()
+
+  def get_message_size_max(self):
+    """
+    Return the Ice.MessageSizeMax of the OMERO client, in KB.
+    """
+    if self.__message_size_max is None:
+      self.connect()
+      try:
+        v = self.session_pool.current().client.getProperty(
+          'Ice.MessageSizeMax'
+          )
+        self.__message_size_max = int(v) if v else DEFAULT_MESSAGE_SIZE_MAX
+      except (ValueError, AttributeError):
+        self.__message_size_max = DEFAULT_MESSAGE_SIZE_MAX
+      finally:
+        self.disconnect()
+    return self.__message_size_max
+
+  def get_write_batch_size(self, row_bytes):
+    """
+    Return the number of rows of row_bytes bytes that can be sent
+    with a single addData call without exceeding the Ice message size
+    limit. This is at least one, however large the rows.
+    """
+    budget = WRITE_MESSAGE_USAGE * 1024 * self.get_message_size_max()
+    return int(max(1, budget // max(1, row_bytes)))
+
+  def close(self):
+    """
+    Close all the sessions held by this proxy.
+    """
+    self.session_pool.close()
+    if self.direct_reader:
+      self.direct_reader.clear()
+
+  def get_session_stats(self):
+    return self.session_pool.stats()
+
+  def get_table_cache_stats(self):
+    stats = {'size': 0, 'hits': 0, 'misses': 0}
+    for ps in self.session_pool.sessions():
+      if ps.tables is not None:
+        for k, v in ps.tables.stats().iteritems():
+          stats[k] += v
+    return stats
+
+  def get_operation_stats(self):
+    """
+    Return per-operation call counts, latency histograms and
+    transferred rows and bytes, together with session and cache
+    counters (see :mod:`.instrumentation`).
+    """
+    return self.op_stats.stats()
+
+  def log_operation_stats(self):
+    self.op_stats.log_report(self.logger)
 
   def ome_query_params(self, conf):
     params = osp.ParametersI()
@@ -159,18 +331,26 @@ class ProxyCore(object):
 
   def ome_operation(self, operation, action, *action_args):
     session = self.connect()
-    # try:
-    try:
-      service = getattr(session, operation)()
-    except AttributeError:
-      raise kb.KBError("%r kb operation not supported" % operation)
     try:
-      result = getattr(service, action)(*action_args)
-    except AttributeError:
-      raise kb.KBError("%r kb action not supported on operation %r" %
-                       (action, operation))
-    # finally:
-    #   self.disconnect()
+      try:
+        service = getattr(session, operation)()
+      except AttributeError:
+        raise kb.KBError("%r kb operation not supported" % operation)
+      start, n_rows, error = time.time(), 0, True
+      try:
+        result = getattr(service, action)(*action_args)
+        error = False
+      except AttributeError:
+        raise kb.KBError("%r kb action not supported on operation %r" %
+                         (action, operation))
+      finally:
+        # failed calls (e.g., timeouts) are recorded too
+        if not error and isinstance(result, (list, tuple)):
+          n_rows = len(result)
+        self.op_stats.record('%s.%s' % (operation, action),
+                             time.time() - start, n_rows, error=error)
+    finally:
+      self.disconnect()
     return result
 
   def find_all_by_query(self, query, params, factory):
@@ -201,6 +381,7 @@ class ProxyCore(object):
       if not res:
         raise ValueError('cannot load ome_obj %s'  % ome_obj)
       return res
+    self.del_from_cache(o.ome_obj)
     res = load_ome_obj(o.ome_obj)
     if fields:
       for f in fields:
@@ -208,6 +389,7 @@ class ProxyCore(object):
         setattr(res, f, x)
     o.ome_obj = res
     o.proxy = self
+    self.store_to_cache(o)
 
   def save(self, obj):
     """
@@ -299,13 +481,18 @@ class ProxyCore(object):
 
       ${OMERO_HOME}/bin/omero admin cleanse ${OMERO_DATA_DIR}
     """
-    # try:
     self.connect()
-    ofiles = self._list_table_copies(table_name)
-    for o in ofiles:
-      self.ome_operation('getUpdateService' , 'deleteObject', o)
-    # finally:
-    #   self.disconnect()
+    try:
+      ofiles = self._list_table_copies(table_name)
+      for o in ofiles:
+        self.ome_operation('getUpdateService' , 'deleteObject', o)
+        if self.direct_reader:
+          self.direct_reader.invalidate(o.id.val)
+      self.__invalidate_table(table_name)
+      if self.table_mirror:
+        self.table_mirror.purge(table_name)
+    finally:
+      self.disconnect()
 
   def table_exists(self, table_name):
     # try:
@@ -317,44 +504,96 @@ class ProxyCore(object):
   def create_table(self, table_name, fields):
     ofields = [self.OME_TABLE_COLUMN[f[0]](*f[1:]) for f in fields]
     s = self.connect()
-    # try:
-    r = s.sharedResources()
-    m = r.repositories()
-    i = m.descriptions[0].id.val
-    t = r.newTable(i, table_name)
-    t.initialize(ofields)
-    # finally:
-    #   self.disconnect()
+    try:
+      r = s.sharedResources()
+      m = r.repositories()
+      i = m.descriptions[0].id.val
+      t = r.newTable(i, table_name)
+      t.initialize(ofields)
+      self.__invalidate_table(table_name)
+    finally:
+      self.disconnect()
     return t
 
+  def __release_tables(self, ps):
+    if ps.tables is not None:
+      ps.tables.clear()
+
+  def __invalidate_table(self, table_name):
+    for ps in self.session_pool.sessions():
+      if ps.tables is not None:
+        ps.tables.invalidate(table_name)
+
   def _get_table(self, session, table_name):
+    """
+    Return the named table, opened on session. Tables opened on a
+    pooled session are cached, together with their headers, until
+    the table is deleted or the session is recycled.
+    """
+    ps = self.session_pool.current()
+    cache = None
+    if ps is not None and ps.session is session:
+      if ps.tables is None:
+        ps.tables = TableCache()
+      cache = ps.tables
+      t = cache.get(table_name)
+      if t is not None:
+        return t
     s = session
     qs = s.getQueryService()
     ofile = qs.findByString('OriginalFile', 'name', table_name, None)
     if not ofile:
       raise kb.KBError('the requested %s table is missing' % table_name)
     r = s.sharedResources()
-    t = r.openTable(ofile)
+    t = self.op_stats.timed('Table.open', r.openTable, ofile)
     if not t:
       raise ValueError("failed to retrieve table '%s'" % table_name)
-    return t
+    t = instrument_table(t, self.op_stats)
+    return CachedTable(t) if cache is None else cache.put(table_name, t)
 
-  def get_table_rows_iterator(self, table_name, batch_size=100):
-    # TODO add error checking
-    def iter_on_rows(t, n_cols):
-      i, N = 0, t.getNumberOfRows()
-      while i < N:
-        j = min(N, i + batch_size)
-        v = t.read(range(n_cols), i, j)
-        Z = convert_coordinates_to_np(v)
-        for k in range(j - i):
-          yield Z[k]
-        i = j
-      # self.disconnect()  # this closes the connect() below
+  def get_table_rows_iterator(self, table_name, batch_size=None,
+                              prefetch=PREFETCH_BATCHES, yield_batches=False,
+                              col_names=None):
+    """
+    Iterate over all rows of a table, while a background thread
+    prefetches up to ``prefetch`` batches of ``batch_size`` rows. If
+    ``batch_size`` is not set, it is computed from the row width. If
+    ``yield_batches`` is True, yield record arrays of up to
+    ``batch_size`` rows instead of single rows. If ``col_names`` is
+    set, only read those columns.
+    """
     s = self.connect()
-    t = self._get_table(s, table_name)
-    col_objs = t.getHeaders()
-    return iter_on_rows(t, len(col_objs))
+    try:
+      t = self._get_table(s, table_name)
+      col_numbers = self.__convert_col_names_to_indices(t, col_names)
+      col_objs = self.__get_col_objs(t, col_numbers)
+      if not batch_size:
+        batch_size = auto_batch_size(convert_to_numpy_record_type(col_objs))
+      dt = self.__open_direct(t)
+      if dt is not None:
+        record_type = convert_to_numpy_record_type(col_objs)
+        return PrefetchingReader(lambda i, j: dt.read(record_type, i, j),
+                                 dt.getNumberOfRows(), batch_size,
+                                 prefetch=prefetch,
+                                 yield_batches=yield_batches,
+                                 on_close=dt.release)
+      def read_batch(i, j):
+        buf = TableBuffer(col_objs, j - i)
+        buf.add(t.read(col_numbers, i, j))
+        return buf.result()
+      # the table must outlive the session recycling policy and
+      # eviction from the table cache; the pinned session goes back
+      # to the pool only when the reader is closed
+      ps = self.session_pool.pin()
+      t.acquire()
+      def on_close():
+        t.release()
+        self.session_pool.unpin(ps)
+      return PrefetchingReader(read_batch, t.getNumberOfRows(), batch_size,
+                               prefetch=prefetch, yield_batches=yield_batches,
+                               on_close=on_close)
+    finally:
+      self.disconnect()
 
   def __convert_col_names_to_indices(self, table, col_names):
     col_objs = table.getHeaders()
@@ -371,100 +610,219 @@ class ProxyCore(object):
     return col_numbers
 
   def get_table_rows(self, table_name, selector, col_names=None,
-                     batch_size=BATCH_SIZE):
+                     batch_size=BATCH_SIZE, columnar=False, mirror=False):
     """
     selector can be either a selection or a list of selections. In
     the latter case, it is interpreted as an 'or' condition between
     the list elements.
+
+    If columnar is True, return a dictionary that maps column names
+    to numpy arrays rather than a numpy record array.
+
+    If mirror is True and the proxy has a table mirror, the result is
+    read from (or stored to) the local mirror as a read-only
+    memory-mapped array. Only use it for tables that are not updated
+    in place.
     """
     s = self.connect()
-    # try:
-    t = self._get_table(s, table_name)
-    col_numbers = self.__convert_col_names_to_indices(t, col_names)
-    if selector:
-      res = self.__get_table_rows_selected(t, selector, col_numbers,
-                                           batch_size)
-    else:
-      res = self.__get_table_rows_bulk(t, col_numbers, batch_size)
-    # finally:
-    #   self.disconnect()
+    try:
+      t = self._get_table(s, table_name)
+      col_numbers = self.__convert_col_names_to_indices(t, col_names)
+      if mirror and self.table_mirror:
+        res = self.__get_table_rows_mirrored(t, table_name, selector,
+                                             col_numbers, batch_size, columnar)
+      else:
+        res = self.__read_table_rows(t, selector, col_numbers, batch_size,
+                                     columnar)
+    finally:
+      self.disconnect()
     return res
 
   def get_table_rows_by_indices(self, table_name, indices, col_names=None,
-                                batch_size=BATCH_SIZE):
+                                batch_size=BATCH_SIZE, columnar=False):
     """
     indices must be a list of integer values.
     """
     s = self.connect()
-    # try:
-    t = self._get_table(s, table_name)
-    col_numbers = self.__convert_col_names_to_indices(t, col_names)
-    res = self.__get_table_rows_by_indices(t, indices, col_numbers,
-                                           batch_size)
-    # finally:
-    #   self.disconnect()
+    try:
+      t = self._get_table(s, table_name)
+      col_numbers = self.__convert_col_names_to_indices(t, col_names)
+      res = self.__get_table_rows_direct(t, col_numbers, columnar,
+                                         row_numbers=indices)
+      if res is None:
+        res = self.__get_table_rows_slice(t, indices, col_numbers, batch_size,
+                                          columnar)
+    finally:
+      self.disconnect()
     return res
 
-  def __get_table_rows_by_indices(self, table, row_indices, col_numbers,
-                                  batch_size):
-    d = table.slice(col_numbers, row_indices)
-    res = [convert_coordinates_to_np(d)]
-    return np.concatenate(tuple(res)) if res else []
-    
-  def __get_table_rows_selected(self, table, selector, col_numbers, batch_size):
-    res, row_read, max_row = [], 0, table.getNumberOfRows()
-    if isinstance(selector, str):
-      selector = [selector]
-    while row_read < max_row:
-      for s in selector:
-        ids = table.getWhereList(s, {}, row_read, row_read + batch_size, 1)
-        if ids:
-          d = table.slice(col_numbers, ids)
-          res.append(convert_coordinates_to_np(d))
-      row_read += batch_size
-    return np.concatenate(tuple(res)) if res else []
+  def __get_table_rows_mirrored(self, table, table_name, selector,
+                                col_numbers, batch_size, columnar=False):
+    key = (table_name, table.getOriginalFile().id.val,
+           table.getNumberOfRows())
+    data = self.table_mirror.get(*key, selector=selector,
+                                 col_numbers=col_numbers)
+    if data is None:
+      data = self.__read_table_rows(table, selector, col_numbers, batch_size)
+      if not len(data):
+        col_objs = self.__get_col_objs(table, col_numbers)
+        data = np.zeros(0, dtype=convert_to_numpy_record_type(col_objs))
+      data = self.table_mirror.put(*key, data=data, selector=selector,
+                                   col_numbers=col_numbers)
+    if columnar:
+      return dict((k, data[k]) for k in data.dtype.names)
+    return data if len(data) else []
+
+  def __read_table_rows(self, table, selector, col_numbers, batch_size,
+                        columnar=False):
+    res = self.__get_table_rows_direct(table, col_numbers, columnar,
+                                       selector=selector)
+    if res is not None:
+      return res
+    if selector:
+      return self.__get_table_rows_selected(table, selector, col_numbers,
+                                            batch_size, columnar)
+    return self.__get_table_rows_bulk(table, col_numbers, batch_size, columnar)
 
-  def __get_table_rows_bulk(self, table, col_numbers, batch_size=BATCH_SIZE):
-    res, row_read, max_row = [], 0, table.getNumberOfRows()
+  def __open_direct(self, table):
+    if self.direct_reader is None:
+      return None
+    return self.direct_reader.open(table.getOriginalFile().id.val,
+                                   table.getNumberOfRows())
+
+  def __get_table_rows_direct(self, table, col_numbers, columnar=False,
+                              **kwargs):
+    """
+    Read rows from the table's HDF5 file, if it is locally available;
+    return None otherwise, or if the local read fails.
+    """
+    dt = self.__open_direct(table)
+    if dt is None:
+      return None
+    try:
+      record_type = convert_to_numpy_record_type(
+        self.__get_col_objs(table, col_numbers)
+        )
+      return dt.read(record_type, columnar=columnar, **kwargs)
+    except Exception, e:
+      self.logger.warning('direct read failed (%s), falling back to Ice' % e)
+      self.direct_reader.n_fallbacks += 1
+      return None
+    finally:
+      dt.release()
+
+  def __get_table_rows_selected(self, table, selector, col_numbers,
+                                batch_size, columnar=False):
+    plan = SelectionPlan(table, selector, batch_size, logger=self.logger)
+    row_ids = plan.row_ids()
+    buf = TableBuffer(self.__get_col_objs(table, col_numbers), len(row_ids),
+                      columnar)
+    plan.fetch(row_ids, col_numbers, buf.add)
+    plan.log_stats()
+    self.last_selection_stats = plan.stats
+    return buf.result()
+
+  def __get_table_rows_bulk(self, table, col_numbers, batch_size=BATCH_SIZE,
+                            columnar=False):
+    row_read, max_row = 0, table.getNumberOfRows()
+    buf = TableBuffer(self.__get_col_objs(table, col_numbers), max_row,
+                      columnar)
     while row_read < max_row:
       d = table.read(col_numbers, row_read, row_read + batch_size)
       if d:
-        res.append(convert_coordinates_to_np(d))
+        buf.add(d)
       row_read += batch_size
-    return np.concatenate(tuple(res)) if res else []
-
-  def __get_table_rows_slice(self, table, row_numbers, col_numbers, batch_size):
-    res, n_rows, row_read = [], len(row_numbers), 0
+    return buf.result()
+
+  def __get_table_rows_slice(self, table, row_numbers, col_numbers,
+                             batch_size, columnar=False):
+    if isinstance(row_numbers, np.ndarray):
+      row_numbers = row_numbers.tolist()
+    n_rows, row_read = len(row_numbers), 0
+    buf = TableBuffer(self.__get_col_objs(table, col_numbers), n_rows,
+                      columnar)
     while row_read < n_rows:
       ids = row_numbers[row_read:(row_read+batch_size)]
       if ids:
-        d = table.slice(col_numbers, ids)
-        res.append(convert_coordinates_to_np(d))
+        buf.add(table.slice(col_numbers, ids))
       row_read += batch_size
-    return np.concatenate(tuple(res)) if res else []
+    return buf.result()
 
   def get_table_slice(self, table_name, row_numbers, col_names=None,
-                      batch_size=BATCH_SIZE):
+                      batch_size=BATCH_SIZE, columnar=False):
     s = self.connect()
-    # try:
-    t = self._get_table(s, table_name)
-    col_numbers = self.__convert_col_names_to_indices(t, col_names)
-    res = self.__get_table_rows_slice(t, row_numbers, col_numbers, batch_size)
-    # finally:
-    #   self.disconnect()
+    try:
+      t = self._get_table(s, table_name)
+      col_numbers = self.__convert_col_names_to_indices(t, col_names)
+      res = self.__get_table_rows_direct(t, col_numbers, columnar,
+                                         row_numbers=row_numbers)
+      if res is None:
+        res = self.__get_table_rows_slice(t, row_numbers, col_numbers,
+                                          batch_size, columnar)
+    finally:
+      self.disconnect()
     return res
-  
+
+  def get_table_row_ranges(self, table_name, ranges, col_names=None,
+                           batch_size=BATCH_SIZE, columnar=False):
+    """
+    Read the rows in a list of (start, stop) ranges, returned one
+    range after the other into a single preallocated result. Each
+    range is read with a single read call, or batch_size rows at a
+    time if it is longer than that.
+    """
+    s = self.connect()
+    try:
+      t = self._get_table(s, table_name)
+      col_numbers = self.__convert_col_names_to_indices(t, col_names)
+      res = self.__get_table_rows_direct(t, col_numbers, columnar,
+                                         ranges=ranges)
+      if res is None:
+        buf = TableBuffer(self.__get_col_objs(t, col_numbers),
+                          sum(stop - start for start, stop in ranges),
+                          columnar)
+        for start, stop in ranges:
+          for i in xrange(start, stop, batch_size):
+            buf.add(t.read(col_numbers, i, min(stop, i + batch_size)))
+        res = buf.result()
+    finally:
+      self.disconnect()
+    return res
+
+  def __get_col_objs(self, table, col_numbers):
+    col_objs = table.getHeaders()
+    return [col_objs[i] for i in col_numbers]
+
   def get_table_headers(self, table_name):
     col_objs = None
     s = self.connect()
-    # try:
-    t = self._get_table(s, table_name)
-    col_objs = t.getHeaders()
-    # finally:
-    #   self.disconnect()
+    try:
+      t = self._get_table(s, table_name)
+      col_objs = t.getHeaders()
+    finally:
+      self.disconnect()
     if col_objs:
       return convert_to_numpy_record_type(col_objs)
 
+  def get_table_descriptions(self, table_name):
+    """
+    Return a dictionary that maps the column names of a table to
+    their descriptions.
+    """
+    s = self.connect()
+    try:
+      t = self._get_table(s, table_name)
+      return dict((c.name, c.description) for c in t.getHeaders())
+    finally:
+      self.disconnect()
+
+  def get_table_n_rows(self, table_name):
+    s = self.connect()
+    try:
+      return self._get_table(s, table_name).getNumberOfRows()
+    finally:
+      self.disconnect()
+
   def add_table_row(self, table_name, row):
     if hasattr(row, 'dtype'):
       dtype = row.dtype
@@ -472,12 +830,27 @@ class ProxyCore(object):
     return self.add_table_rows_from_stream(table_name, iter([row]), 10)
 
   def add_table_rows(self, table_name, rows, batch_size=BATCH_SIZE):
-    dtype = rows.dtype
-    def stream(rows):
-      for r in rows:
-        yield dict([(k, convert_from_numpy(r[k])) for k in dtype.names])
-    return self.add_table_rows_from_stream(table_name, stream(rows),
-                                           batch_size=batch_size)
+    """
+    Append rows to a table and return their indices.
+
+    rows can be either a numpy record array or a dictionary that maps
+    each column name to an array (or list) of values; all columns
+    must have the same length. Values are assigned one column at a
+    time, batch_size rows at a time.
+    """
+    if hasattr(rows, 'dtype'):
+      names, n_rows = rows.dtype.names, len(rows)
+    else:
+      names = rows.keys()
+      lengths = set(len(rows[k]) for k in names)
+      if len(lengths) > 1:
+        raise ValueError('columns must have the same length')
+      n_rows = lengths.pop() if lengths else 0
+    def column_batches():
+      for i in xrange(0, n_rows, batch_size):
+        yield dict((k, rows[k][i:i+batch_size]) for k in names)
+    return self.__extend_table(table_name, self.__load_column_batch,
+                               column_batches(), batch_size=batch_size)
 
   def add_table_rows_from_stream(self, table_name, stream,
                                  batch_size=BATCH_SIZE):
@@ -488,21 +861,20 @@ class ProxyCore(object):
                      batch_size=BATCH_SIZE):
     s = self.connect()
     indices = []
-    # try:
-    t = self._get_table(s, table_name)
-    col_objs = t.getHeaders()
-    batch = batch_loader(records_stream, col_objs, batch_size)
-    # First index of the new batch of rows is the number of rows
-    # already stored into the table
-    first_index = t.getNumberOfRows()
-    while batch:
-      t.addData(batch)
-      indices.extend(range(first_index, t.getNumberOfRows()))
+    try:
+      t = self._get_table(s, table_name)
       col_objs = t.getHeaders()
-      batch = batch_loader(records_stream, col_objs, batch_size)
+      # First index of the new batch of rows is the number of rows
+      # already stored into the table
       first_index = t.getNumberOfRows()
-    # finally:
-    #   self.disconnect()
+      n = batch_loader(records_stream, col_objs, batch_size)
+      while n:
+        t.addData(col_objs)
+        indices.extend(xrange(first_index, first_index + n))
+        first_index += n
+        n = batch_loader(records_stream, col_objs, batch_size)
+    finally:
+      self.disconnect()
     return indices
 
   def __load_batch(self, records_stream, col_objs, chunk_size):
@@ -511,52 +883,105 @@ class ProxyCore(object):
       for k, x in r.iteritems():
         v.setdefault(k, []).append(x)
     if len(v) == 0:
-      return None
+      return 0
     for o in col_objs:
       o.values = v[o.name]
-    return col_objs
+    return len(col_objs[0].values)
+
+  def __load_column_batch(self, batches, col_objs, chunk_size):
+    try:
+      batch = batches.next()
+    except StopIteration:
+      return 0
+    for o in col_objs:
+      try:
+        values = batch[o.name]
+      except (KeyError, ValueError):
+        raise ValueError('missing values for column %s' % o.name)
+      o.values = values.tolist() if hasattr(values, 'tolist') else values
+    return len(col_objs[0].values)
 
   def update_table_row(self, table_name, selector, row):
     s = self.connect()
-    # try:
-    t = self._get_table(s, table_name)
-    idxs = t.getWhereList(selector, {}, 0, t.getNumberOfRows(), 1)
-    self.logger.debug('\tselector %s results in %s' % (selector, idxs))
-    if not len(idxs) == 1:
-      raise ValueError('selector %s does not yield a single row' % selector)
-    self.logger.debug('\tselected idx: %s' % idxs)
-    data = t.readCoordinates(idxs)
-    self.__update_data_contents(data, row)
-    t.update(data)
-    # finally:
-    #   self.disconnect()
+    try:
+      t = self._get_table(s, table_name)
+      idxs = t.getWhereList(selector, {}, 0, t.getNumberOfRows(), 1)
+      self.logger.debug('\tselector %s results in %s' % (selector, idxs))
+      if not len(idxs) == 1:
+        raise ValueError('selector %s does not yield a single row' % selector)
+      self.logger.debug('\tselected idx: %s' % idxs)
+      data = t.readCoordinates(idxs)
+      self.__update_data_contents(data, row)
+      t.update(data)
+      if self.table_mirror:
+        self.table_mirror.purge(table_name)
+    finally:
+      self.disconnect()
 
   def update_table_rows(self, table_name, selector, update_items):
+    """
+    Set columns to constant values on all rows matching selector.
+    update_items maps column names to the new values.
+    """
+    return self.update_table_columns(table_name, selector, update_items)
+
+  def update_table_columns(self, table_name, rows, values,
+                           batch_size=BATCH_SIZE):
+    """
+    Bulk update of one or more columns of a table.
+
+    rows can be either a sequence of row indices or a selector (see
+    get_table_rows); in the latter case, matching rows are taken in
+    table order. values maps column names to either an array of
+    len(rows) new values or a single value to be assigned to all
+    rows. Rows are updated batch_size at a time, with one read and
+    one update call per batch. Returns the number of updated rows.
+    """
+    if not values:
+      return 0
     s = self.connect()
-    # try:
-    t = self._get_table(s, table_name)
-    idxs = t.getWhereList(selector, {}, 0, t.getNumberOfRows(), 1)
-    self.logger.debug('\tselector %s results in %s' % (selector, idxs))
-    if len(idxs) == 0:
-      self.logger.debug('\tno rows to update') 
-      return
-    data = t.readCoordinates(idxs)
-    cols = [c.name for c in data.columns]
-    for x in update_items.keys():
-      if x not in cols:
-        raise ValueError('%s is not a valid field for table %s' % (x, table_name))
-    for dc in data.columns:
-      if dc.name in update_items.keys():
-        for x in range(0, len(dc.values)):
-          self.logger.debug('\tcolumn :%s  -> setting value to %s (old value %s)' % (dc.name,
-                                                                                     update_items[dc.name],
-                                                                                     dc.values[x]))
-          dc.values[x] = update_items[dc.name]
-    self.logger.debug('\trecords have been modified')
-    t.update(data)
-    self.logger.debug('\tdata update complete')
-    # finally:
-    #   self.disconnect()
+    try:
+      t = self._get_table(s, table_name)
+      cols = [c.name for c in t.getHeaders()]
+      for x in values.keys():
+        if x not in cols:
+          raise ValueError('%s is not a valid field for table %s' %
+                           (x, table_name))
+      col_numbers = self.__convert_col_names_to_indices(t, values.keys())
+      if isinstance(rows, basestring) or \
+         isinstance(rows, list) and rows and isinstance(rows[0], basestring):
+        plan = SelectionPlan(t, rows, batch_size, logger=self.logger)
+        row_ids = plan.row_ids()
+      else:
+        row_ids = np.asarray(rows, dtype=np.int64)
+      n_rows = len(row_ids)
+      for k, v in values.iteritems():
+        if hasattr(v, '__len__') and not isinstance(v, basestring) and \
+           len(v) != n_rows:
+          raise ValueError('%d values for column %s, expected %d' %
+                           (len(v), k, n_rows))
+      for i in xrange(0, n_rows, batch_size):
+        ids = row_ids[i:i+batch_size].tolist()
+        # unlike readCoordinates, slice reads only the columns being
+        # updated; update writes back the columns present in data at
+        # data.rowNumbers, which we set explicitly to the rows we read
+        data = t.slice(col_numbers, ids)
+        data.rowNumbers = ids
+        for dc in data.columns:
+          v = values[dc.name]
+          if hasattr(v, '__len__') and not isinstance(v, basestring):
+            v = v[i:i+batch_size]
+            dc.values = v.tolist() if hasattr(v, 'tolist') else list(v)
+          else:
+            dc.values = [v] * len(ids)
+        t.update(data)
+      if self.table_mirror:
+        self.table_mirror.purge(table_name)
+      self.logger.debug('updated %d rows (%d columns) of %s' %
+                        (n_rows, len(col_numbers), table_name))
+    finally:
+      self.disconnect()
+    return n_rows
 
   def __update_data_contents(self, data, row):
     assert len(data.rowNumbers) == 1
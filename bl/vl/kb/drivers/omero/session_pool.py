@@ -0,0 +1,383 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+"""
+OMERO session pool
+==================
+
+A bounded set of OMERO sessions shared by the threads of a single
+:class:`~bl.vl.kb.drivers.omero.proxy_core.ProxyCore` instance.
+
+Each thread checks out its own session, so concurrent queries never
+share an ``omero.client``. A session is recycled (closed and replaced
+by a fresh one) after a configurable number of operations or seconds:
+since the only way of forcing the server-side Java garbage collector
+to release the memory associated with a session is closing it, this
+keeps long running jobs from degrading while avoiding the cost of a
+``createSession`` + ``setSecurityContext`` round trip per operation.
+
+A session that is still pinned (e.g., by a table iterator) when its
+thread checks it in is only given back to the pool on its last
+unpin. Sessions bound to threads that exited without checking them in
+are reclaimed when the pool runs out of sessions.
+"""
+
+import time, threading, weakref
+from collections import Counter
+from contextlib import contextmanager
+
+import omero
+
+import bl.vl.kb as kb
+from bl.vl.utils import get_logger
+
+
+RECLAIM_POLL_SECS = 1.0
+DEFAULT_SIZE = 4
+DEFAULT_CHECKOUT_TIMEOUT = 60.0
+
+
+class PooledSession(object):
+  """
+  An OMERO session together with its bookkeeping information.
+  """
+  def __init__(self, client, session, generation):
+    self.client = client
+    self.session = session
+    self.generation = generation
+    self.created = time.time()
+    self.n_operations = 0
+    self.tokens = 0
+    # nesting level of the operations running on the session
+    self.depth = 0
+    self.pins = 0
+    # weak reference to the thread the session is bound to
+    self.owner = None
+    # checked in while pinned: give back to the pool on last unpin
+    self.released = False
+    # resources bound to the session, e.g., open tables
+    self.tables = None
+
+  @property
+  def age(self):
+    return time.time() - self.created
+
+  def close(self):
+    try:
+      self.client.closeSession()
+    except Exception:
+      pass
+
+
+class SessionPool(object):
+  """
+  A thread-aware pool of at most ``size`` OMERO sessions.
+
+  :param max_operations: recycle a session after it has served this
+    many operations (None means never)
+  :type max_operations: int
+
+  :param max_age: recycle a session after this many seconds (None
+    means never)
+  :type max_age: float
+
+  :param keepalive_secs: if set, each session pings the server at
+    this interval so that it is not reaped while idle
+  :type keepalive_secs: int
+
+  :param checkout_timeout: how long, in seconds, a thread waits for a
+    free session when all of them are checked out (None means forever)
+  :type checkout_timeout: float
+  """
+  def __init__(self, host, user, passwd, group_name=None, size=DEFAULT_SIZE,
+               max_operations=None, max_age=None, keepalive_secs=None,
+               checkout_timeout=DEFAULT_CHECKOUT_TIMEOUT, logger=None):
+    if size < 1:
+      raise ValueError('pool size must be a positive integer')
+    self.host = host
+    self.user = user
+    self.passwd = passwd
+    self.group_name = group_name
+    self.size = size
+    self.max_operations = max_operations
+    self.max_age = max_age
+    self.keepalive_secs = keepalive_secs
+    self.checkout_timeout = checkout_timeout
+    self.logger = logger or get_logger('bl.vl.kb.drivers.omero.session_pool')
+    self.counters = Counter()
+    self.__cond = threading.Condition()
+    self.__local = threading.local()
+    self.__idle = []
+    self.__sessions = set()
+    self.__n_sessions = 0
+    self.__generation = 0
+    self.__recycle_listeners = []
+
+  def add_recycle_listener(self, callback):
+    """
+    Register a callable that will be invoked with the
+    :class:`PooledSession` about to be closed, e.g., to drop any
+    resource bound to it.
+    """
+    self.__recycle_listeners.append(callback)
+
+  def set_group(self, group_name):
+    """
+    Switch to a new security context. Sessions opened with the old
+    one are recycled the next time they are checked out.
+    """
+    with self.__cond:
+      self.group_name = group_name
+      self.__generation += 1
+
+  def current(self):
+    """
+    Return the :class:`PooledSession` bound to the calling thread, or
+    None.
+    """
+    return getattr(self.__local, 'session', None)
+
+  def checkout(self):
+    """
+    Return the :class:`PooledSession` bound to the calling thread,
+    binding a new one if needed.
+    """
+    ps = self.current()
+    if ps is None:
+      ps = self.__bind(self.__acquire())
+    elif self.__must_recycle(ps):
+      old, ps = ps, self.__bind(self.__recycle(ps))
+      # the new session takes over the caller's bookkeeping
+      ps.tokens, ps.depth = old.tokens, old.depth
+    else:
+      self.__count('reused')
+    ps.n_operations += 1
+    return ps
+
+  def checkin(self):
+    """
+    Unbind the calling thread's session and give it back to the pool.
+    """
+    ps = self.current()
+    if ps is None:
+      return
+    self.__local.session = None
+    with self.__cond:
+      ps.owner = None
+      if ps.pins > 0:
+        # still in use, e.g., by a table iterator
+        ps.released = True
+        return
+    self.__release(ps)
+
+  def pin(self):
+    """
+    Prevent the calling thread's session from being recycled, e.g.,
+    while a table proxy opened on it is in use, until :meth:`unpin`
+    is called on the returned :class:`PooledSession`.
+    """
+    ps = self.current() or self.checkout()
+    with self.__cond:
+      ps.pins += 1
+    return ps
+
+  def unpin(self, ps):
+    with self.__cond:
+      ps.pins = max(0, ps.pins - 1)
+      release = ps.released and ps.pins == 0
+      if release:
+        ps.released = False
+    if release:
+      self.__release(ps)
+
+  @contextmanager
+  def pinned(self):
+    """
+    Context manager version of :meth:`pin`.
+    """
+    ps = self.pin()
+    try:
+      yield ps
+    finally:
+      self.unpin(ps)
+
+  def sessions(self):
+    """
+    Return a list of all open :class:`PooledSession` objects.
+    """
+    with self.__cond:
+      return list(self.__sessions)
+
+  def close(self):
+    """
+    Close all sessions, including those still bound to a thread.
+    """
+    with self.__cond:
+      sessions = list(self.__sessions)
+      self.__sessions.clear()
+      self.__idle = []
+      self.__n_sessions = 0
+      self.__cond.notify_all()
+    for ps in sessions:
+      self.__notify_recycle(ps)
+      ps.close()
+      self.__count('closed')
+    self.__local = threading.local()
+
+  def stats(self):
+    """
+    Return a dictionary with session usage counters.
+    """
+    with self.__cond:
+      stats = {
+        'size': self.size,
+        'open': self.__n_sessions,
+        'idle': len(self.__idle),
+        }
+      for k in 'created', 'reused', 'recycled', 'closed', 'reclaimed':
+        stats[k] = self.counters[k]
+    return stats
+
+  def __count(self, key):
+    with self.__cond:
+      self.counters[key] += 1
+
+  def __bind(self, ps):
+    with self.__cond:
+      ps.owner = weakref.ref(threading.current_thread())
+    self.__local.session = ps
+    return ps
+
+  def __release(self, ps):
+    with self.__cond:
+      if ps not in self.__sessions:  # the pool has been closed
+        return
+    if self.__must_recycle(ps):
+      self.__discard(ps)
+      with self.__cond:
+        self.counters['recycled'] += 1
+        self.__n_sessions -= 1
+        self.__cond.notify()
+      return
+    with self.__cond:
+      self.__idle.append(ps)
+      self.__cond.notify()
+
+  def __reclaim_dead(self):
+    # called with self.__cond held: make the sessions of threads that
+    # exited without checking them in available again
+    reclaimed = False
+    for ps in self.__sessions:
+      if ps.owner is None:
+        continue
+      thread = ps.owner()
+      if thread is not None and thread.is_alive():
+        continue
+      ps.owner = None
+      self.counters['reclaimed'] += 1
+      if ps.pins > 0:
+        ps.released = True
+      else:
+        self.__idle.append(ps)
+        reclaimed = True
+    return reclaimed
+
+  def __must_recycle(self, ps):
+    if ps.pins > 0:
+      return False
+    if ps.generation != self.__generation:
+      return True
+    if self.max_operations and ps.n_operations >= self.max_operations:
+      return True
+    if self.max_age and ps.age >= self.max_age:
+      return True
+    return False
+
+  def __create(self):
+    client = omero.client(self.host)
+    try:
+      session = client.createSession(self.user, self.passwd)
+      if self.group_name:
+        a = session.getAdminService()
+        try:
+          g = a.lookupGroup(self.group_name)
+          session.setSecurityContext(g)
+        except omero.ApiUsageException, aue:
+          raise ValueError(aue.message)
+      if self.keepalive_secs:
+        client.enableKeepAlive(self.keepalive_secs)
+    except:
+      try:
+        client.closeSession()
+      except Exception:
+        pass
+      raise
+    ps = PooledSession(client, session, self.__generation)
+    with self.__cond:
+      self.__sessions.add(ps)
+      self.counters['created'] += 1
+      n_created = self.counters['created']
+    self.logger.debug('created session #%d' % n_created)
+    return ps
+
+  def __discard(self, ps):
+    self.__notify_recycle(ps)
+    ps.close()
+    with self.__cond:
+      self.__sessions.discard(ps)
+
+  def __notify_recycle(self, ps):
+    for callback in self.__recycle_listeners:
+      try:
+        callback(ps)
+      except Exception, e:
+        self.logger.warning('recycle listener failed: %s' % e)
+
+  def __recycle(self, ps):
+    self.logger.debug('recycling session (%d operations, %.1f s)' %
+                      (ps.n_operations, ps.age))
+    self.__discard(ps)
+    self.__count('recycled')
+    try:
+      return self.__create()
+    except:
+      with self.__cond:
+        self.__n_sessions -= 1
+        self.__cond.notify()
+      raise
+
+  def __acquire(self):
+    deadline = (None if self.checkout_timeout is None
+                else time.time() + self.checkout_timeout)
+    with self.__cond:
+      while True:
+        if self.__idle:
+          ps = self.__idle.pop()
+          break
+        if self.__n_sessions < self.size:
+          self.__n_sessions += 1
+          ps = None
+          break
+        if self.__reclaim_dead():
+          continue
+        # wake up periodically, since thread exits are not notified
+        if deadline is None:
+          self.__cond.wait(RECLAIM_POLL_SECS)
+        else:
+          remaining = deadline - time.time()
+          if remaining <= 0:
+            raise kb.KBError('no OMERO session available after %.1f s' %
+                             self.checkout_timeout)
+          self.__cond.wait(min(remaining, RECLAIM_POLL_SECS))
+    if ps is None:
+      try:
+        return self.__create()
+      except:
+        with self.__cond:
+          self.__n_sessions -= 1
+          self.__cond.notify()
+        raise
+    if self.__must_recycle(ps):
+      return self.__recycle(ps)
+    self.__count('reused')
+    return ps
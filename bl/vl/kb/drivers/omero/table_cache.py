@@ -0,0 +1,150 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+"""
+Per-session table handle cache
+==============================
+
+Opening a KB table costs a ``findByString('OriginalFile', ...)``
+query plus an ``openTable`` call, and most table helpers then ask for
+the column headers. :class:`TableCache` keeps, for a single OMERO
+session, the most recently used open tables together with their
+headers and OriginalFile, so that repeated accesses to the same table
+(e.g., per-sample GDO reads) pay none of these round trips.
+
+Handles must be invalidated when the table is deleted; invalidated
+handles are closed right away, so that the server can release them
+(errors from tables that are already gone are ignored). Handles
+evicted to make room for new ones are closed, unless they are in use
+by a long-running reader (see :meth:`CachedTable.acquire`), in which
+case they are closed when the last user releases them. All cached
+handles are closed by :meth:`TableCache.clear`, which should be
+called when the session is closed.
+"""
+
+import threading, copy
+from collections import OrderedDict
+
+
+MAX_OPEN_TABLES = 32
+
+
+class CachedTable(object):
+  """
+  An open table proxy whose headers and OriginalFile, which do not
+  change while the table is open, are only fetched once. All other
+  calls are forwarded to the proxy.
+  """
+  def __init__(self, table):
+    self.table = table
+    self.__headers = None
+    self.__ofile = None
+    self.__lock = threading.Lock()
+    self.__users = 0
+    self.__retired = False
+
+  def getHeaders(self):
+    if self.__headers is None:
+      self.__headers = self.table.getHeaders()
+    # callers fill the returned column objects with data to be written
+    return [copy.copy(c) for c in self.__headers]
+
+  def getOriginalFile(self):
+    if self.__ofile is None:
+      self.__ofile = self.table.getOriginalFile()
+    return self.__ofile
+
+  def __getattr__(self, name):
+    return getattr(self.table, name)
+
+  def acquire(self):
+    """
+    Mark the table as in use, so that it is not closed on eviction.
+    """
+    with self.__lock:
+      self.__users += 1
+
+  def release(self):
+    with self.__lock:
+      self.__users -= 1
+      close = self.__retired and self.__users == 0
+    if close:
+      self.close()
+
+  def retire(self):
+    """
+    Close the table now if it is not in use, else on last release.
+    """
+    with self.__lock:
+      self.__retired = True
+      close = self.__users == 0
+    if close:
+      self.close()
+
+  def close(self):
+    # the table may be gone already, e.g., after a delete
+    try:
+      self.table.close()
+    except Exception:
+      pass
+
+
+class TableCache(object):
+  """
+  An LRU map from table names to the :class:`CachedTable` objects
+  opened on a single session.
+  """
+  def __init__(self, max_size=MAX_OPEN_TABLES):
+    self.max_size = max_size
+    self.__lock = threading.Lock()
+    self.__tables = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, table_name):
+    with self.__lock:
+      t = self.__tables.pop(table_name, None)
+      if t is None:
+        self.misses += 1
+        return None
+      self.__tables[table_name] = t
+      self.hits += 1
+      return t
+
+  def put(self, table_name, table):
+    """
+    Cache an open table; return the :class:`CachedTable` wrapping it.
+    """
+    t = CachedTable(table)
+    evicted = []
+    with self.__lock:
+      self.__tables.pop(table_name, None)
+      self.__tables[table_name] = t
+      while len(self.__tables) > self.max_size:
+        evicted.append(self.__tables.popitem(last=False)[1])
+    for e in evicted:
+      e.retire()
+    return t
+
+  def invalidate(self, table_name):
+    with self.__lock:
+      t = self.__tables.pop(table_name, None)
+    if t is not None:
+      t.close()
+
+  def stats(self):
+    return {'size': len(self.__tables), 'hits': self.hits,
+            'misses': self.misses}
+
+  def clear(self):
+    with self.__lock:
+      tables = self.__tables.values()
+      self.__tables.clear()
+    for t in tables:
+      t.close()
+
+  def __len__(self):
+    return len(self.__tables)
+
+  def __contains__(self, table_name):
+    return table_name in self.__tables
@@ -0,0 +1,132 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+"""
+Prefetching table row iterator
+==============================
+
+:class:`PrefetchingReader` iterates over the rows of a table while a
+worker thread reads the following batches into a bounded queue, so
+that network latency overlaps with the consumer's processing.
+"""
+
+import threading, Queue, sys
+
+import numpy as np
+
+
+PREFETCH_BATCHES = 2
+TARGET_BATCH_BYTES = 8 * 2**20
+MAX_BATCH_ROWS = 5000
+QUEUE_POLL_SECS = 0.5
+
+_END = object()
+
+
+def auto_batch_size(record_type, target_bytes=TARGET_BATCH_BYTES,
+                    max_rows=MAX_BATCH_ROWS):
+  """
+  Return the number of rows of the given type that fit in
+  ``target_bytes``, capped at ``max_rows``: a batch of GDO rows (tens
+  of MB each) holds a single row, while one of EAV rows holds
+  thousands.
+  """
+  row_size = np.dtype(record_type).itemsize
+  return int(max(1, min(max_rows, target_bytes // max(1, row_size))))
+
+
+def _put(queue, stop, item):
+  while not stop.is_set():
+    try:
+      queue.put(item, timeout=QUEUE_POLL_SECS)
+      return True
+    except Queue.Full:
+      pass
+  return False
+
+
+def _fill(read_batch, n_rows, batch_size, queue, stop, on_close):
+  try:
+    for i in xrange(0, n_rows, batch_size):
+      j = min(n_rows, i + batch_size)
+      if not _put(queue, stop, read_batch(i, j)):
+        return
+    _put(queue, stop, _END)
+  except Exception:
+    _put(queue, stop, sys.exc_info())
+  finally:
+    # only release resources once no read is in flight
+    if on_close:
+      on_close()
+
+
+class PrefetchingReader(object):
+  """
+  Iterate over the rows (or, if ``yield_batches`` is True, over
+  batches of rows) of a table with ``n_rows`` rows.
+
+  ``read_batch(i, j)`` must return rows ``i`` to ``j`` (excluded) as
+  a numpy record array; it is called by a worker thread that keeps up
+  to ``prefetch`` batches ready. ``on_close``, if given, is called
+  once by the worker thread, after its last ``read_batch`` call,
+  i.e., when all rows have been read or, after the reader has been
+  closed or discarded, as soon as the read in progress completes.
+  """
+  def __init__(self, read_batch, n_rows, batch_size,
+               prefetch=PREFETCH_BATCHES, yield_batches=False,
+               on_close=None):
+    self.read_batch = read_batch
+    self.n_rows = n_rows
+    self.batch_size = batch_size
+    self.yield_batches = yield_batches
+    self.on_close = on_close
+    self.__queue = Queue.Queue(maxsize=max(1, prefetch))
+    self.__stop = threading.Event()
+    self.__batch = None
+    self.__pos = 0
+    self.__closed = False
+    # the worker must not reference self, or the reader would never
+    # be garbage collected while the worker is alive
+    self.__worker = threading.Thread(
+      target=_fill, args=(read_batch, n_rows, batch_size, self.__queue,
+                          self.__stop, on_close)
+      )
+    self.__worker.daemon = True
+    self.__worker.start()
+
+  def __iter__(self):
+    return self
+
+  def __next_batch(self):
+    if self.__closed:
+      raise StopIteration
+    item = self.__queue.get()
+    if item is _END:
+      self.close()
+      raise StopIteration
+    if isinstance(item, tuple):
+      self.close()
+      raise item[0], item[1], item[2]
+    return item
+
+  def next(self):
+    if self.yield_batches:
+      return self.__next_batch()
+    while self.__batch is None or self.__pos >= len(self.__batch):
+      self.__batch, self.__pos = self.__next_batch(), 0
+    r = self.__batch[self.__pos]
+    self.__pos += 1
+    return r
+
+  def close(self):
+    if self.__closed:
+      return
+    self.__closed = True
+    self.__stop.set()
+    # the worker calls on_close: wait for it, but do not block on a
+    # read that takes long to complete
+    if threading.current_thread() is not self.__worker:
+      self.__worker.join(2 * QUEUE_POLL_SECS)
+
+  def __del__(self):
+    self.close()
@@ -0,0 +1,174 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+"""
+Local table mirror
+==================
+
+Some KB tables, most notably the ``mset-*`` and ``align-*`` marker set
+tables, are practically never modified once written, but are read in
+full (millions of rows) by most genotype handling tools.
+:class:`TableMirror` keeps a copy of such reads on the local disk as
+``.npy`` files that are then mapped back in memory without copying.
+
+An entry is keyed by table name, OriginalFile id and number of rows
+(plus the selector and column list of the read), so recreating or
+extending a table automatically invalidates its mirrored copies; the
+check only costs the ``getNumberOfRows`` call needed to open the
+table anyway. Least recently used entries are removed when the total
+size exceeds the disk quota.
+"""
+
+import os, hashlib, shutil
+
+import numpy as np
+
+from bl.vl.utils import get_logger
+
+
+DEFAULT_QUOTA = 4 * 2**30
+SUFFIX = '.npy'
+
+
+class TableMirror(object):
+  """
+  An on-disk cache of table reads rooted at ``root``.
+
+  :param quota: maximum total size, in bytes, of the mirrored data
+    (None means no limit)
+  :type quota: int
+  """
+  def __init__(self, root, quota=DEFAULT_QUOTA, logger=None):
+    self.root = os.path.abspath(root)
+    self.quota = quota
+    self.logger = logger or get_logger('bl.vl.kb.drivers.omero.table_mirror')
+    self.counters = dict.fromkeys(['hits', 'misses', 'stores', 'evictions'],
+                                  0)
+    if not os.path.isdir(self.root):
+      os.makedirs(self.root)
+
+  def __table_dir(self, table_name):
+    return os.path.join(self.root, table_name.replace(os.sep, '_'))
+
+  def __version(self, ofile_id, n_rows):
+    return '%d-%d-' % (ofile_id, n_rows)
+
+  def path(self, table_name, ofile_id, n_rows, selector=None,
+           col_numbers=None):
+    """
+    Return the path of the file that mirrors the given read.
+    """
+    digest = hashlib.sha1(repr((selector, col_numbers))).hexdigest()
+    return os.path.join(self.__table_dir(table_name), '%s%s%s' % (
+      self.__version(ofile_id, n_rows), digest[:16], SUFFIX
+      ))
+
+  def get(self, table_name, ofile_id, n_rows, selector=None,
+          col_numbers=None):
+    """
+    Return the mirrored read as a read-only memory-mapped record
+    array, or None if it is not available.
+    """
+    path = self.path(table_name, ofile_id, n_rows, selector, col_numbers)
+    try:
+      data = np.load(path, mmap_mode='r')
+    except (IOError, OSError):
+      self.counters['misses'] += 1
+      return None
+    except ValueError:
+      self.logger.warning('removing corrupted mirror file %s' % path)
+      self.__remove(path)
+      self.counters['misses'] += 1
+      return None
+    try:
+      os.utime(path, None)
+    except OSError:
+      pass
+    self.counters['hits'] += 1
+    return data
+
+  def put(self, table_name, ofile_id, n_rows, data, selector=None,
+          col_numbers=None):
+    """
+    Store a read (a numpy record array) and return its memory-mapped
+    copy. Mirrored reads of other versions of the same table are
+    removed.
+    """
+    path = self.path(table_name, ofile_id, n_rows, selector, col_numbers)
+    d = os.path.dirname(path)
+    if not os.path.isdir(d):
+      try:
+        os.makedirs(d)
+      except OSError:
+        if not os.path.isdir(d):
+          raise
+    self.__remove_stale(d, self.__version(ofile_id, n_rows))
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    try:
+      with open(tmp_path, 'wb') as f:
+        np.save(f, data)
+      os.rename(tmp_path, path)
+    except:
+      self.__remove(tmp_path)
+      raise
+    self.counters['stores'] += 1
+    self.logger.debug('mirrored %d rows of %s (%d bytes)' %
+                      (len(data), table_name, os.path.getsize(path)))
+    self.__enforce_quota(keep=path)
+    return np.load(path, mmap_mode='r')
+
+  def purge(self, table_name):
+    """
+    Remove all mirrored reads of the given table.
+    """
+    shutil.rmtree(self.__table_dir(table_name), ignore_errors=True)
+
+  def clear(self):
+    for name in os.listdir(self.root):
+      shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+
+  def size(self):
+    return sum(s for _, s, _ in self.__entries())
+
+  def stats(self):
+    stats = dict(self.counters)
+    stats['bytes'] = self.size()
+    return stats
+
+  def __remove(self, path):
+    try:
+      os.remove(path)
+    except OSError:
+      pass
+
+  def __remove_stale(self, table_dir, version):
+    for name in os.listdir(table_dir):
+      if name.endswith(SUFFIX) and not name.startswith(version):
+        self.__remove(os.path.join(table_dir, name))
+
+  def __entries(self):
+    for dirpath, _, filenames in os.walk(self.root):
+      for name in filenames:
+        if not name.endswith(SUFFIX):
+          continue
+        path = os.path.join(dirpath, name)
+        try:
+          st = os.stat(path)
+        except OSError:
+          continue
+        yield path, st.st_size, st.st_mtime
+
+  def __enforce_quota(self, keep=None):
+    if self.quota is None:
+      return
+    entries = sorted(self.__entries(), key=lambda e: e[2])
+    total = sum(e[1] for e in entries)
+    for path, size, _ in entries:
+      if total <= self.quota:
+        break
+      if path == keep:
+        continue
+      # files already mapped by a reader stay readable until unmapped
+      self.__remove(path)
+      total -= size
+      self.counters['evictions'] += 1
@@ -0,0 +1,139 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+"""
+Selector-based table reads
+==========================
+
+A selector is either a single PyTables condition string or a list of
+them, interpreted as an 'or' between the list elements.
+:class:`SelectionPlan` runs such a read in two phases:
+
+#. scan: OR-selectors are merged into as few server-side conditions
+   as possible, and the matching row ids are collected, over large
+   windows, into a single sorted, duplicate-free array;
+
+#. fetch: the requested columns for those rows are read with a few
+   large ``slice`` calls.
+"""
+
+import time
+
+import numpy as np
+
+import omero
+
+
+SCAN_SIZE = 1000000
+MAX_MERGED_TERMS = 64
+MAX_CONDITION_LENGTH = 8192
+
+
+def group_selectors(selector, max_terms=MAX_MERGED_TERMS,
+                    max_length=MAX_CONDITION_LENGTH):
+  """
+  Split a list of OR-selectors into groups of at most ``max_terms``
+  terms and ``max_length`` characters.
+  """
+  if isinstance(selector, basestring):
+    return [[selector]]
+  groups, group, length = [], [], 0
+  for s in selector:
+    if group and (len(group) >= max_terms or
+                  length + len(s) + 5 > max_length):
+      groups.append(group)
+      group, length = [], 0
+    group.append(s)
+    length += len(s) + 5
+  if group:
+    groups.append(group)
+  return groups
+
+
+def merge_selectors(terms):
+  """
+  Merge OR-selector terms into a single condition.
+  """
+  if len(terms) == 1:
+    return terms[0]
+  return '|'.join('(%s)' % s for s in terms)
+
+
+class SelectionPlan(object):
+  """
+  A selector-based read on an open OMERO table.
+  """
+  def __init__(self, table, selector, batch_size, scan_size=SCAN_SIZE,
+               logger=None):
+    self.table = table
+    self.selector = selector
+    self.batch_size = batch_size
+    self.scan_size = max(scan_size, batch_size)
+    self.logger = logger
+    self.groups = group_selectors(selector)
+    self.split_groups = set()
+    self.stats = {
+      'n_conditions': len(self.groups),
+      'n_scans': 0,
+      'n_slices': 0,
+      'n_rows': 0,
+      'scan_time': 0.0,
+      'fetch_time': 0.0,
+      }
+
+  def __where(self, condition, start, stop):
+    self.stats['n_scans'] += 1
+    return self.table.getWhereList(condition, {}, start, stop, 1)
+
+  def __scan_window(self, start, stop):
+    ids = []
+    for i, terms in enumerate(self.groups):
+      if i not in self.split_groups:
+        try:
+          ids.extend(self.__where(merge_selectors(terms), start, stop))
+          continue
+        except omero.ServerError:
+          if len(terms) == 1:
+            raise
+          # the merged condition was rejected, fall back to its terms
+          if self.logger:
+            self.logger.debug('merged condition rejected, splitting it')
+          self.split_groups.add(i)
+      for s in terms:
+        ids.extend(self.__where(s, start, stop))
+    return ids
+
+  def row_ids(self):
+    """
+    Return the sorted array of ids of the rows matching the selector.
+    """
+    start_time = time.time()
+    ids, start, n_rows = [], 0, self.table.getNumberOfRows()
+    while start < n_rows:
+      stop = min(n_rows, start + self.scan_size)
+      ids.extend(self.__scan_window(start, stop))
+      start = stop
+    row_ids = np.unique(np.array(ids, dtype=np.int64))
+    self.stats['n_rows'] = row_ids.size
+    self.stats['scan_time'] = time.time() - start_time
+    return row_ids
+
+  def fetch(self, row_ids, col_numbers, consumer):
+    """
+    Read the given rows, ``batch_size`` at a time, passing each
+    resulting ``omero.grid.Data`` object to ``consumer``.
+    """
+    start_time = time.time()
+    for i in xrange(0, len(row_ids), self.batch_size):
+      ids = row_ids[i:i+self.batch_size].tolist()
+      self.stats['n_slices'] += 1
+      consumer(self.table.slice(col_numbers, ids))
+    self.stats['fetch_time'] = time.time() - start_time
+
+  def log_stats(self):
+    if self.logger:
+      self.logger.debug(
+        'selection: %(n_rows)d rows, %(n_conditions)d conditions, '
+        '%(n_scans)d scans in %(scan_time).3f s, '
+        '%(n_slices)d slices in %(fetch_time).3f s' % self.stats
+        )
@@ -1,7 +1,9 @@
 # BEGIN_COPYRIGHT
 # END_COPYRIGHT
 
-import time, os
+import time, os, hashlib
+
+import numpy as np
 
 import bl.vl.utils as vu
 from bl.vl.utils.ome_utils import make_unique_key, time2rtime
@@ -16,3 +18,28 @@ def assign_vid_and_timestamp(conf, time_stamp_field='startDate'):
   conf = assign_vid(conf)
   conf.setdefault(time_stamp_field, time.time())
   return conf
+
+
+def resolve_action_id(kb, action):
+  """
+  Return the id of action, which can be either an Action or an id.
+  """
+  if isinstance(action, kb.Action):
+    if not action.is_loaded():
+      action.reload()
+    return action.id
+  return action
+
+
+def gdo_checksum(probs, confs):
+  """
+  Return the (sha1, size) pair recorded in the DataObject of a GDO
+  with the given probs and confs. Checksums are computed on float32
+  arrays, i.e., on the values that are actually stored.
+  """
+  size = 0
+  sha1 = hashlib.sha1()
+  for a in probs, confs:
+    s = np.ascontiguousarray(a, dtype=np.float32).tostring()
+    size += len(s); sha1.update(s)
+  return sha1.hexdigest(), size
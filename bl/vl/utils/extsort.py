@@ -0,0 +1,112 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+"""
+External merge sort.
+
+Sorts streams of records that do not fit in memory: records are
+buffered up to a memory budget, each full buffer is sorted and
+spilled to a temporary file (a "run"), then runs are combined with a
+k-way merge that holds a single record per run in memory.
+"""
+
+import os, sys, heapq, tempfile, shutil
+import cPickle
+
+DEFAULT_MEMORY_BUDGET = 256 * 2**20  # bytes
+MAX_OPEN_RUNS = 64
+PROGRESS_INTERVAL = 100000
+
+
+def record_size(r):
+  """
+  Rough estimate of the memory footprint of a record.
+  """
+  size = sys.getsizeof(r)
+  values = r.itervalues() if isinstance(r, dict) else r
+  try:
+    return size + sum(sys.getsizeof(v) for v in values)
+  except TypeError:
+    return size
+
+
+def _write_run(records, dirname):
+  fd, fn = tempfile.mkstemp(suffix='.run', dir=dirname)
+  with os.fdopen(fd, 'wb') as f:
+    pickler = cPickle.Pickler(f, cPickle.HIGHEST_PROTOCOL)
+    for r in records:
+      pickler.dump(r)
+      pickler.clear_memo()
+  return fn
+
+
+def _read_run(fn):
+  with open(fn, 'rb') as f:
+    unpickler = cPickle.Unpickler(f)
+    while True:
+      try:
+        yield unpickler.load()
+      except EOFError:
+        break
+
+
+def _merge(runs):
+  # runs hold (key, seq, record) tuples: seq keeps the sort stable
+  # and ensures records themselves are never compared
+  return heapq.merge(*[_read_run(fn) for fn in runs])
+
+
+def external_sort(stream, key, memory_budget=DEFAULT_MEMORY_BUDGET,
+                  tmp_dir=None, progress=None):
+  """
+  Iterate over the records in stream, sorted by key(record).
+
+  At most about ``memory_budget`` bytes worth of records (as
+  estimated by :func:`record_size`) are kept in memory; if the stream
+  does not exceed the budget, it is sorted in memory. Temporary runs
+  are written to a new directory under ``tmp_dir`` and removed when
+  the iteration ends. If set, ``progress`` is called as
+  ``progress(phase, count)``, with phase one of 'read' (records
+  read so far), 'spill' (runs written so far) and 'merge' (records
+  output so far). The sort is stable.
+  """
+  run_dir = None
+  runs = []
+  buf, buf_size = [], 0
+  try:
+    for seq, r in enumerate(stream):
+      buf.append((key(r), seq, r))
+      buf_size += record_size(r)
+      if progress and (seq + 1) % PROGRESS_INTERVAL == 0:
+        progress('read', seq + 1)
+      if buf_size >= memory_budget:
+        if run_dir is None:
+          run_dir = tempfile.mkdtemp(prefix='extsort-', dir=tmp_dir)
+        buf.sort()
+        runs.append(_write_run(buf, run_dir))
+        buf, buf_size = [], 0
+        if progress:
+          progress('spill', len(runs))
+    buf.sort()
+    if not runs:
+      merged = iter(buf)
+    else:
+      if buf:
+        runs.append(_write_run(buf, run_dir))
+      buf = None
+      while len(runs) > MAX_OPEN_RUNS:
+        merged_runs = []
+        for i in xrange(0, len(runs), MAX_OPEN_RUNS):
+          group = runs[i:i+MAX_OPEN_RUNS]
+          merged_runs.append(_write_run(_merge(group), run_dir))
+          for fn in group:
+            os.remove(fn)
+        runs = merged_runs
+      merged = _merge(runs)
+    for n, (_, _, r) in enumerate(merged):
+      yield r
+      if progress and (n + 1) % PROGRESS_INTERVAL == 0:
+        progress('merge', n + 1)
+  finally:
+    if run_dir is not None:
+      shutil.rmtree(run_dir, ignore_errors=True)
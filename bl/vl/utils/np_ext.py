@@ -8,6 +8,97 @@ NumPy extensions.
 import numpy as np
 
 
+class SortedKeys(object):
+  """
+  An array of distinct keys, with the permutation that sorts it.
+
+  Sortedness and uniqueness are checked once, at construction time,
+  so that a SortedKeys object can be reused in any number of
+  :func:`multi_index_intersect` and :func:`multi_index_union` calls.
+  Arrays that are already strictly increasing are used as they are,
+  without sorting or copying.
+  """
+  def __init__(self, a):
+    a = np.asarray(a)
+    if a.ndim != 1:
+      raise ValueError("keys must be a one-dimensional array")
+    if (a[1:] > a[:-1]).all():
+      self.keys, self.order = a, None
+    else:
+      self.order = np.argsort(a, kind='mergesort')
+      self.keys = a[self.order]
+      if (self.keys[1:] == self.keys[:-1]).any():
+        raise ValueError("arrays must contain no duplicate elements")
+
+  def __len__(self):
+    return len(self.keys)
+
+  @property
+  def dtype(self):
+    return self.keys.dtype
+
+  def lookup(self, values):
+    """
+    Return a boolean array that tells which of the given values are
+    in the keys, and the positions of the found values in the
+    original (unsorted) array.
+    """
+    if not len(self.keys):
+      return np.zeros(len(values), dtype=np.bool), np.zeros(0, dtype=np.intp)
+    pos = np.searchsorted(self.keys, values)
+    pos[pos == len(self.keys)] = 0
+    found = self.keys[pos] == values
+    pos = pos[found]
+    return found, pos if self.order is None else self.order[pos]
+
+
+def _sorted_keys(arrays):
+  keys = [a if isinstance(a, SortedKeys) else SortedKeys(a) for a in arrays]
+  if not keys:
+    raise ValueError("no arrays given")
+  if len(set(k.dtype for k in keys)) > 1:
+    raise ValueError("arrays must be of the same type")
+  return keys
+
+
+def multi_index_intersect(arrays):
+  """
+  Find indexes of elements common to all given arrays.
+
+  Each array must contain no duplicate elements and all arrays must
+  have the same dtype; :class:`SortedKeys` objects can be passed
+  instead of arrays to skip sorting and checks. Return a list with,
+  for each array, the indexes of the common elements, in increasing
+  order of element value.
+  """
+  keys = _sorted_keys(arrays)
+  common = min(keys, key=len).keys
+  for k in keys:
+    common = common[k.lookup(common)[0]]
+  return [k.lookup(common)[1] for k in keys]
+
+
+def multi_index_union(arrays):
+  """
+  Find all distinct elements of the given arrays (see
+  :func:`multi_index_intersect` for requirements).
+
+  Return the sorted array of distinct elements and a list with, for
+  each array, the indexes of these elements in the array, or -1 for
+  elements that are not in it.
+  """
+  keys = _sorted_keys(arrays)
+  union = np.unique(np.concatenate([k.keys for k in keys]))
+  indexes = []
+  for k in keys:
+    found, pos = k.lookup(union)
+    idx = np.empty(len(union), dtype=np.intp)
+    idx.fill(-1)
+    idx[found] = pos
+    indexes.append(idx)
+  return union, indexes
+
+
 def index_intersect(a1, a2):
   """
   Find indexes of elements common to arrays a1 and a2.
@@ -16,17 +107,20 @@ def index_intersect(a1, a2):
   elements. Return a tuple of two arrays that contain indexes of
   common elements with respect to a1 and a2.
   """
-  if a1.dtype != a2.dtype:
-    raise ValueError("arrays must be of the same type")
-  for a in a1, a2:
-    if a.size != np.unique(a).size:
-      raise ValueError("arrays must contain no duplicate elements")
-  dtype = np.dtype([('item', a1.dtype), ('idx', np.int32)])
-  b = np.empty(a1.size+a2.size, dtype)
-  b['item'][:a1.size] = a1
-  b['item'][a1.size:] = a2
-  b['idx'][:a1.size] = np.arange(a2.size, a2.size+a1.size)
-  b['idx'][a1.size:] = np.arange(a2.size)
-  b.sort(order='item')
-  mask = b[:-1]['item'] == b[1:]['item']
-  return b[1:][mask]['idx'] - a2.size, b[mask]['idx']
+  return tuple(multi_index_intersect([a1, a2]))
+
+
+def index_ranges(a):
+  """
+  Coalesce a sorted array of distinct integers into contiguous ranges.
+
+  Return a list of (start, stop) tuples such that the concatenation
+  of the corresponding ``xrange(start, stop)`` is equal to a.
+  """
+  a = np.asarray(a)
+  if a.size == 0:
+    return []
+  breaks = np.flatnonzero(np.diff(a) != 1) + 1
+  starts = np.concatenate(([0], breaks))
+  stops = np.concatenate((breaks, [a.size]))
+  return [(int(a[i]), int(a[j-1]) + 1) for i, j in zip(starts, stops)]
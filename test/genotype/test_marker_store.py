@@ -0,0 +1,107 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+import os, unittest, tempfile, shutil
+
+import numpy as np
+
+import bl.vl.genotype.algo as algo
+from bl.vl.genotype import marker_store
+from bl.vl.genotype.marker_store import MarkerMajorStore
+
+
+N_MARKERS = 130
+N_SAMPLES = 11
+
+
+class TestMarkerMajorStore(unittest.TestCase):
+
+  def setUp(self):
+    if marker_store.tables is None:
+      self.skipTest('PyTables not available')
+    self.wd = tempfile.mkdtemp(prefix='bl_vl_')
+    self.path = os.path.join(self.wd, 'mstore.h5')
+    self.probs = np.random.random(
+      (N_SAMPLES, 2, N_MARKERS)).astype(np.float32)
+    self.probs /= self.probs.sum(axis=1)[:, np.newaxis, :] + 0.5
+    self.confs = np.random.random((N_SAMPLES, N_MARKERS)).astype(np.float32)
+    self.vids = ['V%03d' % i for i in xrange(N_SAMPLES)]
+
+  def tearDown(self):
+    shutil.rmtree(self.wd)
+
+  def __fill(self):
+    store = MarkerMajorStore.create(self.path, N_MARKERS, chunk_markers=32,
+                                    chunk_samples=4)
+    for i, j in (0, 4), (4, 5), (5, N_SAMPLES):
+      store.append(self.vids[i:j], range(i, j), self.probs[i:j],
+                   self.confs[i:j])
+    store.close()
+
+  def test_append_read(self):
+    self.__fill()
+    with MarkerMajorStore(self.path) as store:
+      self.assertEqual(store.n_markers, N_MARKERS)
+      self.assertEqual(store.n_samples, N_SAMPLES)
+      self.assertEqual(store.chunk_samples, 4)
+      self.assertEqual(list(store.vid[:]), self.vids)
+      data = store.read(10, 50)
+      self.assertTrue((data['probs'] ==
+                       self.probs[:, :, 10:50].transpose(1, 2, 0)).all())
+      self.assertTrue((data['confidence'] == self.confs[:, 10:50].T).all())
+      probs, confs = store.read_sample(3)
+      self.assertTrue((probs == self.probs[3]).all())
+      self.assertTrue((confs == self.confs[3]).all())
+      stops = [stop for _, stop, _ in store.iter_blocks(50)]
+      self.assertEqual(stops, [50, 100, N_MARKERS])
+
+  def test_counts(self):
+    self.__fill()
+    with MarkerMajorStore(self.path) as store:
+      N, counts = store.counts()
+    gdos = [{'probs': p} for p in self.probs]
+    exp_N, exp_counts = algo.count_homozygotes(iter(gdos))
+    self.assertEqual(N, exp_N)
+    self.assertTrue((np.abs(counts - exp_counts) <= 1).all())
+
+  def test_truncate(self):
+    self.__fill()
+    with MarkerMajorStore(self.path, 'a') as store:
+      store.truncate(5)
+      self.assertEqual(store.n_samples, 5)
+      self.assertEqual(len(store.row_index), 5)
+      self.assertRaises(ValueError, store.append, self.vids[:2], [5, 6],
+                        self.probs[:1], self.confs[:2])
+
+
+class TestStoreFlags(unittest.TestCase):
+
+  def setUp(self):
+    self.wd = tempfile.mkdtemp(prefix='bl_vl_')
+    self.path = os.path.join(self.wd, 'sub', 'mstore.h5')
+
+  def tearDown(self):
+    shutil.rmtree(self.wd)
+
+  def test_stale(self):
+    self.assertFalse(marker_store.is_stale(self.path))
+    with marker_store.lock(self.path):
+      marker_store.mark_stale(self.path)
+    self.assertTrue(marker_store.is_stale(self.path))
+    marker_store.clear_stale(self.path)
+    self.assertFalse(marker_store.is_stale(self.path))
+    marker_store.clear_stale(self.path)
+
+
+def suite():
+  suite = unittest.TestSuite()
+  suite.addTest(TestMarkerMajorStore('test_append_read'))
+  suite.addTest(TestMarkerMajorStore('test_counts'))
+  suite.addTest(TestMarkerMajorStore('test_truncate'))
+  suite.addTest(TestStoreFlags('test_stale'))
+  return suite
+
+
+if __name__ == '__main__':
+  runner = unittest.TextTestRunner(verbosity=2)
+  runner.run((suite()))
@@ -3,7 +3,7 @@
 
 import unittest, time, os, random
 import itertools as it
-import tempfile
+import tempfile, shutil
 import numpy as np
 
 from bl.vl.kb import KnowledgeBase as KB
@@ -80,12 +80,14 @@ class markers_set(unittest.TestCase):
       self.kb.delete(x)
     self.kill_list = []
 
-  def __create_snp_markers_set(self, N):
+  def __create_snp_markers_set(self, N, gdo_block_size=None,
+                               gdo_encoding=None):
     label = 'ams-%f' % time.time()
     maker, model, release = 'FOO', 'FOO1', '%f' % time.time()
     rows = [('M%d' % i, 'AC[A/G]GT', i, False) for i in xrange(N)]
     mset = self.kb.create_snp_markers_set(
-      label, maker, model, release, N, iter(rows), self.action
+      label, maker, model, release, N, iter(rows), self.action,
+      gdo_block_size=gdo_block_size, gdo_encoding=gdo_encoding
       )
     self.kill_list.append(mset)
     return mset, rows
@@ -112,7 +114,8 @@ class markers_set(unittest.TestCase):
         yield r
     aligns = list(insert_duplicates(mset.markers))
     random.shuffle(aligns)
-    self.kb.align_snp_markers_set(mset, ref_genome, aligns, self.action)
+    self.align_report = self.kb.align_snp_markers_set(mset, ref_genome,
+                                                      aligns, self.action)
     return pos
 
   def __create_data_sample(self, mset, label):
@@ -161,6 +164,10 @@ class markers_set(unittest.TestCase):
     N_dups = 4
     ref_genome = 'g' + ('%f' % time.time())[-14:]
     mset, pos = self.__create_aligned_mset(N, N_dups, ref_genome)
+    self.assertEqual(self.align_report['markers'], N)
+    self.assertEqual(self.align_report['aligned'], N - N_dups)
+    self.assertEqual(self.align_report['multi_aligned'], N_dups)
+    self.assertEqual(self.align_report['extra_copies'], N_dups)
     mset.load_alignments(ref_genome)
     for p, m in it.izip(pos, mset.get_markers_iterator()):
       self.assertEqual(p, m.position)
@@ -202,6 +209,108 @@ class markers_set(unittest.TestCase):
       self.assertTrue((confs[indices] == x['confidence']).all())
     self.assertEqual(i, 0)
 
+  def test_bulk_gdo(self):
+    N, n_samples = 32, 5
+    mset, _ = self.__create_snp_markers_set(N)
+    mset.load_markers()
+    data_samples = [self.__create_data_sample(mset, 'foo-data-%d' % i)
+                    for i in xrange(n_samples)]
+    data = [make_fake_data(mset) for _ in xrange(n_samples)]
+    records = [(self.action, ds, p, c)
+               for ds, (p, c) in it.izip(data_samples, data)]
+    dos = self.kb.add_gdo_data_objects(iter(records), batch_size=2)
+    self.kill_list.extend(dos)
+    self.assertEqual(len(dos), n_samples)
+    for ds, (probs, confs) in it.izip(data_samples, data):
+      probs1, confs1 = ds.resolve_to_data()
+      self.assertTrue((probs == probs1).all())
+      self.assertTrue((confs == confs1).all())
+
+  def test_get_gdos(self):
+    N, n_samples = 32, 4
+    mset, _ = self.__create_snp_markers_set(N)
+    mset.load_markers()
+    data_samples = [self.__create_data_sample(mset, 'foo-data-%d' % i)
+                    for i in xrange(n_samples)]
+    data = [self.__create_data_object(ds) for ds in data_samples]
+    data_samples.reverse()
+    data.reverse()
+    indices = slice(N/4, N/2)
+    gdos = self.kb.get_gdos(mset, data_samples=data_samples, indices=indices)
+    self.assertEqual(gdos['probs'].shape, (n_samples, 2, N/4))
+    self.assertEqual(gdos['confidence'].shape, (n_samples, N/4))
+    for i, (probs, confs) in enumerate(data):
+      self.assertTrue((probs[:, indices] == gdos['probs'][i]).all())
+      self.assertTrue((confs[indices] == gdos['confidence'][i]).all())
+    by_vid = self.kb.get_gdos(mset, vids=gdos['vid'][::-1])
+    self.assertTrue((by_vid['row_index'] == gdos['row_index'][::-1]).all())
+    s = self.kb.get_gdo_iterator(mset, data_samples=data_samples,
+                                 batch_size=3)
+    for (probs, confs), x in it.izip(data, s):
+      self.assertTrue((probs == x['probs']).all())
+      self.assertTrue((confs == x['confidence']).all())
+
+  def test_resolve_to_data(self):
+    msets = [self.__create_snp_markers_set(N)[0] for N in 16, 24]
+    for mset in msets:
+      mset.load_markers()
+    data_samples, data = [], []
+    for i in xrange(5):
+      mset = msets[i % 2]
+      ds = self.__create_data_sample(mset, 'foo-data-%d' % i)
+      data_samples.append(ds)
+      data.append(self.__create_data_object(ds))
+    data_samples.reverse()
+    data.reverse()
+    s = self.kb.resolve_to_data(data_samples, batch_size=2)
+    for (probs, confs), (probs1, confs1) in it.izip_longest(data, s):
+      self.assertTrue((probs == probs1).all())
+      self.assertTrue((confs == confs1).all())
+    no_gdo = self.__create_data_sample(msets[0], 'foo-data-no-gdo')
+    self.assertRaises(ValueError, self.kb.resolve_to_data, [no_gdo])
+
+  def test_blocked_gdo(self):
+    N = 40
+    mset, _ = self.__create_snp_markers_set(N, gdo_block_size=16)
+    mset.load_markers()
+    data_sample = self.__create_data_sample(mset, 'foo-data')
+    probs, confs = self.__create_data_object(data_sample)
+    probs1, confs1 = data_sample.resolve_to_data()
+    self.assertTrue((probs == probs1).all())
+    self.assertTrue((confs == confs1).all())
+    for indices in slice(18, 30), np.array([39, 0, 17]):
+      s = self.kb.get_gdo_iterator(mset, indices=indices)
+      for i, x in enumerate(s):
+        self.assertTrue((probs[:, indices] == x['probs']).all())
+        self.assertTrue((confs[indices] == x['confidence']).all())
+      self.assertEqual(i, 0)
+
+  def test_quantized_gdo(self):
+    N = 40
+    mset, _ = self.__create_snp_markers_set(N, gdo_block_size=16,
+                                            gdo_encoding='q8')
+    mset.load_markers()
+    data_sample = self.__create_data_sample(mset, 'foo-data')
+    probs, confs = self.__create_data_object(data_sample)
+    probs1, confs1 = data_sample.resolve_to_data()
+    self.assertEqual(probs1.dtype, np.float32)
+    self.assertTrue((np.abs(probs - probs1) <= 0.5 / 255 + 1e-6).all())
+    self.assertTrue((np.abs(confs - confs1) <= 0.5 / 255 + 1e-6).all())
+    n_rows = self.kb.gadpt.reencode_gdo_table(mset.id)
+    self.assertEqual(n_rows, 1)
+    work_dir = tempfile.mkdtemp()
+    try:
+      self.assertRaises(ValueError, self.kb.gadpt.reencode_gdo_table,
+                        mset.id, work_dir=work_dir, resume=True)
+      open(os.path.join(work_dir, 'batch-000000.npz'), 'w').close()
+      self.assertRaises(ValueError, self.kb.gadpt.reencode_gdo_table,
+                        mset.id, work_dir=work_dir)
+    finally:
+      shutil.rmtree(work_dir)
+    probs2, confs2 = data_sample.resolve_to_data()
+    self.assertTrue((probs1 == probs2).all())
+    self.assertTrue((confs1 == confs2).all())
+
   def test_define_range_selector(self):
     N, N_dups = 16, 0
     ref_genome = 'g' + ('%f' % time.time())[-14:]
@@ -252,6 +361,16 @@ class markers_set(unittest.TestCase):
       m1, m2 = mset1[i], mset2[j]
       self.assertEqual(m1.position, m2.position)
       self.assertTrue(m1.position > (0,0))
+    indices = self.kb.SNPMarkersSet.intersect_all([mset1, mset2, mset1])
+    self.assertEqual(len(indices), 3)
+    for i, idx in zip((idx1, idx2, idx1), indices):
+      self.assertTrue(np.array_equal(i, idx))
+    gpos, indices = self.kb.SNPMarkersSet.union_all([mset1, mset2])
+    self.assertEqual(len(gpos), len(mset1) + len(mset2) - len(idx1))
+    for ms, idx in zip((mset1, mset2), indices):
+      found = idx > -1
+      self.assertTrue(np.array_equal(ms.aligns['global_pos'][idx[found]],
+                                     gpos[found]))
 
   def test_speed(self):
     ref_genome = 'g' + ('%f' % time.time())[-14:]
@@ -328,6 +447,11 @@ def suite():
   suite.addTest(markers_set('test_align'))
   suite.addTest(markers_set('test_read_ssc'))
   suite.addTest(markers_set('test_gdo'))
+  suite.addTest(markers_set('test_bulk_gdo'))
+  suite.addTest(markers_set('test_get_gdos'))
+  suite.addTest(markers_set('test_resolve_to_data'))
+  suite.addTest(markers_set('test_blocked_gdo'))
+  suite.addTest(markers_set('test_quantized_gdo'))
   suite.addTest(markers_set('test_define_range_selector'))
   suite.addTest(markers_set('test_intersect'))
   #--
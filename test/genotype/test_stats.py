@@ -0,0 +1,85 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+import os, unittest, time
+
+import numpy as np
+
+import bl.vl.genotype.algo as algo
+import bl.vl.genotype.stats as stats
+from bl.vl.utils import get_logger
+
+
+def make_counts(n_samples, n_markers):
+  return algo.count_homozygotes(
+    dict(probs=algo.generate_data(n_markers)[0]) for _ in xrange(n_samples)
+    )
+
+
+class TestStats(unittest.TestCase):
+
+  def setUp(self):
+    self.counts = make_counts(50, 1000)
+
+  def __check(self, maf, hwe):
+    exp_maf = algo.maf(None, self.counts)
+    exp_hwe = algo.hwe(None, self.counts)
+    self.assertEqual(maf.shape, exp_maf.shape)
+    self.assertTrue(np.allclose(maf, exp_maf))
+    self.assertEqual(hwe.shape, exp_hwe.shape)
+    self.assertTrue(np.allclose(hwe, exp_hwe, atol=1e-6))
+
+  def test_hwe_exact(self):
+    N = 20
+    # all (minor allele count, heterozygote count) configurations
+    n_a, n_ab = zip(*[(a, b) for a in xrange(N + 1) for b in xrange(a + 1)
+                      if (a - b) % 2 == 0 and b + (a - b) / 2 <= N])
+    p_values = stats.hwe_exact(n_a, n_ab, N)
+    for a, b, p in zip(n_a, n_ab, p_values):
+      if a == b > 0:
+        # algo.hwe_scalar fails for a = b = 1
+        self.assertEqual(p, 0)
+      else:
+        self.assertAlmostEqual(p, algo.hwe_scalar(a, b, N), 6)
+
+  def test_serial(self):
+    blocks = stats.split_counts(self.counts, block_size=128)
+    self.__check(*stats.compute_stats(blocks, processes=1))
+
+  def test_parallel(self):
+    blocks = stats.split_counts(self.counts, block_size=128)
+    self.__check(*stats.compute_stats(blocks, processes=2, max_pending=3))
+    self.assertRaises(ValueError, stats.compute_stats, iter([]), 2)
+
+  @unittest.skipUnless(os.getenv('BL_VL_BENCHMARK'),
+                       'set BL_VL_BENCHMARK to run benchmarks')
+  def test_benchmark(self):
+    n_samples, n_markers = 200, 20000
+    counts = make_counts(n_samples, n_markers)
+    logger = get_logger('test_benchmark', level='INFO')
+    start = time.time()
+    algo.maf(None, counts)
+    algo.hwe(None, counts)
+    t_algo = time.time() - start
+    logger.info('algo: %d samples x %d markers in %.3f s' % (
+      n_samples, n_markers, t_algo))
+    for processes in 1, None:
+      start = time.time()
+      stats.compute_stats(stats.split_counts(counts), processes=processes)
+      t = time.time() - start
+      logger.info('stats (%s processes): %.3f s (%.1fx)' % (
+        processes or 'all', t, t_algo / t))
+
+
+def suite():
+  suite = unittest.TestSuite()
+  suite.addTest(TestStats('test_hwe_exact'))
+  suite.addTest(TestStats('test_serial'))
+  suite.addTest(TestStats('test_parallel'))
+  suite.addTest(TestStats('test_benchmark'))
+  return suite
+
+
+if __name__ == '__main__':
+  runner = unittest.TextTestRunner(verbosity=2)
+  runner.run((suite()))
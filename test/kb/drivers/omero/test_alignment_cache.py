@@ -0,0 +1,104 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+import unittest, tempfile, shutil
+
+import numpy as np
+
+from bl.vl.kb.drivers.omero.alignment_cache import AlignmentCache, \
+     configure_alignment_cache, get_alignment_cache
+
+
+def make_aligns(n_rows):
+  data = np.zeros(n_rows, dtype=[('marker_vid', '|S34'), ('chromosome', 'i8'),
+                                 ('pos', 'i8'), ('global_pos', 'i8')])
+  data['marker_vid'] = ['V%04d' % i for i in xrange(n_rows)]
+  data['pos'] = np.arange(n_rows)
+  return data
+
+
+class TestAlignmentCache(unittest.TestCase):
+
+  def setUp(self):
+    self.root = tempfile.mkdtemp(prefix='align_cache_')
+
+  def tearDown(self):
+    shutil.rmtree(self.root, ignore_errors=True)
+
+  def test_memory(self):
+    cache = AlignmentCache()
+    data = make_aligns(10)
+    self.assertTrue(cache.get('V01', 'hg19', 10) is None)
+    cached = cache.put('V01', 'hg19', 10, data)
+    self.assertFalse(cached.flags.writeable)
+    self.assertTrue(cache.get('V01', 'hg19', 10) is cached)
+    self.assertTrue(cache.get('V01', 'hg18', 10) is None)
+    self.assertTrue(cache.get('V01', 'hg19', 20) is None)
+    self.assertEqual(len(cache.put('V01', 'hg18', 10, [])), 0)
+    cache.put('V02', 'hg19', 5, make_aligns(5))
+    cache.invalidate('V01')
+    self.assertTrue(cache.get('V01', 'hg19', 10) is None)
+    self.assertFalse(cache.get('V02', 'hg19', 5) is None)
+    stats = cache.stats()
+    self.assertEqual(stats['memory']['size'], 1)
+    self.assertEqual(stats['memory']['invalidations'], 1)
+    self.assertTrue(stats['disk'] is None)
+
+  def test_bounded(self):
+    data = make_aligns(100)
+    cache = AlignmentCache(max_bytes=int(2.5 * data.nbytes))
+    for i in xrange(3):
+      cache.put('V%02d' % i, 'hg19', 100, make_aligns(100))
+    self.assertTrue(cache.get('V00', 'hg19', 100) is None)
+    self.assertFalse(cache.get('V02', 'hg19', 100) is None)
+    self.assertEqual(cache.stats()['memory']['evictions'], 1)
+
+  def test_disk(self):
+    data = make_aligns(10)
+    AlignmentCache(disk_dir=self.root).put('V01', 'hg19', 10, data)
+    cache = AlignmentCache(disk_dir=self.root)
+    cached = cache.get('V01', 'hg19', 10)
+    self.assertTrue(isinstance(cached, np.memmap))
+    self.assertTrue(np.all(cached == data))
+    self.assertTrue(cache.get('V01', 'hg19', 10) is cached)
+    cache.invalidate('V01')
+    self.assertTrue(AlignmentCache(disk_dir=self.root).get('V01', 'hg19', 10)
+                    is None)
+
+  def test_extend(self):
+    cache = AlignmentCache(max_bytes=2**20)
+    cached = cache.put('V01', 'hg19', 10, make_aligns(10))
+    cache.extend(max_bytes=50)
+    self.assertEqual(cache.max_bytes, 2**20)
+    cache.extend(max_bytes=None, disk_dir=self.root, disk_quota=10)
+    self.assertTrue(cache.max_bytes is None)
+    self.assertEqual((cache.disk_dir, cache.disk_quota), (self.root, 10))
+    cache.extend(disk_dir=self.root + '_other', disk_quota=None)
+    self.assertEqual((cache.disk_dir, cache.disk_quota), (self.root, 10))
+    cache.extend(disk_dir=self.root, disk_quota=None)
+    self.assertTrue(cache.disk_quota is None)
+    self.assertTrue(cache.get('V01', 'hg19', 10) is cached)
+
+  def test_process_wide(self):
+    cache = configure_alignment_cache(disk_dir=self.root)
+    self.assertTrue(get_alignment_cache() is cache)
+    data = cache.put('V01', 'hg19', 10, make_aligns(10))
+    self.assertTrue(configure_alignment_cache() is cache)
+    self.assertEqual(cache.disk_dir, self.root)
+    self.assertTrue(cache.get('V01', 'hg19', 10) is data)
+    cache.clear()
+
+
+def suite():
+  suite = unittest.TestSuite()
+  suite.addTest(TestAlignmentCache('test_memory'))
+  suite.addTest(TestAlignmentCache('test_bounded'))
+  suite.addTest(TestAlignmentCache('test_disk'))
+  suite.addTest(TestAlignmentCache('test_extend'))
+  suite.addTest(TestAlignmentCache('test_process_wide'))
+  return suite
+
+
+if __name__ == '__main__':
+  runner = unittest.TextTestRunner(verbosity=2)
+  runner.run((suite()))
@@ -0,0 +1,102 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+import unittest
+
+import numpy as np
+
+from bl.vl.kb.drivers.omero.gdo_layout import GDOLayout, Q8, q8_encode, \
+     q8_decode
+
+
+N_MARKERS = 103
+N_SAMPLES = 4
+
+
+def to_record_type(cols):
+  types = {'float_array': 'float32', 'long_array': 'int64'}
+  return [(c[1], '(%d,)%s' % (c[3], types[c[0]])) for c in cols]
+
+
+class TestGDOLayout(unittest.TestCase):
+
+  def setUp(self):
+    self.probs = np.random.random((N_SAMPLES, 2, N_MARKERS)).astype(np.float32)
+    self.confs = np.random.random((N_SAMPLES, N_MARKERS)).astype(np.float32)
+
+  def __store(self, layout):
+    rows = [layout.pack(p, c) for p, c in zip(self.probs, self.confs)]
+    data = dict((k, np.vstack([r[k] for r in rows])) for k in rows[0])
+    data['vid'] = np.array(['V%d' % i for i in xrange(N_SAMPLES)])
+    return data
+
+  def __check(self, layout):
+    data = self.__store(layout)
+    if layout.quantized:
+      tolerance = 0.5 / 255 + 1e-6
+    else:
+      tolerance = 0
+    for indices in (None, slice(10, 40), np.array([100, 3, 50, 51]),
+                    np.arange(N_MARKERS) % 7 == 0):
+      blocks, positions = layout.select(indices)
+      sub = dict((k, data[k]) for k in layout.col_names(blocks) + ['vid'])
+      probs, confs = layout.unpack(sub, blocks, positions)
+      exp_probs = self.probs if indices is None else self.probs[:, :, indices]
+      exp_confs = self.confs if indices is None else self.confs[:, indices]
+      self.assertEqual(probs.dtype, np.float32)
+      self.assertTrue((np.abs(probs - exp_probs) <= tolerance).all())
+      self.assertTrue((np.abs(confs - exp_confs) <= tolerance).all())
+
+  def test_monolithic(self):
+    layout = GDOLayout(N_MARKERS)
+    self.assertEqual(layout.col_names(layout.select()[0]),
+                     ['probs', 'confidence'])
+    self.__check(layout)
+
+  def test_blocked(self):
+    layout = GDOLayout(N_MARKERS, block_size=16)
+    self.assertEqual(len(layout.blocks), 7)
+    self.assertEqual(layout.select(slice(16, 20))[0], [1])
+    self.__check(layout)
+
+  def test_quantized(self):
+    for block_size in None, 16:
+      layout = GDOLayout(N_MARKERS, block_size, encoding=Q8)
+      self.__check(layout)
+    a = np.array([[0.0, 1.0, 0.5, -1.0, 2.0]], dtype=np.float32)
+    packed = q8_encode(a)
+    self.assertEqual(packed.shape, (1, 1))
+    self.assertEqual(packed.dtype, np.int64)
+    self.assertTrue((q8_decode(packed, 5) ==
+                     np.array([[0, 1, 128 / 255.0, 0, 1]],
+                              dtype=np.float32)).all())
+
+  def test_from_headers(self):
+    for block_size in None, 16:
+      for encoding in None, Q8:
+        layout = GDOLayout(N_MARKERS, block_size, encoding)
+        cols = layout.columns()
+        record_type = to_record_type(cols)
+        descriptions = dict((c[1], c[2]) for c in cols)
+        layout2 = GDOLayout.from_headers([('vid', '|S34')] + record_type,
+                                         descriptions)
+        self.assertEqual(layout2.n_markers, N_MARKERS)
+        self.assertEqual(layout2.block_size, block_size)
+        self.assertEqual(layout2.encoding, layout.encoding)
+    self.assertRaises(ValueError, GDOLayout.from_headers,
+                      to_record_type(GDOLayout(N_MARKERS,
+                                               encoding=Q8).columns()))
+
+
+def suite():
+  suite = unittest.TestSuite()
+  suite.addTest(TestGDOLayout('test_monolithic'))
+  suite.addTest(TestGDOLayout('test_blocked'))
+  suite.addTest(TestGDOLayout('test_quantized'))
+  suite.addTest(TestGDOLayout('test_from_headers'))
+  return suite
+
+
+if __name__ == '__main__':
+  runner = unittest.TextTestRunner(verbosity=2)
+  runner.run((suite()))
@@ -0,0 +1,74 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+import unittest
+
+import omero
+import omero_Tables_ice
+
+from bl.vl.kb.drivers.omero.instrumentation import OperationStats, \
+     instrument_table, LATENCY_BUCKETS
+
+
+class FakeTable(object):
+
+  def getNumberOfRows(self):
+    return 10
+
+  def addData(self, columns, _ctx=None):
+    self.ctx = _ctx
+
+  def read(self, col_numbers, start, stop):
+    raise RuntimeError('read failed')
+
+
+class TestOperationStats(unittest.TestCase):
+
+  def test_record(self):
+    op_stats = OperationStats()
+    op_stats.record('getQueryService.findAllByQuery', 0.0005, n_rows=3)
+    op_stats.record('getQueryService.findAllByQuery', 2.0, n_rows=1)
+    op_stats.add_source('sessions', lambda: {'created': 1})
+    stats = op_stats.stats()
+    op = stats['getQueryService.findAllByQuery']
+    self.assertEqual(op['calls'], 2)
+    self.assertEqual(op['rows'], 4)
+    self.assertEqual(op['max_time'], 2.0)
+    self.assertEqual(len(op['histogram']), len(LATENCY_BUCKETS) + 1)
+    self.assertEqual(op['histogram'][0], 1)
+    self.assertEqual(op['histogram'][4], 1)
+    self.assertEqual(stats['sessions'], {'created': 1})
+    self.assertEqual(len(op_stats.report()), 3)
+
+  def test_table(self):
+    op_stats = OperationStats()
+    t = instrument_table(FakeTable(), op_stats)
+    for _ in xrange(3):
+      self.assertEqual(t.getNumberOfRows(), 10)
+    self.assertEqual(op_stats.stats()['Table.getNumberOfRows']['calls'], 3)
+
+  def test_table_write_and_errors(self):
+    op_stats = OperationStats()
+    ft = FakeTable()
+    t = instrument_table(ft, op_stats)
+    c = omero.grid.LongColumn('pos', '', [1, 2, 3])
+    t.addData([c], _ctx={'k': 'v'})
+    self.assertEqual(ft.ctx, {'k': 'v'})
+    op = op_stats.stats()['Table.addData']
+    self.assertEqual((op['rows'], op['bytes'], op['errors']), (3, 24, 0))
+    self.assertRaises(RuntimeError, t.read, [0], 0, 1)
+    op = op_stats.stats()['Table.read']
+    self.assertEqual((op['calls'], op['errors']), (1, 1))
+
+
+def suite():
+  suite = unittest.TestSuite()
+  suite.addTest(TestOperationStats('test_record'))
+  suite.addTest(TestOperationStats('test_table'))
+  suite.addTest(TestOperationStats('test_table_write_and_errors'))
+  return suite
+
+
+if __name__ == '__main__':
+  runner = unittest.TextTestRunner(verbosity=2)
+  runner.run((suite()))
@@ -0,0 +1,76 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+import unittest
+
+import numpy as np
+
+from bl.vl.kb.drivers.omero.interval_index import IntervalIndex
+
+
+MAX_LEN = 10**10
+N_MARKERS = 500
+
+
+class TestIntervalIndex(unittest.TestCase):
+
+  def setUp(self):
+    self.chrom = np.random.randint(1, 27, N_MARKERS)
+    self.pos = np.random.randint(1, 10**6, N_MARKERS)
+    self.global_pos = self.chrom * MAX_LEN + self.pos
+    # not uniquely aligned markers
+    self.global_pos[::9] = -1 - np.arange(len(self.global_pos[::9]))
+    self.marker_indices = np.arange(N_MARKERS)
+    self.index = IntervalIndex(self.global_pos, self.marker_indices, MAX_LEN)
+
+  def __expected(self, beg, end, closed_interval=True):
+    low = beg[0] * MAX_LEN + beg[1]
+    high = end[0] * MAX_LEN + end[1]
+    gp = self.global_pos
+    sel = (low <= gp) & ((gp <= high) if closed_interval else (gp < high))
+    return self.marker_indices[sel]
+
+  def test_chromosome_range(self):
+    valid = self.global_pos >= 0
+    self.assertEqual(len(self.index), valid.sum())
+    for c in xrange(1, 27):
+      start, stop = self.index.chromosome_range(c)
+      self.assertEqual(stop - start, (valid & (self.chrom == c)).sum())
+      self.assertTrue((self.index.global_pos[start:stop] // MAX_LEN == c).all())
+
+  def test_query(self):
+    begins = [(1, 0), (5, 1000), (10, 500000), (26, 10**6)]
+    ends = [(3, 10**6), (5, 900000), (12, 1), (26, 10**6 + 1)]
+    for closed_interval in True, False:
+      starts, stops = self.index.query(begins, ends, closed_interval)
+      for beg, end, start, stop in zip(begins, ends, starts, stops):
+        self.assertEqual(sorted(self.index.markers(start, stop)),
+                         list(self.__expected(beg, end, closed_interval)))
+    # reversed region
+    starts, stops = self.index.query([(4, 10)], [(2, 10)])
+    self.assertEqual(stops[0] - starts[0], 0)
+
+  def test_select(self):
+    # overlapping regions, markers must be reported once
+    begins = [(2, 0), (2, 400000), (20, 0)]
+    ends = [(2, 600000), (3, 10**6), (20, 10**6)]
+    expected = set()
+    for beg, end in zip(begins, ends):
+      expected.update(self.__expected(beg, end))
+    self.assertEqual(list(self.index.select(begins, ends)), sorted(expected))
+    p = self.chrom[1], self.pos[1]
+    self.assertEqual(list(self.index.select([p], [p])),
+                     list(self.__expected(p, p)))
+
+
+def suite():
+  suite = unittest.TestSuite()
+  suite.addTest(TestIntervalIndex('test_chromosome_range'))
+  suite.addTest(TestIntervalIndex('test_query'))
+  suite.addTest(TestIntervalIndex('test_select'))
+  return suite
+
+
+if __name__ == '__main__':
+  runner = unittest.TextTestRunner(verbosity=2)
+  runner.run((suite()))
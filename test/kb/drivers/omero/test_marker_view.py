@@ -0,0 +1,92 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+import unittest
+
+import numpy as np
+
+from bl.vl.kb.drivers.omero.marker_view import MarkerView
+
+
+MARKERS_TYPE = [('vid', '|S34'), ('label', '|S48'), ('mask', '|S69'),
+                ('index', '<i8'), ('allele_flip', '|b1')]
+ALIGNS_TYPE = [('marker_vid', '|S34'), ('chromosome', '<i8'), ('pos', '<i8'),
+               ('global_pos', '<i8'), ('strand', '|b1'), ('allele', '|S1'),
+               ('copies', '<i8')]
+
+
+def make_markers(n, label_offset=0):
+  markers = np.zeros(n, dtype=MARKERS_TYPE)
+  markers['vid'] = ['V%03d' % i for i in xrange(n)]
+  markers['label'] = ['M%03d' % (i + label_offset) for i in xrange(n)]
+  markers['mask'] = 'AC[A/G]GT'
+  markers['index'] = np.arange(n)
+  aligns = np.zeros(n, dtype=ALIGNS_TYPE)
+  aligns['marker_vid'] = markers['vid']
+  aligns['chromosome'] = 1 + np.arange(n) % 3
+  aligns['pos'] = 1000 * (np.arange(n) + label_offset)
+  aligns['global_pos'] = aligns['chromosome'] * 10**10 + aligns['pos']
+  aligns['strand'] = True
+  aligns['allele'] = 'A'
+  aligns['copies'] = 1
+  aligns['copies'][::4] = 2
+  aligns['global_pos'][::4] = -1 - np.arange(len(aligns[::4]))
+  return markers, aligns
+
+
+class TestMarkerView(unittest.TestCase):
+
+  def setUp(self):
+    self.markers, self.aligns = make_markers(10)
+    self.view = MarkerView(self.markers, self.aligns)
+
+  def test_columns(self):
+    self.assertEqual(len(self.view), 10)
+    self.assertTrue((self.view.label == self.markers['label']).all())
+    self.assertEqual(self.view.chrom.tolist()[:3], [0, 2, 3])
+    self.assertEqual(self.view.pos.tolist()[:3], [0, 1000, 2000])
+    view = MarkerView(self.markers)
+    self.assertFalse(view.aligned.any())
+    self.assertEqual(view.chrom.tolist(), [0] * 10)
+    self.assertRaises(ValueError, getattr, view, 'strand')
+
+  def test_slicing(self):
+    sub = self.view[2:8]
+    self.assertEqual(len(sub), 6)
+    sub = sub.filter(sub.chrom == 3)
+    self.assertEqual(sub.index.tolist(), [2, 5])
+    m = sub[1]
+    self.assertEqual(m.label, 'M005')
+    self.assertEqual(m.position, (3, 5000))
+    self.assertTrue(m.on_reference_strand)
+    self.assertEqual(sub[-1].index, 5)
+    self.assertRaises(IndexError, sub.marker, 2)
+    m = self.view[4]
+    self.assertEqual(m.position, (0, 0))
+    self.assertFalse(hasattr(m, 'on_reference_strand'))
+    labels = [m.label for m in self.view[[7, 1]].iter_markers()]
+    self.assertEqual(labels, ['M007', 'M001'])
+
+  def test_join(self):
+    markers, aligns = make_markers(6, label_offset=3)
+    other = MarkerView(markers, aligns)
+    i, j = self.view.join(other)
+    self.assertTrue((self.view.label[i] == other.label[j]).all())
+    self.assertEqual(len(i), 6)
+    i, j = self.view.join(other, on='position')
+    self.assertTrue((self.view.global_pos[i] == other.global_pos[j]).all())
+    self.assertTrue(self.view.aligned[i].all())
+    self.assertTrue(other.aligned[j].all())
+
+
+def suite():
+  suite = unittest.TestSuite()
+  suite.addTest(TestMarkerView('test_columns'))
+  suite.addTest(TestMarkerView('test_slicing'))
+  suite.addTest(TestMarkerView('test_join'))
+  return suite
+
+
+if __name__ == '__main__':
+  runner = unittest.TextTestRunner(verbosity=2)
+  runner.run((suite()))
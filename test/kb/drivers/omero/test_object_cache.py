@@ -0,0 +1,69 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+import unittest, gc
+
+from bl.vl.kb.drivers.omero.object_cache import ObjectCache
+
+
+class Item(object):
+
+  def __init__(self, size=0):
+    self.size = size
+
+
+class TestObjectCache(unittest.TestCase):
+
+  def test_lru(self):
+    cache = ObjectCache(max_size=2)
+    a, b, c = Item(), Item(), Item()
+    cache.put('a', a)
+    cache.put('b', b)
+    self.assertTrue(cache.get('a') is a)
+    cache.put('c', c)
+    self.assertEqual(len(cache), 2)
+    self.assertTrue(cache.get('b') is None)
+    self.assertTrue(cache.get('a') is a)
+    self.assertTrue(cache.get('c') is c)
+    stats = cache.stats()
+    self.assertEqual(stats['evictions'], 1)
+    self.assertEqual(stats['hits'], 3)
+    self.assertEqual(stats['misses'], 1)
+
+  def test_max_bytes(self):
+    cache = ObjectCache(max_size=None, max_bytes=10, sizer=lambda o: o.size)
+    for i in xrange(5):
+      cache.put(i, Item(4))
+    self.assertEqual(len(cache), 2)
+    self.assertEqual(cache.stats()['bytes'], 8)
+
+  def test_weak(self):
+    cache = ObjectCache(weak=True)
+    a = Item()
+    cache.put('a', a)
+    self.assertTrue(cache['a'] is a)
+    del a
+    gc.collect()
+    self.assertRaises(KeyError, cache.__getitem__, 'a')
+
+  def test_invalidation(self):
+    cache = ObjectCache()
+    cache.put('a', Item())
+    cache.discard('a')
+    cache.discard('a')
+    self.assertFalse('a' in cache)
+    self.assertEqual(cache.stats()['invalidations'], 1)
+
+
+def suite():
+  suite = unittest.TestSuite()
+  suite.addTest(TestObjectCache('test_lru'))
+  suite.addTest(TestObjectCache('test_max_bytes'))
+  suite.addTest(TestObjectCache('test_weak'))
+  suite.addTest(TestObjectCache('test_invalidation'))
+  return suite
+
+
+if __name__ == '__main__':
+  runner = unittest.TextTestRunner(verbosity=2)
+  runner.run((suite()))
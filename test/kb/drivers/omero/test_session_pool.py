@@ -0,0 +1,114 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+import os, unittest, threading
+
+from bl.vl.kb.drivers.omero.proxy_core import ProxyCore
+
+
+OME_HOST = os.getenv("OME_HOST", "localhost")
+OME_USER = os.getenv("OME_USER", "root")
+OME_PASS = os.getenv("OME_PASS", "romeo")
+
+N_THREADS = 4
+N_QUERIES = 8
+
+
+class TestSessionPool(unittest.TestCase):
+
+  def __query(self, pc):
+    return pc.ome_operation('getConfigService', 'getConfigValue',
+                            'omero.version')
+
+  def test_reuse(self):
+    pc = ProxyCore(OME_HOST, OME_USER, OME_PASS)
+    try:
+      for _ in xrange(N_QUERIES):
+        self.__query(pc)
+      stats = pc.get_session_stats()
+    finally:
+      pc.close()
+    self.assertEqual(stats['created'], 1)
+    self.assertTrue(stats['reused'] >= N_QUERIES)
+
+  def test_recycle(self):
+    max_ops = 3
+    pc = ProxyCore(OME_HOST, OME_USER, OME_PASS,
+                   session_max_operations=max_ops)
+    try:
+      for _ in xrange(N_QUERIES):
+        self.__query(pc)
+      stats = pc.get_session_stats()
+    finally:
+      pc.close()
+    self.assertTrue(stats['recycled'] > 0)
+    self.assertEqual(stats['created'], stats['recycled'] + 1)
+
+  def test_concurrent_queries(self):
+    pc = ProxyCore(OME_HOST, OME_USER, OME_PASS, pool_size=N_THREADS)
+    results, errors = [], []
+    def worker():
+      try:
+        for _ in xrange(N_QUERIES):
+          results.append(self.__query(pc))
+      except Exception, e:
+        errors.append(e)
+      finally:
+        pc.disconnect()
+    try:
+      threads = [threading.Thread(target=worker) for _ in xrange(N_THREADS)]
+      for t in threads:
+        t.start()
+      for t in threads:
+        t.join()
+      stats = pc.get_session_stats()
+    finally:
+      pc.close()
+    self.assertEqual(errors, [])
+    self.assertEqual(len(results), N_THREADS * N_QUERIES)
+    self.assertTrue(stats['created'] <= N_THREADS + 1)
+
+  def test_release_after_operation(self):
+    pc = ProxyCore(OME_HOST, OME_USER, OME_PASS, pool_size=1,
+                   session_checkout_timeout=5)
+    try:
+      self.__query(pc)
+      # the only session must be available to other threads
+      t = threading.Thread(target=self.__query, args=(pc,))
+      t.start()
+      t.join()
+      self.__query(pc)
+      stats = pc.get_session_stats()
+    finally:
+      pc.close()
+    self.assertEqual(stats['created'], 1)
+    self.assertEqual(stats['reclaimed'], 0)
+
+  def test_dead_thread(self):
+    pc = ProxyCore(OME_HOST, OME_USER, OME_PASS, pool_size=1)
+    try:
+      # the thread exits without calling disconnect
+      t = threading.Thread(target=pc.connect)
+      t.start()
+      t.join()
+      self.__query(pc)
+      stats = pc.get_session_stats()
+    finally:
+      pc.close()
+    self.assertEqual(stats['reclaimed'], 1)
+    self.assertEqual(stats['created'], 1)
+
+
+def suite():
+  suite = unittest.TestSuite()
+  suite.addTest(TestSessionPool('test_reuse'))
+  suite.addTest(TestSessionPool('test_recycle'))
+  suite.addTest(TestSessionPool('test_concurrent_queries'))
+  suite.addTest(TestSessionPool('test_release_after_operation'))
+  suite.addTest(TestSessionPool('test_dead_thread'))
+  return suite
+
+
+if __name__ == '__main__':
+  runner = unittest.TextTestRunner(verbosity=2)
+  runner.run((suite()))
@@ -6,6 +6,8 @@ import itertools as it
 import numpy as np
 
 from bl.vl.kb.drivers.omero.proxy_core import ProxyCore
+from bl.vl.kb.drivers.omero.table_query import group_selectors, \
+     merge_selectors
 
 
 OME_HOST = os.getenv("OME_HOST", "localhost")
@@ -106,6 +108,22 @@ class TestProxyCore(unittest.TestCase):
     for i, row in enumerate(row_it):
       self.assertTrue(row == data[i])
 
+  def test_table_batch_iterator(self):
+    fields = self.__make_fields()
+    table_name = get_random_table_name()
+    batch_size = 3
+    try:
+      pc = ProxyCore(OME_HOST, OME_USER, OME_PASS)
+      pc.create_table(table_name, fields)
+      data = self.__fill_table(pc, table_name, N_ROWS)
+      batches = list(pc.get_table_rows_iterator(
+        table_name, batch_size=batch_size, yield_batches=True
+        ))
+    finally:
+      pc.delete_table(table_name)
+    self.assertEqual(len(batches), (N_ROWS + batch_size - 1) / batch_size)
+    self.assertTrue(np.all(np.concatenate(batches) == data))
+
   def test_update_row(self):
     fields = self.__make_fields()
     table_name = get_random_table_name()
@@ -127,6 +145,32 @@ class TestProxyCore(unittest.TestCase):
     self.assertEqual(len(r), 1)
     self.assertTrue(urow == r[0])
 
+  def test_update_columns(self):
+    fields = self.__make_fields()
+    table_name = get_random_table_name()
+    try:
+      pc = ProxyCore(OME_HOST, OME_USER, OME_PASS)
+      pc.create_table(table_name, fields)
+      data = self.__fill_table(pc, table_name, N_ROWS)
+      idx = np.arange(0, N_ROWS, 2)
+      new_ids = data['r_id'][idx] + N_ROWS
+      n = pc.update_table_columns(
+        table_name, idx, {'r_id': new_ids, 'o_vid': 'foo'}, batch_size=3
+        )
+      self.assertEqual(n, len(idx))
+      n = pc.update_table_rows(table_name, '(r_id >= %d)' % N_ROWS,
+                               {'t_vid': 'bar'})
+      self.assertEqual(n, len(idx))
+      self.assertRaises(ValueError, pc.update_table_rows, table_name,
+                        '(r_id >= %d)' % N_ROWS, {'no_such_col': 0})
+      rows = pc.get_table_rows(table_name, None)
+    finally:
+      pc.delete_table(table_name)
+    data['r_id'][idx] = new_ids
+    data['o_vid'][idx] = 'foo'
+    data['t_vid'][idx] = 'bar'
+    self.assertTrue(np.all(data == rows))
+
   def test_selections(self):
     fields = self.__make_fields()
     table_name = get_random_table_name()
@@ -151,6 +195,79 @@ class TestProxyCore(unittest.TestCase):
     for i, r in it.izip(irange, rows_lite):
       self.assertTrue(data[i] == r)
 
+  def test_overlapping_selections(self):
+    fields = self.__make_fields()
+    table_name = get_random_table_name()
+    try:
+      pc = ProxyCore(OME_HOST, OME_USER, OME_PASS)
+      pc.create_table(table_name, fields)
+      data = self.__fill_table(pc, table_name, N_ROWS)
+      selectors = ['(r_id < %d)' % (N_ROWS/2), '(r_id >= %d)' % (N_ROWS/4)]
+      rows = pc.get_table_rows(table_name, selector=selectors)
+    finally:
+      pc.delete_table(table_name)
+    self.assertEqual(len(rows), N_ROWS)
+    self.assertTrue(np.all(data == rows))
+    self.assertEqual(pc.last_selection_stats['n_conditions'], 1)
+
+  def test_columnar(self):
+    fields = self.__make_fields()
+    table_name = get_random_table_name()
+    try:
+      pc = ProxyCore(OME_HOST, OME_USER, OME_PASS)
+      pc.create_table(table_name, fields)
+      data = self.__fill_table(pc, table_name, N_ROWS)
+      cols = pc.get_table_rows(table_name, None, columnar=True)
+      sel_cols = pc.get_table_rows(table_name, '(r_id >= %d)' % (N_ROWS/2),
+                                   col_names=['r_vid', 'a_f_type'],
+                                   columnar=True)
+      slice_cols = pc.get_table_slice(table_name, [1, 3], columnar=True)
+    finally:
+      pc.delete_table(table_name)
+    for k in data.dtype.names:
+      self.assertTrue(np.all(cols[k] == data[k]))
+      self.assertTrue(np.all(slice_cols[k] == data[k][[1, 3]]))
+    self.assertEqual(sorted(sel_cols.keys()), ['a_f_type', 'r_vid'])
+    self.assertTrue(np.all(sel_cols['r_vid'] == data['r_vid'][N_ROWS/2:]))
+    self.assertTrue(np.all(sel_cols['a_f_type'] ==
+                           data['a_f_type'][N_ROWS/2:]))
+
+  def test_add_columns(self):
+    fields = self.__make_fields()
+    table_name = get_random_table_name()
+    try:
+      pc = ProxyCore(OME_HOST, OME_USER, OME_PASS)
+      pc.create_table(table_name, fields)
+      data = self.__fill_table(pc, table_name, N_ROWS)
+      columns = dict((k, data[k]) for k in data.dtype.names)
+      indices = pc.add_table_rows(table_name, columns, batch_size=N_ROWS/3)
+      rows = pc.get_table_rows(table_name, None)
+    finally:
+      pc.delete_table(table_name)
+    self.assertEqual(indices, range(N_ROWS, 2*N_ROWS))
+    self.assertTrue(np.all(rows[:N_ROWS] == data))
+    self.assertTrue(np.all(rows[N_ROWS:] == data))
+
+  def test_direct_reads(self):
+    fields = self.__make_fields()
+    table_name = get_random_table_name()
+    try:
+      pc = ProxyCore(OME_HOST, OME_USER, OME_PASS, table_data_dir=True)
+      if pc.direct_reader is None:
+        self.skipTest('PyTables not available')
+      pc.create_table(table_name, fields)
+      data = self.__fill_table(pc, table_name, N_ROWS)
+      rows = pc.get_table_rows(table_name, None)
+      sel_rows = pc.get_table_rows(table_name, '(r_id >= %d)' % (N_ROWS/2))
+      slice_rows = pc.get_table_slice(table_name, [1, 3])
+      it_rows = list(pc.get_table_rows_iterator(table_name))
+    finally:
+      pc.delete_table(table_name)
+    self.assertTrue(np.all(data == rows))
+    self.assertTrue(np.all(data[N_ROWS/2:] == sel_rows))
+    self.assertTrue(np.all(data[[1, 3]] == slice_rows))
+    self.assertTrue(np.all(data == np.array(it_rows, dtype=data.dtype)))
+
   def test_array_size(self):
     print
     exp = 5  # large values may trigger a mem overflow (see Ice.MessageSizeMax)
@@ -169,14 +286,36 @@ class TestProxyCore(unittest.TestCase):
       self.assertTrue(np.all(data == rows))
 
 
+class TestSelectorGrouping(unittest.TestCase):
+
+  def test_group(self):
+    selectors = ['(r_id == %d)' % i for i in xrange(10)]
+    groups = group_selectors(selectors, max_terms=4)
+    self.assertEqual([len(g) for g in groups], [4, 4, 2])
+    self.assertEqual(sum(groups, []), selectors)
+    self.assertEqual(group_selectors('(r_id > 0)'), [['(r_id > 0)']])
+
+  def test_merge(self):
+    self.assertEqual(merge_selectors(['(a > 0)']), '(a > 0)')
+    self.assertEqual(merge_selectors(['a > 0', 'b < 1']), '(a > 0)|(b < 1)')
+
+
 def suite():
   suite = unittest.TestSuite()
   suite.addTest(TestProxyCore('test_create_delete'))
   suite.addTest(TestProxyCore('test_table_rows'))
   suite.addTest(TestProxyCore('test_table_rows_iterator'))
+  suite.addTest(TestProxyCore('test_table_batch_iterator'))
   suite.addTest(TestProxyCore('test_update_row'))
+  suite.addTest(TestProxyCore('test_update_columns'))
   suite.addTest(TestProxyCore('test_selections'))
+  suite.addTest(TestProxyCore('test_overlapping_selections'))
+  suite.addTest(TestProxyCore('test_columnar'))
+  suite.addTest(TestProxyCore('test_add_columns'))
+  suite.addTest(TestProxyCore('test_direct_reads'))
   suite.addTest(TestProxyCore('test_array_size'))
+  suite.addTest(TestSelectorGrouping('test_group'))
+  suite.addTest(TestSelectorGrouping('test_merge'))
   return suite
 
 
@@ -0,0 +1,88 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+import unittest
+
+from bl.vl.kb.drivers.omero.table_cache import TableCache
+
+
+class FakeTable(object):
+
+  def __init__(self):
+    self.n_header_calls = 0
+    self.closed = False
+
+  def getHeaders(self):
+    self.n_header_calls += 1
+    return ['c0', 'c1']
+
+  def getNumberOfRows(self):
+    return 10
+
+  def close(self):
+    self.closed = True
+
+
+class TestTableCache(unittest.TestCase):
+
+  def test_headers(self):
+    cache = TableCache()
+    ft = FakeTable()
+    t = cache.put('t', ft)
+    for _ in xrange(3):
+      self.assertTrue(cache.get('t') is t)
+      self.assertEqual(t.getHeaders(), ['c0', 'c1'])
+      self.assertEqual(t.getNumberOfRows(), 10)
+    self.assertEqual(ft.n_header_calls, 1)
+    self.assertEqual(cache.stats()['hits'], 3)
+
+  def test_invalidation(self):
+    cache = TableCache(max_size=2)
+    tables = [FakeTable() for _ in xrange(3)]
+    for i, ft in enumerate(tables):
+      cache.put('t%d' % i, ft)
+    self.assertFalse('t0' in cache)
+    self.assertTrue(tables[0].closed)
+    self.assertEqual(len(cache), 2)
+    cache.invalidate('t1')
+    self.assertTrue(cache.get('t1') is None)
+    self.assertTrue(tables[1].closed)
+    cache.invalidate('t1')
+    cache.clear()
+    self.assertEqual(len(cache), 0)
+    self.assertTrue(tables[2].closed)
+
+  def test_invalidation_deleted(self):
+    cache = TableCache()
+    ft = FakeTable()
+    def close():
+      raise RuntimeError('table deleted')
+    ft.close = close
+    cache.put('t', ft)
+    cache.invalidate('t')
+    self.assertFalse('t' in cache)
+
+  def test_eviction_in_use(self):
+    cache = TableCache(max_size=1)
+    ft = FakeTable()
+    t = cache.put('t0', ft)
+    t.acquire()
+    cache.put('t1', FakeTable())
+    self.assertFalse('t0' in cache)
+    self.assertFalse(ft.closed)
+    t.release()
+    self.assertTrue(ft.closed)
+
+
+def suite():
+  suite = unittest.TestSuite()
+  suite.addTest(TestTableCache('test_headers'))
+  suite.addTest(TestTableCache('test_invalidation'))
+  suite.addTest(TestTableCache('test_invalidation_deleted'))
+  suite.addTest(TestTableCache('test_eviction_in_use'))
+  return suite
+
+
+if __name__ == '__main__':
+  runner = unittest.TextTestRunner(verbosity=2)
+  runner.run((suite()))
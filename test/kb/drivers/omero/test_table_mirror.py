@@ -0,0 +1,70 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+import unittest, tempfile, shutil
+
+import numpy as np
+
+from bl.vl.kb.drivers.omero.table_mirror import TableMirror
+
+
+def make_rows(n_rows):
+  data = np.zeros(n_rows, dtype=[('vid', '|S34'), ('pos', 'i8'),
+                                 ('probs', '(4,)float32')])
+  data['vid'] = ['V%04d' % i for i in xrange(n_rows)]
+  data['pos'] = np.arange(n_rows)
+  return data
+
+
+class TestTableMirror(unittest.TestCase):
+
+  def setUp(self):
+    self.root = tempfile.mkdtemp(prefix='table_mirror_')
+
+  def tearDown(self):
+    shutil.rmtree(self.root, ignore_errors=True)
+
+  def test_get_put(self):
+    mirror = TableMirror(self.root)
+    data = make_rows(10)
+    self.assertTrue(mirror.get('mset-V01.h5', 1, 10) is None)
+    mirror.put('mset-V01.h5', 1, 10, data)
+    m = mirror.get('mset-V01.h5', 1, 10)
+    self.assertTrue(isinstance(m, np.memmap))
+    self.assertTrue(np.all(m == data))
+    self.assertTrue(mirror.get('mset-V01.h5', 1, 10, selector='(pos > 2)')
+                    is None)
+    stats = mirror.stats()
+    self.assertEqual(stats['hits'], 1)
+    self.assertEqual(stats['misses'], 2)
+
+  def test_versions(self):
+    mirror = TableMirror(self.root)
+    mirror.put('align-V01.h5', 1, 10, make_rows(10))
+    mirror.put('align-V01.h5', 1, 20, make_rows(20))
+    self.assertTrue(mirror.get('align-V01.h5', 1, 10) is None)
+    self.assertEqual(len(mirror.get('align-V01.h5', 1, 20)), 20)
+    mirror.purge('align-V01.h5')
+    self.assertTrue(mirror.get('align-V01.h5', 1, 20) is None)
+
+  def test_quota(self):
+    data = make_rows(100)
+    mirror = TableMirror(self.root, quota=int(2.5 * data.nbytes))
+    for i in xrange(4):
+      mirror.put('mset-V%02d.h5' % i, i, 100, data)
+    self.assertTrue(mirror.size() <= mirror.quota)
+    self.assertEqual(mirror.stats()['evictions'], 2)
+    self.assertFalse(mirror.get('mset-V03.h5', 3, 100) is None)
+
+
+def suite():
+  suite = unittest.TestSuite()
+  suite.addTest(TestTableMirror('test_get_put'))
+  suite.addTest(TestTableMirror('test_versions'))
+  suite.addTest(TestTableMirror('test_quota'))
+  return suite
+
+
+if __name__ == '__main__':
+  runner = unittest.TextTestRunner(verbosity=2)
+  runner.run((suite()))
@@ -76,11 +76,35 @@ class TestKB(KBObjectCreator):
     for p in npeople:
       self.assertTrue(p.id in vids)
 
+  def test_get_by_vids_pooled(self):
+    aconf, action = self.create_action()
+    self.kill_list.append(action.save())
+    N = 1000
+    people = []
+    for i in range(N):
+      conf, i = self.create_individual(action=action,
+                                       gender=self.kb.Gender.MALE)
+      self.kill_list.append(i)
+      people.append(i)
+    self.kb.save_array(people)
+    vids = [p.id for p in people]
+    kb = KB(driver='omero')(OME_HOST, OME_USER, OME_PASS, pool_size=4)
+    try:
+      by_vid = kb.get_by_vids(kb.Individual, vids, batch_size=N/8)
+      multi = kb.get_by_field(kb.Individual, 'vid', vids, multi_valued=True)
+    finally:
+      kb.close()
+    self.assertEqual(sorted(by_vid.keys()), sorted(vids))
+    self.assertEqual(sorted(multi.keys()), sorted(vids))
+    for v in multi.itervalues():
+      self.assertEqual(len(v), 1)
+
 
 def suite():
   suite = unittest.TestSuite()
   suite.addTest(TestKB('test_parallel_save'))
   suite.addTest(TestKB('test_get_by_vids'))
+  suite.addTest(TestKB('test_get_by_vids_pooled'))
   return suite
 
 
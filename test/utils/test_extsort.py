@@ -0,0 +1,63 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+import os, unittest, tempfile, shutil, random
+from operator import itemgetter
+
+import bl.vl.utils.extsort as extsort
+
+
+class TestExternalSort(unittest.TestCase):
+
+  def setUp(self):
+    self.wd = tempfile.mkdtemp(prefix='bl_vl_')
+    self.records = [{'index': random.randint(0, 100), 'label': 'M%d' % i}
+                    for i in xrange(2000)]
+
+  def tearDown(self):
+    shutil.rmtree(self.wd)
+
+  def __check(self, memory_budget):
+    events = []
+    res = list(extsort.external_sort(
+      iter(self.records), itemgetter('index'), memory_budget=memory_budget,
+      tmp_dir=self.wd, progress=lambda *args: events.append(args)
+      ))
+    # sorted() is stable too
+    self.assertEqual(res, sorted(self.records, key=itemgetter('index')))
+    self.assertEqual(os.listdir(self.wd), [])
+    return events
+
+  def test_in_memory(self):
+    events = self.__check(extsort.DEFAULT_MEMORY_BUDGET)
+    self.assertFalse([e for e in events if e[0] == 'spill'])
+
+  def test_spill(self):
+    events = self.__check(10000)
+    self.assertTrue([e for e in events if e[0] == 'spill'])
+
+  def test_multi_pass(self):
+    old_max_open_runs = extsort.MAX_OPEN_RUNS
+    extsort.MAX_OPEN_RUNS = 4
+    try:
+      events = self.__check(2000)
+    finally:
+      extsort.MAX_OPEN_RUNS = old_max_open_runs
+    self.assertTrue(max(e[1] for e in events if e[0] == 'spill') > 16)
+
+  def test_empty(self):
+    self.assertEqual(list(extsort.external_sort(iter([]), lambda x: x)), [])
+
+
+def suite():
+  suite = unittest.TestSuite()
+  suite.addTest(TestExternalSort('test_in_memory'))
+  suite.addTest(TestExternalSort('test_spill'))
+  suite.addTest(TestExternalSort('test_multi_pass'))
+  suite.addTest(TestExternalSort('test_empty'))
+  return suite
+
+
+if __name__ == '__main__':
+  runner = unittest.TextTestRunner(verbosity=2)
+  runner.run((suite()))
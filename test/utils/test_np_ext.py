@@ -61,12 +61,65 @@ class TestIndexIntersect(unittest.TestCase):
     print "finished in %.1f s" % (time.time()-t0)
 
 
+class TestMultiIndex(unittest.TestCase):
+
+  def setUp(self):
+    self.arrays = [np.random.permutation(1000)[:n] for n in 600, 700, 800]
+    self.arrays.append(np.arange(0, 1000, 3))
+
+  def test_sorted_keys(self):
+    a = np.arange(10)
+    k = np_ext.SortedKeys(a)
+    self.assertTrue(k.keys is a)
+    self.assertTrue(k.order is None)
+    k = np_ext.SortedKeys(a[::-1])
+    self.assertEqual(k.keys.tolist(), a.tolist())
+    found, pos = k.lookup(np.array([3, 42, 0]))
+    self.assertEqual(found.tolist(), [True, False, True])
+    self.assertEqual(pos.tolist(), [6, 9])
+    self.assertRaises(ValueError, np_ext.SortedKeys, np.array([1, 3, 1]))
+
+  def test_intersect(self):
+    keys = [np_ext.SortedKeys(a) for a in self.arrays]
+    for arrays in self.arrays, keys:
+      indexes = np_ext.multi_index_intersect(arrays)
+      common = reduce(np.intersect1d, self.arrays)
+      for a, idx in zip(self.arrays, indexes):
+        self.assertEqual(a[idx].tolist(), common.tolist())
+    empty = self.arrays[0][:0]
+    self.assertEqual(
+      [len(i) for i in np_ext.multi_index_intersect([self.arrays[0], empty])],
+      [0, 0])
+    self.assertRaises(ValueError, np_ext.multi_index_intersect,
+                      [self.arrays[0], self.arrays[1].astype(np.float64)])
+
+  def test_union(self):
+    union, indexes = np_ext.multi_index_union(self.arrays)
+    self.assertEqual(union.tolist(), reduce(np.union1d, self.arrays).tolist())
+    for a, idx in zip(self.arrays, indexes):
+      found = idx >= 0
+      self.assertEqual(found.sum(), len(a))
+      self.assertEqual(a[idx[found]].tolist(), union[found].tolist())
+
+
+class TestIndexRanges(unittest.TestCase):
+
+  def test_ranges(self):
+    a = np.array([1, 2, 3, 7, 9, 10])
+    self.assertEqual(np_ext.index_ranges(a), [(1, 4), (7, 8), (9, 11)])
+    self.assertEqual(np_ext.index_ranges(np.array([], dtype=int)), [])
+    self.assertEqual(np_ext.index_ranges([5]), [(5, 6)])
+
 def suite():
   suite = unittest.TestSuite()
   suite.addTest(TestIndexIntersect('test_simple_array'))
   suite.addTest(TestIndexIntersect('test_record_array'))
   suite.addTest(TestIndexIntersect('test_exceptions'))
   #suite.addTest(TestIndexIntersect('test_performance'))
+  suite.addTest(TestMultiIndex('test_sorted_keys'))
+  suite.addTest(TestMultiIndex('test_intersect'))
+  suite.addTest(TestMultiIndex('test_union'))
+  suite.addTest(TestIndexRanges('test_ranges'))
   return suite
 
 